@@ -14,11 +14,11 @@ def matrix ( mols, mcs_ids, rule ):
     title_vs_simi = {}
     title_list = []
     filename_vs_title = {}
-    for mol in mols:
+    file_paths = KBASE.ask_many([mol.id() for mol in mols], "filename")
+    for mol, file_path in zip(mols, file_paths):
         #generate dictionary of id vs title of giving mols
         title = mol.title()
         id = mol.id()
-        file_path = KBASE.ask (id, "filename")
         filename = os.path.basename(file_path)
         if id not in id_list:
             id_list.append(id)
@@ -26,9 +26,8 @@ def matrix ( mols, mcs_ids, rule ):
             title_list.append(title)
         id_vs_title [id] = title
         filename_vs_title [filename] = title
-    for id in mcs_ids:
+    for id, (id0, id1) in zip(mcs_ids, KBASE.ask_many(mcs_ids, "mcs-parents")):
         #generate dictionary of pair's title vs similarity score
-        id0, id1 = mcs.get_parent_ids(id)
         simi       = rule.similarity( id0, id1, mcs_id = id )        
         title0 = id_vs_title[id0]
         title1 = id_vs_title[id1]
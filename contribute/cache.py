@@ -0,0 +1,170 @@
+"""Persistent on-disk cache of MCS searching results
+"""
+
+
+
+from kbase import KBASE
+
+import os
+import shelve
+import pickle
+import hashlib
+
+
+
+def struc_key( mol ) :
+    """
+    Returns a content-based key of the molecule C{mol}, which is the canonical SMILES plus a digest of the connection table.
+
+    The canonical SMILES alone identifies the chemical structure, but atom matches are stored as atom indices, which are only
+    valid for the same atom ordering. So the connection table (heavy/hydrogen flag and bonded atoms of each atom, in the order
+    of atom indices) goes into the key as well.
+
+    @type  mol: C{Struc}
+    @param mol: A molecule in the C{KBASE}
+    """
+    try :
+        smiles = KBASE.ask( mol.id(), "SMILES" )
+    except LookupError :
+        smiles = mol.smiles()
+        KBASE.deposit_extra( mol.id(), "SMILES", smiles )
+
+    heavy_atoms = set( mol.heavy_atoms() )
+    table       = []
+    for i in range( 1, len( mol.atom ) + 1 ) :
+        bonded_atoms = ",".join( [str( e ) for e in sorted( mol.bonded_atoms( i ) )] )
+        table.append( "%s:%s" % ("X" if (i in heavy_atoms) else "H", bonded_atoms,) )
+    return "%s %s" % (smiles, hashlib.sha1( ";".join( table ) ).hexdigest(),)
+
+
+
+class McsCache( object ) :
+    """
+    A content-addressed store of the atom matches produced by an MCS engine. The key of a pair of molecules is made of the
+    engine's signature (see C{Mcs.signature}) and the keys of the two molecules (see C{struc_key}), so the cached results
+    survive across runs, input file names and structure titles. Pairs without common substructure are cached as well.
+    """
+    def __init__( self, filename, signature ) :
+        """
+        @type   filename: C{str}
+        @param  filename: Name of the cache file. It will be created if it does not exist.
+        @type  signature: C{str}
+        @param signature: Signature of the MCS engine
+        """
+        self._db        = shelve.open( filename, protocol = pickle.HIGHEST_PROTOCOL )
+        self._signature = signature
+        self._struc_key = {}
+
+
+
+    def _key( self, mol0, mol1 ) :
+        keys = []
+        for mol in (mol0, mol1,) :
+            try :
+                keys.append( self._struc_key[mol.id()] )
+            except KeyError :
+                key = self._struc_key[mol.id()] = struc_key( mol )
+                keys.append( key )
+        return hashlib.sha1( "\n".join( [self._signature,] + keys ) ).hexdigest()
+
+
+
+    def get( self, mol0, mol1 ) :
+        """
+        Returns the cached result of C{Mcs.match} for the two molecules. Raises C{KeyError} if the pair is not in the cache.
+        """
+        return self._db[self._key( mol0, mol1 )]
+
+
+
+    def put( self, mol0, mol1, result ) :
+        """
+        Stores the result of C{Mcs.match} for the two molecules.
+        """
+        self._db[self._key( mol0, mol1 )] = result
+
+
+
+    def close( self ) :
+        self._db.close()
+
+
+
+class McsCheckpoint( object ) :
+    """
+    An append-only file of the results of an MCS search in progress, so that an interrupted search can be resumed. Each
+    record is a pickled tuple of (ID of the first molecule, ID of the second molecule, result of C{Mcs.match},), and the first
+    record is the engine's signature. Records are only ever appended and flushed to the disk, so a crash can at most leave an
+    incomplete last record, which is ignored when the file is loaded.
+
+    Unlike C{McsCache}, the records are keyed by the molecule IDs, so the resumed run must read the same structures.
+    """
+    def __init__( self, filename, signature, should_resume = False ) :
+        """
+        @type       filename: C{str}
+        @param      filename: Name of the checkpoint file
+        @type      signature: C{str}
+        @param     signature: Signature of the MCS engine
+        @type  should_resume: C{bool}
+        @param should_resume: If true, the records in the existing file are loaded (see C{get}) and new records are appended to
+                              them; otherwise the file is started afresh.
+        """
+        self._results = {}
+        if (should_resume and os.path.isfile( filename )) :
+            self._load( filename, signature )
+            self._fh = open( filename, "ab" )
+        else :
+            self._fh = open( filename, "wb" )
+            pickle.dump( signature, self._fh, pickle.HIGHEST_PROTOCOL )
+            self.flush()
+
+
+
+    def _load( self, filename, signature ) :
+        with open( filename, "rb" ) as fh :
+            if (pickle.load( fh ) != signature) :
+                raise ValueError( "Checkpoint file '%s' was written by a different MCS engine." % filename )
+            while (True) :
+                end = fh.tell()
+                try :
+                    id0, id1, result = pickle.load( fh )
+                except (EOFError, pickle.UnpicklingError, ValueError, TypeError, AttributeError, IndexError,) :
+                    # End of file, or the incomplete last record of an interrupted run.
+                    break
+                self._results[(id0, id1,)] = result
+        # Cuts off the incomplete record so that new records are not appended after it.
+        with open( filename, "r+b" ) as fh :
+            fh.truncate( end )
+
+
+
+    def __len__( self ) :
+        return len( self._results )
+
+
+
+    def get( self, mol0, mol1 ) :
+        """
+        Returns the recorded result of C{Mcs.match} for the two molecules. Raises C{KeyError} if the pair is not recorded.
+        """
+        return self._results[(mol0.id(), mol1.id(),)]
+
+
+
+    def put( self, mol0, mol1, result ) :
+        """
+        Appends the result of C{Mcs.match} for the two molecules. Call C{flush} to make sure it is on the disk.
+        """
+        pickle.dump( (mol0.id(), mol1.id(), result,), self._fh, pickle.HIGHEST_PROTOCOL )
+
+
+
+    def flush( self ) :
+        self._fh.flush()
+        os.fsync( self._fh.fileno() )
+
+
+
+    def close( self ) :
+        self.flush()
+        self._fh.close()
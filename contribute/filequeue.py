@@ -0,0 +1,281 @@
+"""A file-queue executor that spreads MCS searching over worker processes on any machines sharing a directory
+
+The driver (see C{FileQueue.match_pairs}) writes the pairs of structures to search as work units into the queue directory,
+and the workers (see C{work}) claim the units by renaming them, which is atomic on the same file system, and write the
+results back. Files in the queue directory:
+
+    job_<tag>.pkl                   the MCS engine and where (file and record) to read the structures of a job
+    todo/<tag>_<n>.pkl              work units waiting for workers
+    claimed/<tag>_<n>.pkl.<worker>  work units being searched by a worker
+    done/<tag>_<n>.pkl              results of work units
+    stop                            tells the workers started with C{--wait} to exit
+
+To start a worker on a machine that mounts the queue directory:
+
+    python filequeue.py --wait <queue-dir>
+"""
+
+
+
+from kbase import KBASE
+
+import struc
+import runner
+
+import os
+import sys
+import time
+import glob
+import socket
+import pickle
+import logging
+
+
+
+def _write( fname, obj ) :
+    """
+    Writes C{obj} into the file C{fname} atomically: other processes see either no file or the complete file.
+    """
+    tmp_fname = "%s.tmp.%s.%d" % (fname, socket.gethostname(), os.getpid(),)
+    with open( tmp_fname, "wb" ) as fh :
+        pickle.dump( obj, fh, pickle.HIGHEST_PROTOCOL )
+    os.rename( tmp_fname, fname )
+
+
+
+def _read( fname ) :
+    with open( fname, "rb" ) as fh :
+        return pickle.load( fh )
+
+
+
+class FileQueue( object ) :
+    """
+    The driver side of the queue.
+    """
+    # Seconds without results after which the outstanding work units are logged
+    report_interval = 300
+
+    def __init__( self, dirname ) :
+        """
+        @type  dirname: C{str}
+        @param dirname: Name of the queue directory. It will be created if it does not exist.
+        """
+        self._dirname = os.path.abspath( dirname )
+        for e in ("todo", "claimed", "done",) :
+            if (not os.path.isdir( os.path.join( self._dirname, e ) )) :
+                os.makedirs( os.path.join( self._dirname, e ) )
+
+
+
+    def _write_job( self, tag, engine, mols ) :
+        strucs = []
+        for mol in mols :
+            source = KBASE.source( mol.id() )
+            if (source is None) :
+                raise ValueError( "Structure '%s' was not read from a structure file, so file-queue workers cannot read it."
+                                  % mol.title() )
+            strucs.append( (mol.id(), os.path.abspath( source[0] ), source[1],) )
+        _write( os.path.join( self._dirname, "job_%s.pkl" % tag ), {"engine" : engine, "strucs" : strucs,} )
+
+
+
+    def _report_outstanding( self, tag, units, claim_timeout ) :
+        """
+        Logs the work units of the job C{tag} that are still outstanding, and who claimed them.
+        """
+        claims = [os.path.basename( e ) for e in glob.glob( os.path.join( self._dirname, "claimed", tag + "_*" ) )]
+        logging.warn( "WARNING: No results from the file queue for %d seconds. %d work units are outstanding: %d queued, "
+                      "%d claimed." % (self.report_interval, len( units ), len( units ) - len( claims ), len( claims ),) )
+        for e in sorted( claims ) :
+            name = e[:e.index( ".pkl" ) + 4]
+            try :
+                age = time.time() - os.path.getmtime( os.path.join( self._dirname, "claimed", e ) )
+            except OSError :
+                # Finished or queued again in the meantime
+                continue
+            logging.warn( "  '%s' claimed by worker '%s' %d seconds ago" % (name, e[len( name ) + 1:], age,) )
+        if (claims and not claim_timeout) :
+            logging.warn( "  Units of dead workers are never queued again without --queue-timeout." )
+
+
+
+    def _requeue_stale( self, claim_timeout ) :
+        """
+        Moves the work units that have been claimed for longer than C{claim_timeout} seconds back into the queue, as their
+        workers might be dead.
+        """
+        for fname in glob.glob( os.path.join( self._dirname, "claimed", "*" ) ) :
+            try :
+                if (time.time() - os.path.getmtime( fname ) > claim_timeout) :
+                    name = os.path.basename( fname )
+                    name = name[:name.index( ".pkl" ) + 4]
+                    os.rename( fname, os.path.join( self._dirname, "todo", name ) )
+                    logging.warn( "WARNING: Work unit '%s' was claimed too long ago and is queued again." % name )
+            except OSError :
+                # The unit was finished or requeued in the meantime.
+                pass
+
+
+
+    def match_pairs( self, engine, mols, pairs, unit_size = 100, num_workers = 0, claim_timeout = 0 ) :
+        """
+        Queues the pairs of molecules in work units of C{unit_size} pairs, and yields a tuple of (pairs of the work unit,
+        results of C{Mcs.match} on the pairs,) for each unit as the results arrive, in no particular order.
+
+        @type         engine: C{Mcs}
+        @param        engine: The MCS engine. It is pickled for the workers.
+        @type           mols: C{list} of C{Struc}
+        @param          mols: A list of molecules. The workers read them from the structure files recorded in the C{KBASE}.
+        @type          pairs: C{list} of C{(int, int,)}
+        @param         pairs: A list of pairs of indices into C{mols}
+        @type    num_workers: C{int}
+        @param   num_workers: Number of worker processes to start on this machine. Workers on other machines can be
+                              started separately.
+        @type  claim_timeout: C{float}
+        @param claim_timeout: Work units claimed for longer than this number of seconds are queued again. 0 means never.
+        """
+        if (not pairs) :
+            return
+        tag      = "%s_%d_%d" % (socket.gethostname(), os.getpid(), int( time.time() * 1000 ),)
+        involved = sorted( set( [i for i, j in pairs] + [j for i, j in pairs] ) )
+        self._write_job( tag, engine, [mols[i] for i in involved] )
+
+        units = {}
+        for k in range( 0, len( pairs ), unit_size ) :
+            name        = "%s_%d.pkl" % (tag, k // unit_size,)
+            units[name] = pairs[k:k + unit_size]
+            _write( os.path.join( self._dirname, "todo", name ),
+                    (tag, [(mols[i].id(), mols[j].id(),) for i, j in units[name]],) )
+        logging.info( "  %d work units queued in '%s'." % (len( units ), self._dirname,) )
+
+        script  = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), "filequeue.py" )
+        workers = runner.Runner( num_workers )
+        for k in range( num_workers ) :
+            workers.submit( [sys.executable, script, self._dirname,], name = "worker %d" % k )
+        try :
+            last_result = time.time()
+            while (units) :
+                names = [os.path.basename( e ) for e in glob.glob( os.path.join( self._dirname, "done", tag + "_*.pkl" ) )]
+                for name in names :
+                    fname   = os.path.join( self._dirname, "done", name )
+                    results = _read( fname )
+                    os.remove( fname )
+                    if (name in units) :
+                        yield units.pop( name ), results
+                if (names) :
+                    last_result = time.time()
+                    continue
+                workers.poll()
+                if ([e for e in workers.jobs if (e.returncode not in (None, 0,))]) :
+                    raise RuntimeError( "A file-queue worker failed." )
+                if (claim_timeout) :
+                    self._requeue_stale( claim_timeout )
+                if (time.time() - last_result > self.report_interval) :
+                    self._report_outstanding( tag, units, claim_timeout )
+                    last_result = time.time()
+                time.sleep( 0.5 )
+        finally :
+            workers.cancel()
+            for fname in glob.glob( os.path.join( self._dirname, "*", tag + "_*" ) ) + \
+                         [os.path.join( self._dirname, "job_%s.pkl" % tag ),] :
+                try :
+                    os.remove( fname )
+                except OSError :
+                    pass
+
+
+
+def _load_job( fname ) :
+    """
+    Reads the structures of a job into the C{KBASE} under the same IDs as in the driver, and returns the MCS engine of the
+    job.
+    """
+    job       = _read( fname )
+    filenames = {}
+    for id, filename, record in job["strucs"] :
+        filenames.setdefault( filename, {} ).setdefault( record, [] ).append( id )
+    for filename, records in filenames.items() :
+        # Structures are found by their record indices in the file, as titles need not be unique.
+        for record, s in enumerate( struc.read_file( filename ) ) :
+            for k, id in enumerate( records.get( record, [] ) ) :
+                e = s.copy() if (k) else s
+                KBASE.deposit( id, e, should_overwrite = True )
+                e.set_id( id )
+    return job["engine"]
+
+
+
+def _claim( dirname, worker ) :
+    """
+    Claims a work unit in the queue directory C{dirname} for the worker C{worker}, and returns a tuple of (name of the unit,
+    name of the claimed file,), or C{(None, None,)} if there are no units to claim.
+    """
+    for e in sorted( os.listdir( os.path.join( dirname, "todo" ) ) ) :
+        if (not e.endswith( ".pkl" )) :
+            # Being written by the driver
+            continue
+        claimed = os.path.join( dirname, "claimed", "%s.%s" % (e, worker,) )
+        try :
+            os.rename( os.path.join( dirname, "todo", e ), claimed )
+        except OSError :
+            # Claimed by another worker
+            continue
+        try :
+            # The age of a claim (see `FileQueue._requeue_stale') is counted from now, not from when the unit was queued, as
+            # renaming keeps the modification time.
+            os.utime( claimed, None )
+        except OSError :
+            # Queued again by the driver in the meantime
+            continue
+        return e, claimed
+    return None, None
+
+
+
+def work( dirname, should_wait = False ) :
+    """
+    Claims and searches the work units in the queue directory C{dirname} until there are no more units, or until the "stop"
+    file appears in the directory if C{should_wait} is true.
+    """
+    worker = "%s.%d" % (socket.gethostname(), os.getpid(),)
+    jobs   = {}
+    while (True) :
+        name, claimed = _claim( dirname, worker )
+        if (name is None) :
+            if (should_wait and not os.path.exists( os.path.join( dirname, "stop" ) )) :
+                time.sleep( 1.0 )
+                continue
+            return
+
+        tag, id_pairs = _read( claimed )
+        if (tag not in jobs) :
+            jobs[tag] = _load_job( os.path.join( dirname, "job_%s.pkl" % tag ) )
+        engine  = jobs[tag]
+        ids     = sorted( set( [id0 for id0, id1 in id_pairs] + [id1 for id0, id1 in id_pairs] ) )
+        index   = dict( [(id, k,) for k, id in enumerate( ids )] )
+        mols    = [KBASE.ask( id ) for id in ids]
+        results = engine.match_pairs( mols, [(index[id0], index[id1],) for id0, id1 in id_pairs] )
+        _write( os.path.join( dirname, "done", name ), results )
+        try :
+            os.remove( claimed )
+        except OSError :
+            # The driver queued the unit again in the meantime.
+            pass
+
+
+
+if ("__main__" == __name__) :
+    from optparse import OptionParser
+
+    logging.basicConfig( format  = '%(asctime)s: %(message)s',
+                         datefmt = '%m/%d/%y %I:%M:%S',
+                         level   = logging.INFO )
+    parser = OptionParser( usage = "Usage: %prog [options] <queue-dir>" )
+    parser.add_option( "--wait", default = False, action = "store_true",
+                       help = "keep waiting for new work units until the file 'stop' appears in the queue directory." )
+    (opt, args) = parser.parse_args()
+    if (len( args ) != 1) :
+        parser.print_help()
+        sys.exit( 1 )
+    work( args[0], opt.wait )
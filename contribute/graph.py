@@ -3,6 +3,7 @@
  
 from kbase import KBASE
 
+import kbase
 import struc
 import rule
 import mcs
@@ -26,22 +27,17 @@ def create( basic_graph, mcs_ids, rule, add_attr = True ) :
     @type  rule    : C{Rule}
     @param rule    : The rule to determine the similarity score between two structures
     """
-    g = copy.deepcopy( basic_graph )
-    for id in mcs_ids :
-        id0, id1 = mcs.get_parent_ids( id )
+    g             = copy.deepcopy( basic_graph )
+    parents       = KBASE.ask_many( mcs_ids, "mcs-parents" )
+    partial_rings = KBASE.ask_many( mcs_ids, "partial_ring",     0   ) if (add_attr) else None
+    slack_simis   = KBASE.ask_many( mcs_ids, "slack_similarity", 0.0 ) if (add_attr) else None
+    for k, id in enumerate( mcs_ids ) :
+        id0, id1 = parents[k]
         simi     = rule.similarity( id0, id1, mcs_id = id )
         if (simi > 0) :
             if (add_attr) :
-                try :
-                    partial_ring = int( KBASE.ask( id, "partial_ring" ) )
-                except LookupError :
-                    partial_ring = 0
-                try :
-                    slack_simi = KBASE.ask( id, "slack_similarity" )
-                except LookupError :
-                    slack_simi = 0.0
-                g.add_edge( id0, id1, similarity = simi, slack_similarity = slack_simi,
-                            partial_ring = partial_ring, mcs_id = id )
+                g.add_edge( id0, id1, similarity = simi, slack_similarity = slack_simis[k],
+                            partial_ring = int( partial_rings[k] ), mcs_id = id )
             else :
                 g.add_edge( id0, id1, similarity = simi )
     return g
@@ -248,7 +244,51 @@ def optimize_graph( complete, desired, algo, simi_cutoff ) :
         return trim_cluster( desired, desired.nodes(), 2 )
     
 
-def gen_graph( mcs_ids, basic_rule, slack_rule, simi_cutoff, max_csize, num_c2c ) :
+def calc_similarity( mcs_ids, basic_rule, slack_rule, num_jobs = 1 ) :
+    """
+    Calculates the strict and slack similarity scores for each of the given common substructures and deposits them into
+    C{KBASE} with the tags "similarity" and "slack_similarity", respectively. Returns the set of IDs of all parent molecules.
+    Scores that are already in the C{KBASE}, e.g., from a snapshot (see C{kbase.write_snapshot}), are reused.
+
+    @type     mcs_ids: C{list} of C{str}
+    @param    mcs_ids: A list of ids of the maximum substructures in C{KBASE}
+    @type  basic_rule: C{rule.Rule}
+    @param basic_rule: The rule to determine the (strict) similarity score between two structures
+    @type  slack_rule: C{rule.Rule}
+    @param slack_rule: The rule to determine the slack similarity score between two structures
+    @type    num_jobs: C{int}
+    @param   num_jobs: Number of worker processes to evaluate the rules (see C{kbase.parallel_map})
+    """
+    all_ids = set()
+    fh      = open( "simiscore", "w" ) if (logging.getLogger().getEffectiveLevel() == logging.DEBUG) else None
+    logging.info( "  Calculating similarity scores..." )
+    parents = KBASE.ask_many( mcs_ids, "mcs-parents" )
+
+    def scores( k ) :
+        #calculate the similarity scores for molecule pair
+        id0, id1 = parents[k]
+        return (basic_rule.similarity( id0, id1, mcs_id = mcs_ids[k] ),
+                slack_rule.similarity( id0, id1, mcs_id = mcs_ids[k] ),)
+
+    simis = zip( KBASE.ask_many( mcs_ids, "similarity" ), KBASE.ask_many( mcs_ids, "slack_similarity" ) )
+    todo  = [k for k, e in enumerate( simis ) if (None in e)]
+    if (len( todo ) < len( mcs_ids )) :
+        logging.info( "  %d of %d pairs already scored." % (len( mcs_ids ) - len( todo ), len( mcs_ids ),) )
+    for k, e in zip( todo, kbase.parallel_map( scores, todo, num_jobs ) ) :
+        simis[k] = e
+
+    for k, (simi, slack_simi,) in enumerate( simis ) :
+        all_ids.update( parents[k] )
+        if (fh) :
+            print >> fh, simi
+    KBASE.deposit_many( [(mcs_ids[k], simis[k][0],) for k in todo], "similarity"       )
+    KBASE.deposit_many( [(mcs_ids[k], simis[k][1],) for k in todo], "slack_similarity" )
+    logging.info( "  Calculating similarity scores... Done" )
+    return all_ids
+
+
+
+def gen_graph( mcs_ids, basic_rule, slack_rule, simi_cutoff, max_csize, num_c2c, num_jobs = 1 ) :
     """
     Generates and returns a graph according to the requirements.
     
@@ -262,24 +302,11 @@ def gen_graph( mcs_ids, basic_rule, slack_rule, simi_cutoff, max_csize, num_c2c
     @param   max_csize: Maximum cluster size
     @type      num_c2c: C{int}
     @param     num_c2c: Number of cluster-to-cluster edges
+    @type     num_jobs: C{int}
+    @param    num_jobs: Number of worker processes to calculate the similarity scores
     """
     basic_graph = networkx.Graph()
-    all_ids     = set()
-    fh          = open( "simiscore", "w" ) if (logging.getLogger().getEffectiveLevel() == logging.DEBUG) else None
-    logging.info( "  Calculating similarity scores..." )
-    for id in mcs_ids :
-        #get the id for mol0 and mol1
-        id0, id1   = mcs.get_parent_ids( id )
-        #calculate the similarity scores for molecule pair
-        simi       = basic_rule.similarity( id0, id1, mcs_id = id )
-        slack_simi = slack_rule.similarity( id0, id1, mcs_id = id )
-        KBASE.deposit_extra( id, "similarity",             simi )
-        KBASE.deposit_extra( id, "slack_similarity", slack_simi )
-        all_ids.add( id0 )
-        all_ids.add( id1 )
-        if (fh) :
-            print >> fh, simi
-    logging.info( "  Calculating similarity scores... Done" )
+    all_ids     = calc_similarity( mcs_ids, basic_rule, slack_rule, num_jobs )
     basic_graph.add_nodes_from( all_ids )
     #create a complete graph
     complete = create( basic_graph, mcs_ids, rule.Cutoff( 0 ) )
@@ -355,73 +382,153 @@ def gen_graph( mcs_ids, basic_rule, slack_rule, simi_cutoff, max_csize, num_c2c
 
 
 
-def annotate_nodes_with_smiles( g ) :
+def add_nodes( g, new_ids, mcs_ids, basic_rule, slack_rule, simi_cutoff, num_edges = 2, num_jobs = 1 ) :
     """
+    Adds new molecules to an existing graph (as generated by C{gen_graph}) in place, without rebuilding it.
+
+    Only the edges incident to the new molecules are optimized; edges already in C{g} are kept as they are. Among the
+    candidate edges whose similarity scores are not less than C{simi_cutoff}, each new molecule keeps its C{num_edges} best
+    edges plus the new edges on the maximum spanning tree of its neighborhood, which is the same criterion as
+    C{trim_cluster}. A group of new molecules that ends up disconnected from the rest of the graph is connected to it through
+    its best boundary edge, as C{gen_graph} connects clusters.
 
+    @type            g: C{networkx.Graph}
+    @param           g: The existing graph
+    @type      new_ids: C{list} of C{str}
+    @param     new_ids: IDs of the new molecules in C{KBASE}
+    @type      mcs_ids: C{list} of C{str}
+    @param     mcs_ids: IDs of the maximum substructures between the new molecules and all (old and new) molecules
+    @type  simi_cutoff: C{float}
+    @param simi_cutoff: Cutoff of similarity scores. Values less than the cutoff are considered as 0.
+    @type    num_edges: C{int}
+    @param   num_edges: Number of edges that each new molecule is wanted to have
+    @type     num_jobs: C{int}
+    @param    num_jobs: Number of worker processes to calculate the similarity scores
     """
-    for molid in g.nodes() :
-        try :
-            smiles = KBASE.ask( molid, "SMILES" )
-        except LookupError :
+    calc_similarity( mcs_ids, basic_rule, slack_rule, num_jobs )
+    basic_graph = networkx.Graph()
+    basic_graph.add_nodes_from( new_ids )
+    complete    = create( basic_graph, mcs_ids, rule.Cutoff( 0 ) )
+    desired     = cutoff_graph( complete, simi_cutoff )
+
+    # Edges to keep: the best edges of each new molecule...
+    edges = set()
+    for e in new_ids :
+        r = sorted( desired.edges( e, data = True ), lambda x, y : cmp_edge( desired, x, y ) )
+        edges |= set( [(x[0], x[1],) for x in r[-num_edges:]] )
+
+    # ...and the new edges on the maximum spanning tree of the neighborhood, including the existing edges around it.
+    sg = networkx.Graph( desired )
+    sg.add_edges_from( g.subgraph( [e for e in sg.nodes() if (e in g)] ).edges( data = True ) )
+    for e in sg.edges() :
+        sg[e[0]][e[1]]["reversed_similarity"] = -sg[e[0]][e[1]]["similarity"]
+    for e in networkx.minimum_spanning_edges( sg, "reversed_similarity" ) :
+        if (e[0] in desired and e[1] in desired[e[0]]) :
+            edges.add( (e[0], e[1],) )
+
+    g.add_nodes_from( new_ids )
+    for id0, id1 in edges :
+        g.add_edge( id0, id1, **complete[id0][id1] )
+
+    # Connects new molecules that are not connected to any old one.
+    old_ids = set( g.nodes() ) - set( new_ids )
+    for c in networkx.connected_components( g.subgraph( new_ids ) ) :
+        if (networkx.node_boundary( g, c, old_ids )) :
+            continue
+        c2c_edges = networkx.edge_boundary( complete, c, old_ids )
+        if (len( c2c_edges ) == 0) :
+            logging.warn( "WARNING: Cannot connect %d new structure(s) with the existing ones." % len( c )           )
+            logging.warn( "         If there should be connections, consider to adjust the rules to" )
+            logging.warn( "         reduce 0-similarity assignments or loosen the MCS conditions."   )
+            continue
+        c2c_edges.sort( lambda x, y : cmp_edge( complete, x, y ) )
+        node0, node1 = c2c_edges[-1]
+        simi         = complete[node0][node1]["similarity"]
+        mcs_id       = complete[node0][node1]["mcs_id"    ]
+        g.add_edge( node0, node1, similarity = simi, boundary = True, mcs_id = mcs_id )
+        logging.warn( "  boundary similarity = %f between '%s' and '%s'" % (simi, KBASE.ask( node0 ), KBASE.ask( node1 ),) )
+    return g
+
+
+
+def annotate_nodes_with_smiles( g, nbunch = None ) :
+    """
+
+    """
+    molids = list( g.nbunch_iter( nbunch ) )
+    new    = []
+    for molid, smiles in zip( molids, KBASE.ask_many( molids, "SMILES" ) ) :
+        if (smiles is None) :
             smiles = KBASE.ask( molid ).smiles()
-            KBASE.deposit_extra( molid, "SMILES", smiles )
+            new.append( (molid, smiles,) )
         g.node[molid]["SMILES"] = smiles
+    KBASE.deposit_many( new, "SMILES" )
 
 
 
-def annotate_nodes_with_title( g ) :
+def annotate_nodes_with_title( g, nbunch = None ) :
     """
 
     """
-    for molid in g.nodes() :
-        g.node[molid]["title"] = KBASE.ask( molid ).title()
+    molids = list( g.nbunch_iter( nbunch ) )
+    for molid, title in zip( molids, KBASE.ask_many( molids, "title" ) ) :
+        g.node[molid]["title"] = title if (title is not None) else struc.ask_descriptor( molid, "title" )
         g.node[molid]["label"] = molid[:7]
 
 
 
-def annotate_edges_with_smiles( g ) :
+def annotate_edges_with_smiles( g, nbunch = None ) :
     """
 
     """
-    for e in g.edges( data = True ) :
-        try :
-            mcs_id = e[2]["mcs_id"]
-            try :
-                smiles = KBASE.ask( mcs_id, "SMILES" )
-            except LookupError :
-                smiles = mcs.get_struc( mcs_id ).smiles()
-            KBASE.deposit_extra( mcs_id, "SMILES", smiles )
-            g[e[0]][e[1]]["SMILES"] = smiles
-        except KeyError :
-            pass
+    edges = [e for e in g.edges( nbunch, data = True ) if ("mcs_id" in e[2])]
+    new   = []
+    for e, smiles in zip( edges, KBASE.ask_many( [e[2]["mcs_id"] for e in edges], "SMILES" ) ) :
+        if (smiles is None) :
+            smiles = mcs.get_struc( e[2]["mcs_id"] ).smiles()
+            new.append( (e[2]["mcs_id"], smiles,) )
+        g[e[0]][e[1]]["SMILES"] = smiles
+    KBASE.deposit_many( new, "SMILES" )
+
 
 
+def annotate_edges_with_matches( g, nbunch = None ) :
+    """
 
-def annotate_edges_with_matches( g ) :
     """
+    edges        = [e for e in g.edges( nbunch, data = True ) if ("mcs_id" in e[2])]
+    mcs_ids      = [e[2]["mcs_id"] for e in edges]
+    trimmed_mcss = KBASE.ask_many( mcs_ids, "trimmed-mcs" )
+    layout_mcss  = KBASE.ask_many( mcs_ids, "layout_mcs"  )
+    for k, e in enumerate( edges ) :
+        mol0        = KBASE.ask( e[0] )
+        mol1        = KBASE.ask( e[1] )
+        mcs_matches = mcs.get_atom_matches( mcs_ids[k] )
+        g[e[0]][e[1]]["original-mcs"] = {e[0]:mol0.smarts( mcs_matches[e[0]] ), e[1]:mol1.smarts( mcs_matches[e[1]] ),}
+        g[e[0]][e[1]][ "trimmed-mcs"] = trimmed_mcss[k]
+        g[e[0]][e[1]][ "layout_mcs"]  = layout_mcss [k]
+
+
 
+def annotate_nodes_with_filename( g, nbunch = None ) :
     """
-    for e in g.edges( data = True ) :
-        try :
-            mcs_id      = e[2]["mcs_id"]
-            mol0        = KBASE.ask( e[0] )
-            mol1        = KBASE.ask( e[1] )
-            mcs_matches = KBASE.ask( mcs_id, "mcs-matches" )
-            trimmed_mcs = KBASE.ask( mcs_id, "trimmed-mcs" )
-            layout_mcs = KBASE.ask( mcs_id, "layout_mcs" )
-            g[e[0]][e[1]]["original-mcs"] = {e[0]:mol0.smarts( mcs_matches[e[0]] ), e[1]:mol1.smarts( mcs_matches[e[1]] ),}
-            g[e[0]][e[1]][ "trimmed-mcs"] = trimmed_mcs
-            g[e[0]][e[1]][ "layout_mcs"] = layout_mcs
-        except KeyError :
-            pass
+    Records the structure file of each molecule and the index of its record in the file, so that the molecules of a saved
+    graph can be read back later.
+    """
+    molids = list( g.nbunch_iter( nbunch ) )
+    for molid, filename in zip( molids, KBASE.ask_many( molids, "filename" ) ) :
+        g.node[molid]["filename"] = os.path.abspath( filename )
+        source = KBASE.source( molid )
+        if (source is not None) :
+            g.node[molid]["record"] = source[1]
 
 
 
-def annotate_edges_with_hexcode( g ) :
+def annotate_edges_with_hexcode( g, nbunch = None ) :
     """
 
     """
-    for e in g.edges() :
+    for e in g.edges( nbunch ) :
         g[e[0]][e[1]]["label"] = "%s-%s" % (e[0][:7], e[1][:7],)
 
 
@@ -1,16 +1,232 @@
-"""Defines a simple dictionary-based knowledge base.
+"""Defines a simple dictionary-based knowledge base, a persistent one backed by an SQLite file, and snapshots of knowledge
+bases in memory-mapped columns.
 """
 
 
 
+import os
+import sys
+import time
+import atexit
+import logging
+import cPickle as pickle
+import sqlite3
 import hashlib
+import collections
+import multiprocessing
 
 
 
-class Kbase( object ) :
+class Record( object ) :
+    """
+    Base class of the records that hold the extra knowlets of a key, each in its own typed field. A field is C{None} when its
+    knowlet has not been deposited. Knowlets whose tags have no field go into the C{others} dict.
+    """
+    __slots__ = ()
+
+    # Tag -> field name
+    _TAGS = {}
+
     def __init__( self ) :
+        for e in self.__slots__ :
+            setattr( self, e, None )
+
+
+
+    def get( self, tag ) :
+        """
+        Returns the knowlet of the tag C{tag}. Raises C{KeyError} if it has not been deposited.
+        """
+        field = self._TAGS.get( tag )
+        if (field is None) :
+            if (self.others is None) :
+                raise KeyError( tag )
+            return self.others[tag]
+        ret = getattr( self, field )
+        if (ret is None) :
+            raise KeyError( tag )
+        return ret
+
+
+
+    def set( self, tag, knowlet ) :
+        field = self._TAGS.get( tag )
+        if (field is None) :
+            if (self.others is None) :
+                self.others = {}
+            self.others[tag] = knowlet
+        else :
+            setattr( self, field, knowlet )
+
+
+
+    def items( self ) :
+        """
+        Returns a list of the pairs C{(tag, knowlet,)} of the deposited knowlets.
+        """
+        ret = [(tag, getattr( self, field ),) for tag, field in self._TAGS.items() if (getattr( self, field ) is not None)]
+        if (self.others) :
+            ret.extend( self.others.items() )
+        return ret
+
+
+
+class MolRecord( Record ) :
+    """
+    Extra knowlets of a molecule. C{title}, C{total_charge} and C{num_heavy_atoms} are descriptors of the structure (see
+    C{struc.deposit_descriptors}), which can be read without reading the structure back into memory.
+    """
+    __slots__ = ("filename", "smiles", "alias_of", "title", "total_charge", "num_heavy_atoms", "others",)
+    _TAGS     = {"filename"        : "filename",
+                 "SMILES"          : "smiles",
+                 "alias-of"        : "alias_of",
+                 "title"           : "title",
+                 "total_charge"    : "total_charge",
+                 "num_heavy_atoms" : "num_heavy_atoms",
+                 }
+
+
+
+class McsRecord( Record ) :
+    """
+    Extra knowlets of a common substructure. C{matches} is the atom matches (see C{mcs.Mcs.deposit_to_kbase}), and
+    C{trimmed_mcs} is a dict of the trimmed MCS of each parent.
+    """
+    __slots__ = ("parents", "matches", "timed_out", "num_heavy_atoms", "num_light_atoms", "partial_ring", "trimmed_mcs",
+                 "layout_mcs", "smiles", "similarity", "slack_similarity", "others",)
+    _TAGS     = {"mcs-parents"      : "parents",
+                 "mcs-matches"      : "matches",
+                 "mcs-timeout"      : "timed_out",
+                 "num_heavy_atoms"  : "num_heavy_atoms",
+                 "num_light_atoms"  : "num_light_atoms",
+                 "partial_ring"     : "partial_ring",
+                 "trimmed-mcs"      : "trimmed_mcs",
+                 "layout_mcs"       : "layout_mcs",
+                 "SMILES"           : "smiles",
+                 "similarity"       : "similarity",
+                 "slack_similarity" : "slack_similarity",
+                 }
+
+
+
+def _new_record( tag ) :
+    """
+    Returns an empty record for a key whose first extra knowlet has the tag C{tag}. MCSs are deposited with "mcs-parents"
+    first (see C{mcs.Mcs.deposit_to_kbase}).
+    """
+    return McsRecord() if ("mcs-parents" == tag) else MolRecord()
+
+
+
+def _read_struc( key, filename, record ) :
+    """
+    Reads the structure of the key C{key} back from the record C{record} of the structure file C{filename}. Only that record
+    is parsed (see C{struc.read_record}).
+    """
+    import struc
+
+    mol = struc.read_record( filename, record )
+    if (mol is not None) :
+        mol.set_id( key )
+        return mol
+    raise LookupError( "Record %d of '%s' for %s not found. Has the file been changed?" % (record, filename, key,) )
+
+
+
+class MolStore( object ) :
+    """
+    Keeps the recently used structures in memory within a byte budget, and reads the others back from their structure files
+    when they are asked for. The least recently used structures are evicted first.
+
+    The size of a structure is estimated from its number of atoms (C{BYTES_PER_ATOM}, measured with C{struc.PyStruc} and
+    including the atom properties), as the toolkits do not tell the memory taken by their molecules. Structures that are
+    still referenced elsewhere stay in memory after being evicted, so callers should not hold on to them.
+    """
+    BYTES_PER_ATOM = 2048
+
+    def __init__( self, byte_budget ) :
+        """
+        @type  byte_budget: C{int}
+        @param byte_budget: Maximum number of bytes of the structures in memory. The most recently used structure is always
+                            kept, even if it alone is over the budget.
+        """
+        self._budget       = byte_budget
+        self._mols         = collections.OrderedDict()    # Key -> (structure, size,), the most recent last
+        self._num_bytes    = 0
+        self.max_bytes     = 0
+        self.num_hits      = 0
+        self.num_misses    = 0
+        self.num_evictions = 0
+
+
+
+    def put( self, key, mol ) :
+        self.discard( key )
+        size             = self.BYTES_PER_ATOM * len( mol.atom )
+        self._mols[key]  = (mol, size,)
+        self._num_bytes += size
+        while (self._num_bytes > self._budget and len( self._mols ) > 1) :
+            k, (m, size,) = self._mols.popitem( last = False )
+            self._num_bytes    -= size
+            self.num_evictions += 1
+        self.max_bytes = max( self.max_bytes, self._num_bytes )
+
+
+
+    def discard( self, key ) :
+        if (key in self._mols) :
+            self._num_bytes -= self._mols.pop( key )[1]
+
+
+
+    def get( self, key, source ) :
+        """
+        Returns the structure of the key C{key}, reading it back from C{source}, which is a tuple of (structure file name,
+        record index,), if it is not in memory.
+        """
+        try :
+            e = self._mols.pop( key )
+        except KeyError :
+            self.num_misses += 1
+            mol = _read_struc( key, *source )
+            self.put( key, mol )
+            return mol
+        self.num_hits  += 1
+        self._mols[key] = e
+        return e[0]
+
+
+
+    def size( self ) :
+        """
+        Returns the number of structures in memory and the estimate of the bytes they take.
+        """
+        return len( self._mols ), self._num_bytes
+
+
+
+    def report( self ) :
+        logging.info( "Molecule store: %d hits, %d misses (read back from files), %d evictions, at most %.1f MB in memory" \
+                      % (self.num_hits, self.num_misses, self.num_evictions, self.max_bytes / 1048576.0,) )
+
+
+
+# Version of the format of the snapshots written by `write_snapshot'
+_SNAPSHOT_VERSION = 1
+
+
+
+class Kbase( object ) :
+    def __init__( self, mol_budget = None ) :
+        """
+        @type  mol_budget: C{int}
+        @param mol_budget: If given, structures deposited with a source are kept in a C{MolStore} with this byte budget;
+                           otherwise, all structures are kept in memory.
+        """
         self._knowledge = {}
-        self._extra     = {}
+        self._extra     = {}    # Key -> `Record'
+        self._sources   = {}    # Key -> source of a structure (see `deposit')
+        self._store     = MolStore( mol_budget ) if (mol_budget) else None
 
 
 
@@ -20,33 +236,1007 @@ class Kbase( object ) :
                 extra = self._extra[quest]
             except KeyError :
                 raise LookupError( "Ignorance on %s" % quest )
+            # Same as `extra.get', inlined as this is called very often.
             try :
-                return extra[tag]
+                ret = getattr( extra, extra._TAGS[tag] )
             except KeyError :
+                ret = extra.others.get( tag ) if (extra.others) else None
+            if (ret is None) :
                 raise LookupError( "Ignorance on %s with tag %s" % (quest, tag,) )
+            return ret
         try :
             return self._knowledge[quest]
         except KeyError :
+            if (quest in self._sources) :
+                return self._store.get( quest, self._sources[quest] )
             raise LookupError( "Ignorance on %s" % quest )
 
 
 
-    def deposit( self, key, knowlet, should_overwrite = False ) :
+    def _has( self, key ) :
+        return key in self._knowledge or key in self._sources
+
+
+
+    def deposit( self, key, knowlet, should_overwrite = False, source = None ) :
+        """
+        @type  source: C{(str, int,)}
+        @param source: Name of the structure file and index of the record in the file that the structure C{knowlet} was read
+                       from. Knowledge bases with a molecule store or a file use it to read the structure back instead of
+                       keeping it.
+        """
         if (not should_overwrite) :
-            while (key in self._knowledge) :
+            while (self._has( key )) :
                 key = hashlib.sha1( key ).hexdigest()
-        self._knowledge[key] = knowlet
+        self._knowledge.pop( key, None )
+        self._sources  .pop( key, None )
+        if (source) :
+            self._sources[key] = source
+        if (source and self._store is not None) :
+            self._store.put( key, knowlet )
+        else :
+            self._knowledge[key] = knowlet
         return key
 
+
+
+    def source( self, key ) :
+        """
+        Returns the source (name of the structure file and index of the record,) of the structure of C{key}, or C{None} if it
+        was deposited without one.
+        """
+        return self._sources.get( key )
+
     
 
+    def ask_many( self, keys, tag, default = None ) :
+        """
+        Returns a list of the knowlets of the tag C{tag} of the keys C{keys}, in the same order, with C{default} for the keys
+        that do not have the tag.
+        """
+        ret = []
+        for key in keys :
+            record = self._extra.get( key )
+            if (record is None) :
+                ret.append( default )
+                continue
+            field = record._TAGS.get( tag )
+            value = getattr( record, field ) if (field) else (record.others.get( tag ) if (record.others) else None)
+            ret.append( default if (value is None) else value )
+        return ret
+
+
+
+    def deposit_many( self, items, tag ) :
+        """
+        Deposits the knowlets of the pairs C{(key, knowlet,)} in C{items} with the tag C{tag}.
+        """
+        for key, knowlet in items :
+            self.deposit_extra( key, tag, knowlet )
+
+
+
+    def record( self, key ) :
+        """
+        Returns the record (C{MolRecord} or C{McsRecord}) of the extra knowlets of C{key}, whose fields can be read directly.
+        Deposit knowlets with C{deposit_extra} rather than by setting the fields, as records of persistent knowledge bases
+        are copies.
+        """
+        try :
+            return self._extra[key]
+        except KeyError :
+            raise LookupError( "Ignorance on %s" % key )
+
+
+
     def deposit_extra( self, key, tag, knowlet ) :
-        if (key not in self._knowledge) :
-            raise KeyError( "'%s' not found in the knowledge base." )
+        if (not self._has( key )) :
+            raise KeyError( "'%s' not found in the knowledge base." % key )
         if (key not in self._extra) :
-            self._extra[key] = {}
-        self._extra[key][tag] = knowlet
+            self._extra[key] = _new_record( tag )
+        self._extra[key].set( tag, knowlet )
+
+
+
+    def flush( self ) :
+        """
+        Writes pending deposits to the storage, if any.
+        """
+        pass
+
+
+
+    def sizes( self ) :
+        """
+        Returns a dict mapping the tags (C{None} for the knowlets deposited without tags, and "(records)" for the records of
+        the extra knowlets) to the numbers of the knowlets kept in memory and the estimates of the bytes they take (see
+        C{_sizeof}). Knowlets kept in files are not counted.
+        """
+        ret = collections.defaultdict( lambda : [0, 0] )
+        for knowlet in self._knowledge.values() :
+            _add_size( ret, None, knowlet )
+        if (self._store is not None) :
+            n, size    = self._store.size()
+            ret[None][0] += n
+            ret[None][1] += size
+        for record in self._extra.values() :
+            _add_size( ret, "(records)", record )
+            for tag, knowlet in record.items() :
+                _add_size( ret, tag, knowlet )
+        return ret
+
+
+
+    def report( self ) :
+        """
+        Logs the statistics of the molecule store, if any.
+        """
+        if (self._store is not None) :
+            self._store.report()
+
+
+
+class SqliteKbase( Kbase ) :
+    """
+    A knowledge base stored in an SQLite file, so that it outlives the process and can be opened again by other scripts.
+
+    Structures deposited with a source are stored as the name of their structure file and the index of their record in the
+    file, and only that record is read back when asked for (see C{struc.read_record}): a process that opens the file scans
+    each structure file once for the offsets of its records. Only the recently used structures are kept in memory (see
+    C{MolStore}).
+    Knowlets with the "mcs-parents" tag go into a table indexed by the parent IDs, and other knowlets are pickled. Deposits
+    are committed in batches of C{batch_size}; call C{flush} before other processes read the file.
+
+    Worker processes of C{parallel_map} open their own read-only connections and keep their deposits in memory.
+    """
+    _SCHEMA = """
+    CREATE TABLE IF NOT EXISTS knowledge (key TEXT PRIMARY KEY, value BLOB, filename TEXT, record INTEGER);
+    CREATE TABLE IF NOT EXISTS mcs       (key TEXT PRIMARY KEY, id0 TEXT NOT NULL, id1 TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS mcs_parents ON mcs (id0, id1);
+    CREATE TABLE IF NOT EXISTS extra     (key TEXT NOT NULL, tag TEXT NOT NULL, value BLOB, PRIMARY KEY (key, tag));
+    CREATE INDEX IF NOT EXISTS extra_tag ON extra (tag);
+    """
+
+    def __init__( self, filename, should_overwrite = False, batch_size = 10000, mol_budget = 256 * 1048576 ) :
+        """
+        @type          filename: C{str}
+        @param         filename: Name of the SQLite file. It will be created if it does not exist.
+        @type  should_overwrite: C{bool}
+        @param should_overwrite: If true, an existing file is emptied first.
+        @type        batch_size: C{int}
+        @param       batch_size: Number of deposits per transaction
+        @type        mol_budget: C{int}
+        @param       mol_budget: Byte budget of the structures kept in memory
+        """
+        if (should_overwrite and os.path.exists( filename )) :
+            os.remove( filename )
+        self._filename   = filename
+        self._connect()
+        self._db.executescript( self._SCHEMA )
+        self._batch_size = batch_size
+        self._num_dirty  = 0
+        self._sources    = {}                       # Key -> source of a structure, for the structures asked for so far
+        self._store      = MolStore( mol_budget )
+        self._unpickled  = {}                       # Knowlets that cannot be pickled
+
+
+
+    def _connect( self ) :
+        self._db              = sqlite3.connect( self._filename )
+        self._db.text_factory = str
+
+
+
+    def _write( self, sql, args ) :
+        self._db.execute( sql, args )
+        self._num_dirty += 1
+        if (self._num_dirty >= self._batch_size) :
+            self.flush()
+
+
+
+    def ask( self, quest, tag = None ) :
+        if (tag) :
+            if ((quest, tag,) in self._unpickled) :
+                return self._unpickled[(quest, tag,)]
+            if ("mcs-parents" == tag) :
+                row = self._db.execute( "SELECT id0, id1 FROM mcs WHERE key = ?", (quest,) ).fetchone()
+                if (row is not None) :
+                    return tuple( row )
+            else :
+                row = self._db.execute( "SELECT value FROM extra WHERE key = ? AND tag = ?", (quest, tag,) ).fetchone()
+                if (row is not None and row[0] is not None) :
+                    return pickle.loads( str( row[0] ) )
+            raise LookupError( "Ignorance on %s with tag %s" % (quest, tag,) )
+
+        if (quest in self._unpickled) :
+            return self._unpickled[quest]
+        if (quest in self._sources) :
+            return self._store.get( quest, self._sources[quest] )
+        row = self._db.execute( "SELECT value, filename, record FROM knowledge WHERE key = ?", (quest,) ).fetchone()
+        if (row is None) :
+            raise LookupError( "Ignorance on %s" % quest )
+        value, filename, record = row
+        if (filename is None) :
+            if (value is None) :
+                raise LookupError( "Ignorance on %s, which was not stored in the file" % quest )
+            return pickle.loads( str( value ) )
+        self._sources[quest] = (filename, record,)
+        return self._store.get( quest, self._sources[quest] )
+
+
+
+    def source( self, key ) :
+        if (key in self._unpickled) :
+            return None
+        row = self._db.execute( "SELECT filename, record FROM knowledge WHERE key = ?", (key,) ).fetchone()
+        return None if (row is None or row[0] is None) else tuple( row )
+
+
+
+    def record( self, key ) :
+        row = self._db.execute( "SELECT id0, id1 FROM mcs WHERE key = ?", (key,) ).fetchone()
+        ret = MolRecord() if (row is None) else McsRecord()
+        if (row is not None) :
+            ret.parents = tuple( row )
+        for tag, value in self._db.execute( "SELECT tag, value FROM extra WHERE key = ?", (key,) ) :
+            if (value is not None) :
+                ret.set( tag, pickle.loads( str( value ) ) )
+        for e, knowlet in self._unpickled.items() :
+            if (isinstance( e, tuple ) and e[0] == key) :
+                ret.set( e[1], knowlet )
+        if (row is None and not self._has( key )) :
+            raise LookupError( "Ignorance on %s" % key )
+        return ret
+
+
+
+    def _select_many( self, sql, keys, args = () ) :
+        """
+        Runs the query C{sql}, whose last parameter is a list of keys (written as C{(%s)}), on the keys C{keys} in chunks
+        that fit the SQLite limit on the number of parameters, and returns an iterator over the rows. C{args} are the values
+        of the other parameters.
+        """
+        keys = list( keys )
+        for i in range( 0, len( keys ), 900 ) :
+            chunk = keys[i:i + 900]
+            for row in self._db.execute( sql % ", ".join( ["?"] * len( chunk ) ), list( args ) + chunk ) :
+                yield row
+
+
+
+    def ask_many( self, keys, tag, default = None ) :
+        keys  = list( keys )
+        found = {}
+        if ("mcs-parents" == tag) :
+            for key, id0, id1 in self._select_many( "SELECT key, id0, id1 FROM mcs WHERE key IN (%s)", set( keys ) ) :
+                found[key] = (id0, id1,)
+        else :
+            for key, value in self._select_many( "SELECT key, value FROM extra WHERE tag = ? AND key IN (%s)", set( keys ),
+                                                 (tag,) ) :
+                if (value is not None) :
+                    found[key] = pickle.loads( str( value ) )
+        if (self._unpickled) :
+            for key in keys :
+                if ((key, tag,) in self._unpickled) :
+                    found[key] = self._unpickled[(key, tag,)]
+        return [found.get( key, default ) for key in keys]
+
+
+
+    def deposit_many( self, items, tag ) :
+        items   = list( items )
+        missing = set( [key for key, knowlet in items] )
+        for row in self._select_many( "SELECT key FROM knowledge WHERE key IN (%s)", missing ) :
+            missing.discard( row[0] )
+        missing -= set( self._unpickled )
+        if (missing) :
+            raise KeyError( "'%s' not found in the knowledge base." % missing.pop() )
+        rows = []
+        for key, knowlet in items :
+            self._unpickled.pop( (key, tag,), None )
+            if ("mcs-parents" == tag) :
+                rows.append( (key, knowlet[0], knowlet[1],) )
+                continue
+            value = self._pickle( knowlet )
+            if (value is None) :
+                self._unpickled[(key, tag,)] = knowlet
+            rows.append( (key, tag, value,) )
+        if ("mcs-parents" == tag) :
+            self._db.executemany( "INSERT OR REPLACE INTO mcs VALUES (?, ?, ?)", rows )
+        else :
+            self._db.executemany( "INSERT OR REPLACE INTO extra VALUES (?, ?, ?)", rows )
+        self._num_dirty += len( rows )
+        if (self._num_dirty >= self._batch_size) :
+            self.flush()
+
+
+
+    def _has( self, key ) :
+        return key in self._unpickled or \
+               self._db.execute( "SELECT 1 FROM knowledge WHERE key = ?", (key,) ).fetchone() is not None
+
+
+
+    def _pickle( self, knowlet ) :
+        """
+        Returns the pickled C{knowlet} for a BLOB column, or C{None} if it cannot be pickled.
+        """
+        try :
+            return sqlite3.Binary( pickle.dumps( knowlet, pickle.HIGHEST_PROTOCOL ) )
+        except (pickle.PicklingError, TypeError,) :
+            return None
+
+
+
+    def deposit( self, key, knowlet, should_overwrite = False, source = None ) :
+        if (not should_overwrite) :
+            while (self._has( key )) :
+                key = hashlib.sha1( key ).hexdigest()
+        self._sources  .pop( key, None )
+        self._store    .discard( key )
+        self._unpickled.pop( key, None )
+        if (source) :
+            self._write( "INSERT OR REPLACE INTO knowledge VALUES (?, NULL, ?, ?)", (key, source[0], source[1],) )
+            self._sources[key] = source
+            self._store.put( key, knowlet )
+        else :
+            value = self._pickle( knowlet )
+            if (value is None) :
+                self._unpickled[key] = knowlet
+            self._write( "INSERT OR REPLACE INTO knowledge VALUES (?, ?, NULL, NULL)", (key, value,) )
+        return key
+
+
+
+    def deposit_extra( self, key, tag, knowlet ) :
+        if (not self._has( key )) :
+            raise KeyError( "'%s' not found in the knowledge base." % key )
+        self._unpickled.pop( (key, tag,), None )
+        if ("mcs-parents" == tag) :
+            self._write( "INSERT OR REPLACE INTO mcs VALUES (?, ?, ?)", (key, knowlet[0], knowlet[1],) )
+            return
+        value = self._pickle( knowlet )
+        if (value is None) :
+            self._unpickled[(key, tag,)] = knowlet
+        self._write( "INSERT OR REPLACE INTO extra VALUES (?, ?, ?)", (key, tag, value,) )
+
+
+
+    def sizes( self ) :
+        ret       = collections.defaultdict( lambda : [0, 0] )
+        ret[None] = list( self._store.size() )
+        for key, knowlet in self._unpickled.items() :
+            _add_size( ret, key[1] if (isinstance( key, tuple )) else None, knowlet )
+        return ret
+
+
+
+    def flush( self ) :
+        self._db.commit()
+        self._num_dirty = 0
+
+
+
+    def close( self ) :
+        self.flush()
+        self._db.close()
+
+
+
+def _to_column( values ) :
+    """
+    Encodes the knowlets C{values} of a tag (C{None} for the keys without the tag) as numpy arrays. Returns a tuple of the
+    kind of the column and a dict of the arrays by their file suffixes, or C{None} if the knowlets do not fit a column, in
+    which case they are pickled instead (see C{write_snapshot}).
+    """
+    import numpy
+
+    known = [e is not None for e in values]
+    found = [e for e in values if (e is not None)]
+    if (not found) :
+        return None
+    if   (all( [isinstance( e, bool ) for e in found] )) :
+        kind, data = "bool", numpy.array( [bool( e ) for e in values], dtype = bool )
+    elif (all( [isinstance( e, (int, long,) ) and not isinstance( e, bool ) for e in found] )) :
+        kind, data = "int", numpy.array( [e or 0 for e in values], dtype = numpy.int64 )
+    elif (all( [isinstance( e, float ) for e in found] )) :
+        kind, data = "float", numpy.array( [e or 0.0 for e in values], dtype = numpy.float64 )
+    elif (all( [isinstance( e, str ) and not e.endswith( "\0" ) for e in found] )) :
+        kind, data = "str", numpy.array( [e or "" for e in values], dtype = str )
+    elif (all( [isinstance( e, numpy.ndarray ) and e.ndim == 2 and e.dtype.kind == "i" for e in found] ) and
+          len( set( [e.shape[0] for e in found] ) ) == 1) :
+        # Arrays of different lengths, e.g., the atom matches of MCSs, are concatenated.
+        lengths = [0 if (e is None) else e.shape[1] for e in values]
+        offsets = numpy.zeros( len( values ) + 1, dtype = numpy.int64 )
+        numpy.cumsum( lengths, out = offsets[1:] )
+        kind    = "ragged"
+        data    = numpy.concatenate( found, axis = 1 )
+        return kind, {"" : data, ".offsets" : offsets, ".known" : numpy.array( known, dtype = bool ),}
+    elif (all( [isinstance( e, tuple ) and all( [isinstance( x, str ) for x in e] ) for e in found] ) and
+          len( set( [len( e ) for e in found] ) ) == 1) :
+        n          = len( found[0] )
+        kind, data = "tuple", numpy.array( [e or ("",) * n for e in values], dtype = str )
+    elif (all( [isinstance( e, dict ) and all( [isinstance( x, str ) for x in sum( e.items(), () )] ) for e in found] ) and
+          len( set( [len( e ) for e in found] ) ) == 1) :
+        n          = len( found[0] )
+        kind, data = "dict", numpy.array( [sum( sorted( e.items() ), () ) if (e) else ("",) * 2 * n for e in values],
+                                          dtype = str )
+    else :
+        return None
+    if (all( known )) :
+        return kind, {"" : data,}
+    return kind, {"" : data, ".known" : numpy.array( known, dtype = bool ),}
+
+
+
+def write_snapshot( dirname, mol_ids, mcs_ids ) :
+    """
+    Writes a snapshot of the C{KBASE} into the directory C{dirname}, which can be opened again with C{SnapshotKbase}. The
+    snapshot covers the structures C{mol_ids} and the common substructures C{mcs_ids} with all their extra knowlets.
+
+    Each table (structures and MCSs) is a set of numpy files, one per field of the records (see C{MolRecord} and
+    C{McsRecord}), with the rows sorted by the keys. Structures are stored as their sources (see C{Kbase.deposit}) and read
+    back from their files when asked for. Knowlets that do not fit a column are pickled into the index file with the other
+    bookkeeping. The snapshot is written into a new directory, which then replaces C{dirname}, so a snapshot can be written
+    over the one being read.
+
+    @type   dirname: C{str}
+    @param  dirname: Name of the snapshot directory
+    @type   mol_ids: C{list} of C{str}
+    @param  mol_ids: IDs of the structures in C{KBASE}. Their order is kept (see C{SnapshotKbase.keys}).
+    @type   mcs_ids: C{list} of C{str}
+    @param  mcs_ids: IDs of the common substructures in C{KBASE}. Their order is kept.
+    """
+    import numpy
+    import shutil
+
+    tmp_dirname = dirname.rstrip( os.sep ) + ".tmp"
+    if (os.path.exists( tmp_dirname )) :
+        shutil.rmtree( tmp_dirname )
+    os.makedirs( tmp_dirname )
+
+    index = {"version" : _SNAPSHOT_VERSION, "files" : [], "columns" : {}, "others" : {}, "knowledge" : {},}
+    files = {}
+    for table, ids, cls in (("mol", mol_ids, MolRecord,), ("mcs", mcs_ids, McsRecord,),) :
+        ids     = list( collections.OrderedDict.fromkeys( ids ) )
+        keys    = numpy.array( ids, dtype = str )
+        order   = numpy.argsort( keys, kind = "mergesort" )
+        rank    = numpy.empty_like( order )
+        rank[order] = numpy.arange( len( order ) )
+        rows    = [ids[i] for i in order]
+        records = []
+        for key in rows :
+            try :
+                records.append( KBASE.record( key ) )
+            except LookupError :
+                records.append( cls() )
+        columns = {"keys" : (None, {"" : keys[order],},), "order" : (None, {"" : rank,},),}
+
+        tags = dict( [(field, tag,) for tag, field in cls._TAGS.items()] )
+        for field in cls.__slots__ :
+            if ("others" == field) :
+                for key, record in zip( rows, records ) :
+                    if (record.others) :
+                        index["others"].setdefault( key, {} ).update( record.others )
+                continue
+            values = [getattr( e, field, None ) for e in records]
+            column = _to_column( values )
+            if (column is None) :
+                for key, value in zip( rows, values ) :
+                    if (value is not None) :
+                        index["others"].setdefault( key, {} )[tags[field]] = value
+            else :
+                columns[field] = column
+
+        if ("mol" == table) :
+            sources = []
+            for key in rows :
+                source = KBASE.source( key )
+                if (source is None) :
+                    sources.append( (-1, -1,) )
+                else :
+                    if (source[0] not in files) :
+                        files[source[0]] = len( index["files"] )
+                        index["files"].append( source[0] )
+                    sources.append( (files[source[0]], source[1],) )
+            columns["source"] = (None, {"" : numpy.array( sources, dtype = numpy.int64 ).reshape( -1, 2 ),},)
+        else :
+            values = [KBASE.ask( key ) for key in rows]
+            column = _to_column( values )
+            if (column is None) :
+                index["knowledge"].update( zip( rows, values ) )
+            else :
+                columns["knowlet"] = column
+
+        index["columns"][table] = {}
+        for field, (kind, arrays,) in columns.items() :
+            index["columns"][table][field] = (kind, sorted( arrays ),)
+            for suffix, array in arrays.items() :
+                numpy.save( os.path.join( tmp_dirname, "%s.%s%s.npy" % (table, field, suffix,) ), array )
+
+    # The index is written last, so an incomplete snapshot cannot be opened.
+    with open( os.path.join( tmp_dirname, "index.pkl" ), "wb" ) as fh :
+        pickle.dump( index, fh, pickle.HIGHEST_PROTOCOL )
+
+    # The files of a replaced snapshot that is being read stay available to the readers until they are closed.
+    old_dirname = dirname.rstrip( os.sep ) + ".old"
+    if (os.path.exists( dirname )) :
+        if (os.path.exists( old_dirname )) :
+            shutil.rmtree( old_dirname )
+        os.rename( dirname, old_dirname )
+    os.rename( tmp_dirname, dirname )
+    if (os.path.exists( old_dirname )) :
+        shutil.rmtree( old_dirname )
+
+
+
+class SnapshotKbase( Kbase ) :
+    """
+    A knowledge base opened from a snapshot written by C{write_snapshot}. The columns of the snapshot are memory-mapped, so
+    opening it takes about as long as opening its files, whatever its size, and the knowlets are read from the files as they
+    are asked for. Keys are found by binary search in the sorted key columns.
+
+    New deposits are kept in memory, where they are looked up before the snapshot; the snapshot itself is not changed.
+    """
+    def __init__( self, dirname, mol_budget = 256 * 1048576 ) :
+        """
+        @type     dirname: C{str}
+        @param    dirname: Name of the snapshot directory
+        @type  mol_budget: C{int}
+        @param mol_budget: Byte budget of the structures kept in memory (see C{MolStore})
+        """
+        import numpy
+
+        Kbase.__init__( self, mol_budget )
+        try :
+            with open( os.path.join( dirname, "index.pkl" ), "rb" ) as fh :
+                index = pickle.load( fh )
+        except IOError :
+            raise IOError( "'%s' is not a knowledge base snapshot, or it was not completely written." % dirname )
+        if (index["version"] != _SNAPSHOT_VERSION) :
+            raise ValueError( "Snapshot '%s' was written by another version of the program." % dirname )
+        self._files        = index["files"]
+        self._others       = index["others"]        # Key -> {tag -> knowlet} of the knowlets that do not fit the columns
+        self._pickled      = index["knowledge"]
+        self._columns      = {}                     # Table -> field -> (kind, data, offsets, known,)
+        for table, fields in index["columns"].items() :
+            self._columns[table] = {}
+            for field, (kind, suffixes,) in fields.items() :
+                arrays = dict( [(e, numpy.load( os.path.join( dirname, "%s.%s%s.npy" % (table, field, e,) ),
+                                                mmap_mode = "r" ),) for e in suffixes] )
+                self._columns[table][field] = (kind, arrays[""], arrays.get( ".offsets" ), arrays.get( ".known" ),)
+
+
+
+    def keys( self, table ) :
+        """
+        Returns the IDs of the structures (C{table} is "mol") or the common substructures ("mcs") in the snapshot, in the
+        order given to C{write_snapshot}.
+        """
+        keys  = self._columns[table]["keys" ][1]
+        order = self._columns[table]["order"][1]
+        return [str( e ) for e in keys[order]]
+
+
+
+    def _find( self, key ) :
+        """
+        Returns the table and the row of C{key} in the snapshot, or C{(None, None,)} if it is not there.
+        """
+        for table in ("mol", "mcs",) :
+            keys = self._columns[table]["keys"][1]
+            i    = keys.searchsorted( key )
+            if (i < len( keys ) and keys[i] == key) :
+                return table, int( i )
+        return None, None
+
+
+
+    def _find_many( self, keys ) :
+        """
+        Same as C{_find} on each of C{keys}, with one binary search per table for all of them.
+        """
+        import numpy
+
+        ret = [(None, None,)] * len( keys )
+        if (not keys) :
+            return ret
+        quests = numpy.array( keys, dtype = str )
+        for table in ("mol", "mcs",) :
+            column = self._columns[table]["keys"][1]
+            if (not len( column )) :
+                continue
+            rows = numpy.minimum( column.searchsorted( quests ), len( column ) - 1 )
+            for k in numpy.flatnonzero( column[rows] == quests ) :
+                if (ret[k][0] is None) :
+                    ret[k] = (table, int( rows[k] ),)
+        return ret
+
+
+
+    def _value( self, table, field, i ) :
+        """
+        Returns the knowlet in the row C{i} of the column C{field} of the table C{table}, or C{None} if there is none.
+        """
+        try :
+            kind, data, offsets, known = self._columns[table][field]
+        except KeyError :
+            return None
+        if (known is not None and not known[i]) :
+            return None
+        if   ("str"    == kind) :
+            return str( data[i] )
+        elif ("float"  == kind) :
+            return float( data[i] )
+        elif ("int"    == kind) :
+            return int( data[i] )
+        elif ("bool"   == kind) :
+            return bool( data[i] )
+        elif ("ragged" == kind) :
+            import numpy
+            # A view of the memory-mapped file, not a copy.
+            return numpy.asarray( data[:, offsets[i]:offsets[i + 1]] )
+        elif ("tuple"  == kind) :
+            return tuple( [str( e ) for e in data[i]] )
+        elif ("dict"   == kind) :
+            row = [str( e ) for e in data[i]]
+            return dict( zip( row[0::2], row[1::2] ) )
+        raise ValueError( "Unknown kind of column: %s" % kind )
+
+
+
+    def _lookup( self, key, tag, table, i ) :
+        if (table is None) :
+            return None
+        cls   = McsRecord if ("mcs" == table) else MolRecord
+        field = cls._TAGS.get( tag )
+        ret   = self._value( table, field, i ) if (field) else None
+        if (ret is None and key in self._others) :
+            ret = self._others[key].get( tag )
+        return ret
+
+
+
+    def ask( self, quest, tag = None ) :
+        try :
+            return Kbase.ask( self, quest, tag )
+        except LookupError :
+            pass
+        table, i = self._find( quest )
+        if (tag) :
+            ret = self._lookup( quest, tag, table, i )
+            if (ret is None) :
+                raise LookupError( "Ignorance on %s with tag %s" % (quest, tag,) )
+            return ret
+        if ("mol" == table) :
+            source = self.source( quest )
+            if (source is None) :
+                raise LookupError( "Ignorance on %s, which was not stored in the snapshot" % quest )
+            self._sources[quest] = source
+            return self._store.get( quest, source )
+        if ("mcs" == table and "knowlet" in self._columns["mcs"]) :
+            return self._value( table, "knowlet", i )
+        if (quest in self._pickled) :
+            return self._pickled[quest]
+        raise LookupError( "Ignorance on %s" % quest )
+
+
+
+    def ask_many( self, keys, tag, default = None ) :
+        keys = list( keys )
+        ret  = Kbase.ask_many( self, keys, tag )
+        todo = [k for k, e in enumerate( ret ) if (e is None)]
+        for k, (table, i,) in zip( todo, self._find_many( [keys[k] for k in todo] ) ) :
+            value  = self._lookup( keys[k], tag, table, i )
+            ret[k] = default if (value is None) else value
+        return ret
+
+
+
+    def _has( self, key ) :
+        return Kbase._has( self, key ) or key in self._pickled or self._find( key )[0] is not None
+
+
+
+    def source( self, key ) :
+        if (key in self._sources or Kbase._has( self, key )) :
+            return self._sources.get( key )
+        table, i = self._find( key )
+        if ("mol" != table) :
+            return None
+        k, record = self._columns["mol"]["source"][1][i]
+        return None if (k < 0) else (self._files[k], int( record ),)
+
+
+
+    def record( self, key ) :
+        table, i = self._find( key )
+        if (table is None) :
+            return Kbase.record( self, key )
+        cls = McsRecord if ("mcs" == table) else MolRecord
+        ret = cls()
+        for field in cls._TAGS.values() :
+            setattr( ret, field, self._value( table, field, i ) )
+        for tag, knowlet in self._others.get( key, {} ).items() :
+            ret.set( tag, knowlet )
+        if (key in self._extra) :
+            for tag, knowlet in self._extra[key].items() :
+                ret.set( tag, knowlet )
+        return ret
+
+
+
+    def deposit_extra( self, key, tag, knowlet ) :
+        if (key not in self._extra and "mcs" == self._find( key )[0]) :
+            self._extra[key] = McsRecord()
+        Kbase.deposit_extra( self, key, tag, knowlet )
+
+
+
+class _Journaled( object ) :
+    """
+    Mixin for the knowledge base of a worker process of C{parallel_map}: deposits are applied locally as usual and also
+    recorded into C{_journal}, which is sent back to the parent process.
+    """
+    def deposit( self, key, knowlet, should_overwrite = False, source = None ) :
+        key = super( _Journaled, self ).deposit( key, knowlet, should_overwrite, source )
+        # Replayed under the key chosen here.
+        self._journal.append( ("deposit", (key, knowlet, True, source,),) )
+        return key
+
+
+
+    def deposit_extra( self, key, tag, knowlet ) :
+        super( _Journaled, self ).deposit_extra( key, tag, knowlet )
+        self._journal.append( ("deposit_extra", (key, tag, knowlet,),) )
+
+
+
+    def deposit_many( self, items, tag ) :
+        for key, knowlet in items :
+            self.deposit_extra( key, tag, knowlet )
+
+
+
+class _SqliteOverlay( object ) :
+    """
+    Mixin for an C{SqliteKbase} in a worker process of C{parallel_map}: deposits are kept in memory, where they are looked up
+    before the file, rather than written to the file, which belongs to the parent process.
+    """
+    def deposit( self, key, knowlet, should_overwrite = False, source = None ) :
+        if (not should_overwrite) :
+            while (self._has( key )) :
+                key = hashlib.sha1( key ).hexdigest()
+        self._sources.pop( key, None )
+        self._store  .discard( key )
+        self._unpickled[key] = knowlet
+        return key
+
+
+
+    def deposit_extra( self, key, tag, knowlet ) :
+        if (not self._has( key )) :
+            raise KeyError( "'%s' not found in the knowledge base." % key )
+        self._unpickled[(key, tag,)] = knowlet
+
+
+
+    def flush( self ) :
+        pass
+
+
+
+def _sizeof( obj ) :
+    """
+    Estimates the bytes of memory taken by C{obj}, including the objects it holds. Structures are estimated by their numbers
+    of atoms (see C{MolStore}). Objects held more than once, e.g., the IDs in the "mcs-parents" knowlets, are counted each
+    time.
+    """
+    if (hasattr( obj, "nbytes" )) :
+        return max( sys.getsizeof( obj ), obj.nbytes )
+    if (isinstance( obj, (str, unicode, int, long, float, bool,) ) or obj is None) :
+        return sys.getsizeof( obj )
+    if (isinstance( obj, (tuple, list, set, frozenset,) )) :
+        return sys.getsizeof( obj ) + sum( [_sizeof( e ) for e in obj] )
+    if (isinstance( obj, dict )) :
+        return sys.getsizeof( obj ) + sum( [_sizeof( k ) + _sizeof( v ) for k, v in obj.items()] )
+    if (isinstance( obj, Record )) :
+        return sys.getsizeof( obj ) + (_sizeof( obj.others ) if (obj.others) else 0)
+    if (hasattr( obj, "atom" )) :
+        return MolStore.BYTES_PER_ATOM * len( obj.atom )
+    return sys.getsizeof( obj )
+
+
+
+def _add_size( sizes, tag, knowlet ) :
+    e     = sizes[tag]
+    e[0] += 1
+    e[1] += _sizeof( knowlet )
+
+
+
+class _Instrumented( object ) :
+    """
+    Mixin for a knowledge base that counts its asks (hits and misses, with the time taken) and deposits per tag, see
+    C{instrument}. Asks of C{ask_many} are counted per key. The accesses in the worker processes of C{parallel_map} are not
+    counted, but the deposits replayed from them are.
+    """
+    # Placeholder for the knowlets not found by `ask_many'
+    _MISSING = object()
+
+    def ask( self, quest, tag = None ) :
+        stats      = self._stats[tag]
+        start_time = time.time()
+        try :
+            ret = super( _Instrumented, self ).ask( quest, tag )
+        except LookupError :
+            stats[1] += 1
+            stats[3] += time.time() - start_time
+            raise
+        stats[0] += 1
+        stats[3] += time.time() - start_time
+        return ret
+
+
+
+    def ask_many( self, keys, tag, default = None ) :
+        stats      = self._stats[tag]
+        start_time = time.time()
+        ret        = super( _Instrumented, self ).ask_many( keys, tag, self._MISSING )
+        stats[3]  += time.time() - start_time
+        for i, e in enumerate( ret ) :
+            if (e is self._MISSING) :
+                stats[1] += 1
+                ret[i]    = default
+            else :
+                stats[0] += 1
+        return ret
+
+
+
+    def deposit( self, key, knowlet, should_overwrite = False, source = None ) :
+        self._stats[None][2] += 1
+        return super( _Instrumented, self ).deposit( key, knowlet, should_overwrite, source )
+
+
+
+    def deposit_extra( self, key, tag, knowlet ) :
+        # Deposits of `deposit_many' are counted there, as some knowledge bases implement it with `deposit_extra'.
+        if (not self._in_bulk) :
+            self._stats[tag][2] += 1
+        super( _Instrumented, self ).deposit_extra( key, tag, knowlet )
+
+
+
+    def deposit_many( self, items, tag ) :
+        items                = list( items )
+        self._stats[tag][2] += len( items )
+        self._in_bulk        = True
+        try :
+            super( _Instrumented, self ).deposit_many( items, tag )
+        finally :
+            self._in_bulk = False
+
+
+
+    def report_stats( self ) :
+        """
+        Logs the numbers of asks and deposits per tag, and the knowlets kept in memory per tag (see C{Kbase.sizes}), with the
+        most asked tags first.
+        """
+        sizes = self.sizes()
+        tags  = set( self._stats ) | set( sizes )
+        tags  = sorted( tags, key = lambda e : (-sum( self._stats[e][:2] ) if (e in self._stats) else 0, str( e ),) )
+        logging.info( "Knowledge base accesses and memory per tag:" )
+        logging.info( "  %-20s %10s %10s %10s %9s %10s %10s %10s" % ("tag", "asks", "hits", "misses", "seconds", "deposits",
+                                                                   "kept", "MB",) )
+        for tag in tags :
+            hits, misses, deposits, seconds = self._stats[tag] if (tag in self._stats) else (0, 0, 0, 0.0,)
+            num_kept, size                  = sizes.get( tag, (0, 0,) )
+            logging.info( "  %-20s %10d %10d %10d %9.2f %10d %10d %10.2f" % ("(knowledge)" if (tag is None) else tag,
+                                                                           hits + misses, hits, misses, seconds, deposits,
+                                                                           num_kept, size / 1048576.0,) )
+
+
+
+# Function called by the worker processes of `parallel_map'. It is set only while a pool is alive.
+_pool_func = None
+
+
+
+def _init_worker() :
+    """
+    Turns the C{KBASE} of a worker process of C{parallel_map} into a journaled one.
+    """
+    cls = KBASE.__class__
+    if (isinstance( KBASE, SqliteKbase )) :
+        KBASE.__class__ = type( "Worker" + cls.__name__, (_Journaled, _SqliteOverlay, cls,), {} )
+        KBASE._connect()
+    else :
+        KBASE.__class__ = type( "Worker" + cls.__name__, (_Journaled, cls,), {} )
+    KBASE._journal = []
+
+
+
+def _map_chunk( items ) :
+    """
+    Worker function of C{parallel_map}. Returns the results of the given chunk of items and the deposits made for them.
+    """
+    KBASE._journal = []
+    return [_pool_func( e ) for e in items], KBASE._journal
+
+
+
+def parallel_map( func, items, num_jobs = 1 ) :
+    """
+    Calls C{func} on each of C{items} and returns a list of the results in the same order.
+
+    If C{num_jobs} is greater than 1, the items are split into chunks that are spread over a pool of C{num_jobs} worker
+    processes forked from the current process. The workers see a copy-on-write snapshot of the C{KBASE} (and everything else)
+    as of this call, without pickling. Their deposits are recorded and sent back with the results of each chunk, and are
+    applied to the C{KBASE} in the order of C{items}. So the C{KBASE} ends up the same as after the serial loop, provided
+    that C{func} only depends on the snapshot and on its own deposits, not on those for other items. The items, results and
+    deposited knowlets must be picklable.
+
+    @type      func: A callable
+    @param     func: Called with one item at a time
+    @type     items: C{list}
+    @param    items: The items
+    @type  num_jobs: C{int}
+    @param num_jobs: Number of worker processes
+    """
+    global _pool_func
+
+    if (num_jobs <= 1 or len( items ) < 2) :
+        return [func( e ) for e in items]
+
+    # Lets the workers of a persistent knowledge base read everything deposited so far.
+    KBASE.flush()
+    chunk_size = max( 1, len( items ) // (num_jobs * 8) )
+    chunks     = [items[i:i + chunk_size] for i in range( 0, len( items ), chunk_size )]
+    _pool_func = func
+    pool       = multiprocessing.Pool( num_jobs, _init_worker )
+    ret        = []
+    try :
+        for results, journal in pool.imap( _map_chunk, chunks ) :
+            for method, args in journal :
+                getattr( KBASE, method )( *args )
+            ret.extend( results )
+        pool.close()
+    except :
+        pool.terminate()
+        raise
+    finally :
+        pool.join()
+        _pool_func = None
+    return ret
+
+
+
+def install( kbase ) :
+    """
+    Makes the global C{KBASE}, which all modules have imported, behave as C{kbase} from now on. Call this before anything is
+    deposited.
+    """
+    KBASE.__class__ = kbase.__class__
+    KBASE.__dict__  = kbase.__dict__
+
+
+
+def instrument() :
+    """
+    Makes the C{KBASE} count its asks and deposits per tag (see C{_Instrumented}), and log them with its memory use per tag
+    at exit. Call this after C{install}.
+    """
+    cls = KBASE.__class__
+    if (issubclass( cls, _Instrumented )) :
+        return
+    KBASE.__class__ = type( "Instrumented" + cls.__name__, (_Instrumented, cls,), {} )
+    KBASE._stats    = collections.defaultdict( lambda : [0, 0, 0, 0.0] )     # Tag -> [hits, misses, deposits, seconds,]
+    KBASE._in_bulk  = False
+    atexit.register( KBASE.report_stats )
+
 
-        
 
 KBASE = Kbase()
@@ -3,6 +3,7 @@
 
 from kbase import KBASE
 
+import kbase
 import struc
 import mcs
 import rule
@@ -36,34 +37,109 @@ logging.basicConfig( format  = '%(asctime)s: %(message)s',
 
 
 
-def main( molid_list, opt, args ) :
+def load_map( fname ) :
+    """
+    Loads a graph saved by C{main}, and reads the structures of its nodes back into the C{KBASE} under the same IDs from the
+    structure files recorded in the graph. Returns the graph and a list of IDs of its structures.
+
+    @type  fname: C{str}
+    @param fname: Name of the pickle file of the graph
+    """
+    g         = pickle.load( open( fname ) )
+    old_ids   = g.nodes()
+    filenames = {}
+    for id in old_ids :
+        try :
+            filenames.setdefault( g.node[id]["filename"], [] ).append( id )
+        except KeyError :
+            raise ValueError( "Structure file of '%s' is not recorded in '%s'. The map needs to be regenerated to allow adding "
+                              "new structures." % (g.node[id].get( "title", id ), fname,) )
+    for filename, ids in filenames.items() :
+        strucs = list( struc.read_file( filename ) )
+        titles = {}
+        for record, e in enumerate( strucs ) :
+            titles.setdefault( e.title(), record )
+        used = set()
+        for id in ids :
+            # Maps saved before the record indices were recorded are matched by the titles of the structures.
+            record = g.node[id].get( "record", titles.get( g.node[id]["title"] ) )
+            if (record is None or record >= len( strucs )) :
+                raise ValueError( "Structure '%s' is not found in '%s'." % (g.node[id]["title"], filename,) )
+            e = strucs[record].copy() if (record in used) else strucs[record]
+            used.add( record )
+            struc.deposit_struc( e, (filename, record,), id )
+    return g, old_ids
+
+
+
+def main( molid_list, opt, args, base_map = None ) :
     """
     @type  molid_list: C{list} of C{str}'s
     @param molid_list: A list of molecule IDs in the C{KBASE}
+    @type    base_map: C{(networkx.Graph, list of str,)}
+    @param   base_map: An existing graph and the IDs of its structures (as returned by C{load_map}). If given, the structures
+                       in C{molid_list} will be added to this graph.
     """
     #load mols files 
     if (opt.graph) :
         g = pickle.load( open( opt.graph ) )
     else :
         mols = []
-        for id in molid_list[opt.receptor:] :
-            mols.append( KBASE.ask( id ) )
+        if (not opt.from_snapshot or opt.build) :
+            for id in molid_list[opt.receptor:] :
+                mols.append( KBASE.ask( id ) )
     #choose mcs search engine and rules 
         if   (struc.infrastructure == "schrodinger") : 
-            mcs_engine = mcs.SchrodMcs( 1 )
+            mcs_engine = mcs.SchrodMcs( 1, pair_timeout = opt.pair_timeout )
             basic_rule = rule.Mcs( rule.EqualCharge(), rule.TrimMcs( True,  rule.MinimumNumberOfAtom() ) )
             slack_rule = rule.Mcs( rule.EqualCharge(), rule.TrimMcs( False, rule.MinimumNumberOfAtom() ) )
         elif (struc.infrastructure == "oechem"     ) : 
-            mcs_engine = mcs.OeMcs()
+            mcs_engine = mcs.OeMcs( pair_timeout = opt.pair_timeout, first_match = opt.first_match )
+            basic_rule = rule.Mcs( rule.EqualCharge(), rule.TrimMcs_oe( True, rule.MinimumNumberOfAtom() ) )
+            slack_rule = rule.Mcs( rule.EqualCharge(), rule.TrimMcs_oe( False, rule.MinimumNumberOfAtom() ) )
+        elif (struc.infrastructure == "python"     ) :
+            mcs_engine = mcs.PyMcs( pair_timeout = opt.pair_timeout )
             basic_rule = rule.Mcs( rule.EqualCharge(), rule.TrimMcs_oe( True, rule.MinimumNumberOfAtom() ) )
             slack_rule = rule.Mcs( rule.EqualCharge(), rule.TrimMcs_oe( False, rule.MinimumNumberOfAtom() ) )
 
-        logging.info( "MCS searching..." )
-        mcs_ids = mcs_engine.search_all( mols, opt )
-        logging.info( "MCS searching... Done" )
-        
+        nbunch = None
+        if (opt.from_snapshot) :
+            # The MCS searching results are in the snapshot.
+            mcs_ids = KBASE.keys( "mcs" )
+            logging.info( "%d MCSs read from the snapshot." % len( mcs_ids ) )
+        else :
+            logging.info( "MCS searching..." )
+            if (base_map) :
+                # Searches only the pairs that involve at least one new structure.
+                g, old_ids = base_map
+                all_mols   = [KBASE.ask( id ) for id in old_ids] + mols
+                n          = len( old_ids )
+                num_mol    = len( all_mols )
+                pairs      = [(i, j,) for i in range( num_mol ) for j in range( max( i + 1, n ), num_mol )]
+                nbunch     = [e.id() for e in mols]
+                logging.info( "  %d pairs between the %d new and all %d structures (%d pairs among the existing ones are not "
+                              "searched)." % (len( pairs ), len( mols ), num_mol, n * (n - 1) // 2,) )
+                mcs_ids    = mcs_engine.search_pairs( all_mols, pairs, opt )
+            else :
+                mcs_ids = mcs_engine.search_all( mols, opt )
+            logging.info( "MCS searching... Done" )
+        if (not opt.build) :
+            # Drops the references to the structures, so that the molecule store can evict them.
+            mols = all_mols = None
+        if (mcs_engine.timed_out) :
+            logging.warn( "MCS searching ran out of time (or search steps) for %d pairs of structures:"
+                          % len( mcs_engine.timed_out ) )
+            for id0, id1 in mcs_engine.timed_out :
+                logging.warn( "  %s - %s" % (KBASE.ask( id0, "title" ), KBASE.ask( id1, "title" ),) )
+
+        # Updates the existing graph locally with the new structures.
+        if (base_map) :
+            logging.info( "Updating graph..." )
+            graph.add_nodes( g, nbunch, mcs_ids, basic_rule, slack_rule, simi_cutoff = 0.05, num_jobs = opt.jobs )
+            c = [list( e ) for e in networkx.connected_components( g )]
+
         #build score matrix from mcs search enable Jonathan's graph planning algorithm
-        if (opt.build):
+        elif (opt.build):
             import build
             (title_list, id_list, filename_vs_title, strict_score) = build.matrix(mols, mcs_ids, basic_rule)
             (title_list, id_list, filename_vs_title, unstrict_score) = build.matrix(mols, mcs_ids, slack_rule)
@@ -86,19 +162,21 @@ def main( molid_list, opt, args ) :
         # Gets graph (`g') and clusters (`c') using schrodinger's graph planning algorithm
         else:
             logging.info( "Creating graph..." )
-            g, c = graph.gen_graph( mcs_ids, basic_rule, slack_rule, simi_cutoff = 0.05, max_csize = 100, num_c2c = 1 )
-        graph.annotate_nodes_with_smiles ( g )
-        graph.annotate_nodes_with_title  ( g )
-        graph.annotate_edges_with_smiles ( g )
-        graph.annotate_edges_with_hexcode( g )
-        graph.annotate_edges_with_matches( g )
+            g, c = graph.gen_graph( mcs_ids, basic_rule, slack_rule, simi_cutoff = 0.05, max_csize = 100, num_c2c = 1,
+                                    num_jobs = opt.jobs )
+        graph.annotate_nodes_with_smiles  ( g, nbunch )
+        graph.annotate_nodes_with_title   ( g, nbunch )
+        graph.annotate_edges_with_smiles  ( g, nbunch )
+        graph.annotate_edges_with_hexcode ( g, nbunch )
+        graph.annotate_edges_with_matches ( g, nbunch )
+        graph.annotate_nodes_with_filename( g, nbunch )
         logging.info( "Creating graph... Done" )
     
         logging.debug( "DEBUG: %d clusters (counted as the connected components in the graph):" % len( c ) )
         c.sort( lambda x, y : len( x ) - len( y ) )
         for i, e in enumerate( c ) :
             logging.debug( "DEBUG: cluster #%d, %d structures:" % (i, len( e ),) )
-            titles = [KBASE.ask( id ).title() for id in e]
+            titles = KBASE.ask_many( e, "title" )
             titles.sort()
             for t in titles :
                 logging.debug( "DEBUG:  %s" % t )
@@ -107,6 +185,10 @@ def main( molid_list, opt, args ) :
         pkl_fh    = open( pkl_fname, "w" )
         pickle.dump( g, pkl_fh )
         pkl_fh.close()
+
+        if (opt.snapshot) :
+            logging.info( "Writing the snapshot of the knowledge base into '%s'..." % opt.snapshot )
+            kbase.write_snapshot( opt.snapshot, molid_list, mcs_ids )
     
         try :
             #use pygraphviz for graph layout
@@ -191,6 +273,40 @@ def startup() :
     parser.add_option( "-m", "--mcs", metavar = "FILE",
                        help = "read MCS searching results directly from FILE and avoid searching again. " \
                               "FILE should be a Schrodinger canvasMCS output file in the CSV format." )
+    parser.add_option( "-c", "--cache", metavar = "FILE",
+                       help = "cache MCS searching results in FILE and reuse the cached results of previous runs. " \
+                              "Only pairs of structures not found in the cache will be searched." )
+    parser.add_option( "--checkpoint", metavar = "FILE",
+                       help = "append MCS searching results to the checkpoint file FILE as the searching goes, so that an "
+                       "interrupted run can be resumed with --resume." )
+    parser.add_option( "--checkpoint-every", default = 1000, metavar = "N", type = "int", dest = "checkpoint_every",
+                       help = "write the checkpoint every N pairs of structures. Default is 1000." )
+    parser.add_option( "--resume", default = False, action = "store_true",
+                       help = "resume the MCS searching from the checkpoint file given by --checkpoint. Only pairs of "
+                       "structures not found in the checkpoint will be searched. The same structures must be given." )
+    parser.add_option( "--kbase", metavar = "FILE",
+                       help = "keep the knowledge base (structures, MCSs and scores) in the SQLite file FILE instead of in "
+                       "memory, so that it can be reused by other scripts. An existing FILE is overwritten." )
+    parser.add_option( "--snapshot", metavar = "DIR",
+                       help = "write a snapshot of the knowledge base (structure descriptors, MCSs and similarity scores) "
+                       "into the directory DIR, so that follow-up runs can start from it with --from-snapshot." )
+    parser.add_option( "--from-snapshot", metavar = "DIR", dest = "from_snapshot",
+                       help = "start from the snapshot in the directory DIR instead of reading structure files and "
+                       "searching MCSs. The structures are read back from their files only when needed." )
+    parser.add_option( "--mol-budget", metavar = "MB", type = "float", dest = "mol_budget",
+                       help = "keep at most about MB megabytes of structures in memory after the MCS searching, and read "
+                       "the others back from their files when needed. Default is no limit, or 256 with --kbase or "
+                       "--from-snapshot." )
+    parser.add_option( "-p", "--prune", default = 0.0, metavar = "CUTOFF", type = "float",
+                       help = "skip the MCS searching for pairs of structures whose similarity scores cannot reach CUTOFF "
+                       "because of the difference in their numbers of heavy atoms. Such pairs will not be available as "
+                       "edges between clusters either. 0.05 is the cutoff of the graph." )
+    parser.add_option( "--pair-timeout", default = 0.0, metavar = "SECONDS", type = "float", dest = "pair_timeout",
+                       help = "time budget of the MCS searching per pair of structures. Pairs running out of the budget "
+                       "fall back to a faster search or are left unconnected, and are listed at the end. 0 means no limit." )
+    parser.add_option( "--first-match", default = False, action = "store_true", dest = "first_match",
+                       help = "take the first maximal common substructure found for each pair of structures instead of "
+                       "enumerating all of them. Faster on symmetric structures. Only used with OpenEye." )
     parser.add_option( "-o", "--output", metavar = "BASENAME", default = "simimap",
                        help = "output files' base name. The following files will be written: <basename>.dot, and "
                        "<basename>.pkl." )
@@ -198,26 +314,77 @@ def startup() :
                        help = "simulation input files' base name. When this option is specified, a number of input files "
                        "for FEP simulations will be written out." )
     parser.add_option( "-g", "--graph", metavar = "FILENAME", help = "use the graph as saved in file FILENAME." )
+    parser.add_option( "-a", "--add", metavar = "FILENAME",
+                       help = "add the given structures to the map as saved in file FILENAME. Only the new structures "
+                       "are searched against the others, and the existing map is updated rather than rebuilt." )
     parser.add_option( "-b", "--build",default = False, action = "store_true" , help = "build score matrix before doing graph planning")
     parser.add_option( "-t", "--siminp_type", metavar = "TYPE", default = "mae",
                        help = "simulation input file type [mae | gro]" )
     parser.add_option( "-r", "--receptor", default = 0, metavar = "N", type = "int",
                        help = "specify the initial N structures as the common receptor. This option is needed when "
                        "you want to write out structure input files for relative binding free energy calculations." )
+    parser.add_option( "-j", "--jobs", default = 1, metavar = "N", type = "int",
+                       help = "run the MCS searching and the similarity scoring in N parallel processes." )
+    parser.add_option( "--queue", metavar = "DIR",
+                       help = "run the MCS searching through the file queue in the shared directory DIR. The number of "
+                       "workers started on this machine is given by -j (can be 0); more workers can be started on other "
+                       "machines that mount DIR with 'python filequeue.py --wait DIR'." )
+    parser.add_option( "--queue-unit", default = 100, metavar = "N", type = "int", dest = "queue_unit",
+                       help = "number of pairs of structures per work unit of the file queue. Default is 100." )
+    parser.add_option( "--queue-timeout", default = 0.0, metavar = "SECONDS", type = "float", dest = "queue_timeout",
+                       help = "queue work units again if their workers have not finished them in SECONDS, e.g., because "
+                       "the workers were preempted. 0 means never; the outstanding work units are then logged every "
+                       "5 minutes without results." )
+    parser.add_option( "--kbase-stats", default = False, action = "store_true", dest = "kbase_stats",
+                       help = "count the accesses to the knowledge base per tag and report them with its memory use per "
+                       "tag at exit. Also turned on by --debug." )
     parser.add_option( "--save",  default = False, action = "store_true", help = "do not delete temporary files." )
     parser.add_option( "--debug", default = False, action = "store_true", help = "turn on debugging mode." )
     
     (opt, args) = parser.parse_args()
 
-    if (len( args ) == 0) :
+    if (len( args ) == 0 and not opt.from_snapshot) :
         parser.print_help()
         sys.exit( 0 )
 
+    if (opt.from_snapshot and (args or opt.add or opt.graph or opt.kbase)) :
+        parser.error( "option --from-snapshot cannot be used together with structure files, -a, -g or --kbase." )
+
+    if (opt.snapshot and (opt.add or opt.graph)) :
+        parser.error( "option --snapshot cannot be used together with -a or -g." )
+
+    if (opt.add and (opt.build or opt.graph)) :
+        parser.error( "option -a cannot be used together with -b or -g." )
+
+    if (opt.queue and struc.infrastructure == "schrodinger") :
+        parser.error( "option --queue cannot be used with Schrodinger's canvasMCS, which searches all pairs of its input "
+                      "molecules at once." )
+
+    if (opt.resume and not opt.checkpoint) :
+        parser.error( "option --resume requires --checkpoint." )
+
     if (opt.debug) :
         logger.setLevel( logging.DEBUG )
         logging.debug( "Debugging mode is on." )
-        
-    molid_list = []
+
+    kwarg = {"mol_budget" : int( opt.mol_budget * 1048576 ),} if (opt.mol_budget) else {}
+    if (opt.kbase) :
+        kbase.install( kbase.SqliteKbase( opt.kbase, should_overwrite = True, **kwarg ) )
+    elif (opt.from_snapshot) :
+        logging.info( "Opening the snapshot in '%s'..." % opt.from_snapshot )
+        kbase.install( kbase.SnapshotKbase( opt.from_snapshot, **kwarg ) )
+    elif (kwarg) :
+        kbase.install( kbase.Kbase( **kwarg ) )
+    if (opt.kbase_stats or opt.debug) :
+        kbase.instrument()
+
+    base_map = None
+    if (opt.add) :
+        logging.info( "Reading the map in '%s'..." % opt.add )
+        base_map = load_map( opt.add )
+        logging.info( "  %d structures in the map." % len( base_map[1] ) )
+
+    molid_list = KBASE.keys( "mol" ) if (opt.from_snapshot) else []
     for a in args :
         logging.info( "Reading structures from '%s'..." % a )
         if (os.path.isfile( a )) :
@@ -242,8 +409,10 @@ def startup() :
                 logging.info( "    Reading done." )
     logging.info( "--------------------------------------------" )
     logging.info( "Finish reading structure input files. %d structures in total" % len( molid_list ) )
-    if (len( molid_list ) > 1) :
-        main( molid_list, opt, args )
+    if (len( molid_list ) > 1 or (base_map and molid_list)) :
+        main( molid_list, opt, args, base_map )
+    KBASE.flush()
+    KBASE.report()
 
 
         
@@ -5,13 +5,22 @@
 from kbase import KBASE
 
 import struc
+import cache
+import similarity
+import filequeue
+import runner
 
 import os
-import subprocess
+import time
+import pickle
+import select
+import signal
 import hashlib
 import logging
 import tempfile
-import pickle
+import itertools
+import traceback
+import multiprocessing
 
 
 
@@ -22,15 +31,105 @@ tempfile_basename = __tempfile_rawname + "__temp_file_ok_to_delete_after_running
 
 
 
+try :
+    import numpy
+
+    def _pack_matches( atom_match0, atom_match1 ) :
+        """
+        Returns the atom matches of a MCS as one 2-row integer array, with the columns sorted by the first row. A small
+        array takes a fraction of the memory of two lists, which matters when the C{KBASE} holds the MCSs of all pairs.
+        """
+        ret = numpy.array( [atom_match0, atom_match1,], dtype = numpy.int32 )
+        if (ret.size and ret.max() <= numpy.iinfo( numpy.int16 ).max) :
+            ret = ret.astype( numpy.int16 )
+        return ret[:, numpy.argsort( ret[0], kind = "mergesort" )]
+
+except ImportError :
+    def _pack_matches( atom_match0, atom_match1 ) :
+        """
+        Returns the atom matches of a MCS as a pair of tuples, sorted by the first tuple.
+        """
+        return tuple( zip( *sorted( zip( atom_match0, atom_match1 ) ) ) )
+
+
+
+class TimedOut( tuple ) :
+    """
+    Result of C{Mcs.match} for a pair of molecules whose search ran out of its time budget. It holds the atom matches of the
+    fallback search like a normal result does, or nothing if there is no fallback result.
+    """
+    pass
+
+
+
+class StepLimited( TimedOut ) :
+    """
+    Result of C{Mcs.match} for a pair of molecules whose search was stopped by its step limit (see C{PyMcs}) before it was
+    exhaustive. It is treated like a C{TimedOut} result: reported, tagged and not cached.
+    """
+    pass
+
+
+
+def _call_with_deadline( func, deadline ) :
+    """
+    Calls C{func} with no arguments in a forked child process, and returns a tuple of (whether it returned before the
+    C{deadline}, its return value or C{None},). The child is killed at the deadline, so that a call into a toolkit, which the
+    Python code cannot interrupt, is bounded too. The return value is pickled back to this process.
+    """
+    rfd, wfd = os.pipe()
+    pid      = os.fork()
+    if (0 == pid) :
+        try :
+            os.close( rfd )
+            try :
+                data = pickle.dumps( (True, func(),), pickle.HIGHEST_PROTOCOL )
+            except :
+                data = pickle.dumps( (False, traceback.format_exc(),), pickle.HIGHEST_PROTOCOL )
+            while (data) :
+                data = data[os.write( wfd, data ):]
+        finally :
+            # Exits without running the exit handlers of the parent process.
+            os._exit( 0 )
+    os.close( wfd )
+    chunks = []
+    try :
+        while (True) :
+            timeout = deadline - time.time()
+            if (timeout <= 0 or not select.select( [rfd,], [], [], timeout )[0]) :
+                os.kill( pid, signal.SIGKILL )
+                return False, None
+            chunk = os.read( rfd, 65536 )
+            if (not chunk) :
+                break
+            chunks.append( chunk )
+    finally :
+        os.close( rfd )
+        os.waitpid( pid, 0 )
+    is_ok, ret = pickle.loads( "".join( chunks ) )
+    if (not is_ok) :
+        raise RuntimeError( "The MCS searching failed in the child process:\n" + ret )
+    return True, ret
+
+
+
 class Mcs( object ) :
     """
     Base class of MCSS engine
     """
+    # Whether the cost of C{match_pairs} is proportional to the number of pairs, so that it can be called on blocks of pairs
+    # without searching more pairs than requested.
+    _is_pairwise = True
+
+    # Whether the matches include hydrogen atoms, or only heavy atoms.
+    _matches_hydrogens = False
+
     def __init__( self ) :
         """
 
         """
-        pass
+        # Pairs of IDs of molecules whose searches ran out of their time budgets.
+        self.timed_out = []
 
     
 
@@ -48,56 +147,517 @@ class Mcs( object ) :
         @type     mcs_mol: C{Struc}
         @param    mcs_mol: C{Struc} object of the MCS substructure        
         """
-        mol0      = KBASE.ask( id0 )
-        mol1      = KBASE.ask( id1 )
-        name0     = mol0.title()
-        name1     = mol1.title()
+        name0     = struc.ask_descriptor( id0, "title" )
+        name1     = struc.ask_descriptor( id1, "title" )
         mcs_title = "mcs@%s..%s" % (name0, name1,)
         mcs_id    = hashlib.sha1( mcs_title ).hexdigest()
         mcs_id    = KBASE.deposit( mcs_id, mcs_title )
 
-        # Sorts the two lists according to the ascending order of atom indices of the first list.
-        atom_match0, atom_match1 = zip( *sorted( zip( atom_match0, atom_match1 ), cmp = lambda x, y : x[0] - y[0] ) )
-        atom_match0, atom_match1 = list( atom_match0 ), list( atom_match1 )
-
-        KBASE.deposit_extra( mcs_id, "mcs-parents", (id0,             id1,            ) )
-        KBASE.deposit_extra( mcs_id, "mcs-matches", {id0:atom_match0, id1:atom_match1,} )
+        # Row 0 holds the matched atoms of `id0', row 1 those of `id1', in the ascending order of row 0.
+        KBASE.deposit_extra( mcs_id, "mcs-parents", (id0, id1,) )
+        KBASE.deposit_extra( mcs_id, "mcs-matches", _pack_matches( atom_match0, atom_match1 ) )
         
         return mcs_id
         
     
 
+    def signature( self ) :
+        """
+        Returns a string that identifies this engine and all its settings that affect the results. It is part of the keys
+        of the MCS cache (see the C{cache} module).
+        """
+        raise NotImplementedError( "`signature' method not implemented in subclass" )
+
+
+
+    def match( self, mol0, mol1 ) :
+        """
+        Finds out the maximum common substructure between C{mol0} and C{mol1} without touching the C{KBASE}. Returns a pair
+        of lists of matched atom indices C{(atom_match0, atom_match1,)}, or C{None} if there is no common substructure.
+
+        @type  mol0: C{Struc}
+        @param mol0: First molecule (the reference molecule)
+        @type  mol1: C{Struc}
+        @param mol1: Second molecule
+        """
+        raise NotImplementedError( "`match' method not implemented in subclass" )
+
+
+
+    def match_block( self, mols, pairs ) :
+        """
+        Calls C{match} on each pair of molecules and returns a list of the results in the same order as C{pairs}. This is the
+        unit of work of C{iter_matches}, which subclasses can override to share work among the pairs of a block.
+
+        @type   mols: C{list} of C{Struc}
+        @param  mols: A list of molecules
+        @type  pairs: C{list} of C{(int, int,)}
+        @param pairs: A list of pairs of indices into C{mols}
+        """
+        return [self.match( mols[i], mols[j] ) for i, j in pairs]
+
+
+
+    def match_pairs( self, mols, pairs, num_jobs = 1 ) :
+        """
+        Calls C{match} on each pair of molecules and returns a list of the results in the same order as C{pairs} (see
+        C{iter_matches}). The results do not depend on the number of jobs.
+
+        @type      mols: C{list} of C{Struc}
+        @param     mols: A list of molecules
+        @type     pairs: C{list} of C{(int, int,)}
+        @param    pairs: A list of pairs of indices into C{mols}
+        @type  num_jobs: C{int}
+        @param num_jobs: Number of worker processes
+        """
+        results = dict( self.iter_matches( mols, pairs, num_jobs ) )
+        return [results[e] for e in pairs]
+
+
+
+    def iter_matches( self, mols, pairs, num_jobs = 1, block_size = None ) :
+        """
+        Calls C{match} on each pair of molecules, and yields a tuple of (pair, result of C{match},) for each pair as soon as
+        the block of pairs that it belongs to is done (see C{match_block}). The pairs are yielded in their order in C{pairs}.
+
+        If C{num_jobs} is greater than 1, the blocks are spread over one pool of C{num_jobs} worker processes, which lives as
+        long as this generator. The workers are forked from the current process, so they see C{mols} (and the toolkit objects
+        within) without pickling them; only the atom indices travel back. Subclasses that prepare the molecules for matching
+        do it once for all the pairs, before the workers are forked.
+
+        @type        mols: C{list} of C{Struc}
+        @param       mols: A list of molecules
+        @type       pairs: C{list} of C{(int, int,)}
+        @param      pairs: A list of pairs of indices into C{mols}
+        @type    num_jobs: C{int}
+        @param   num_jobs: Number of worker processes
+        @type  block_size: C{int}
+        @param block_size: Maximum number of pairs in a block, or C{None} for no limit. It bounds how many pairs are searched
+                           before their results are yielded.
+        """
+        global _pool_state
+
+        if (num_jobs <= 1 or len( pairs ) < 2) :
+            size = block_size or len( pairs ) or 1
+            for k in range( 0, len( pairs ), size ) :
+                block = pairs[k:k + size]
+                for e in zip( block, self.match_block( mols, block ) ) :
+                    yield e
+            return
+
+        # Several blocks per worker to even out the load, as the cost of a pair varies a lot.
+        size        = max( 1, min( len( pairs ) // (num_jobs * 8), block_size or len( pairs ) ) )
+        blocks      = [pairs[i:i + size] for i in range( 0, len( pairs ), size )]
+        _pool_state = (self, mols,)
+        pool        = multiprocessing.Pool( num_jobs )
+        try :
+            for block, results in itertools.izip( blocks, pool.imap( _match_block, blocks ) ) :
+                for e in zip( block, results ) :
+                    yield e
+            pool.close()
+        except :
+            pool.terminate()
+            raise
+        finally :
+            pool.join()
+            _pool_state = None
+
+
+
+    @staticmethod
+    def prune_pairs( mols, pairs, simi_cutoff ) :
+        """
+        Returns the pairs whose similarity scores might reach C{simi_cutoff}. The other pairs cannot get a score that is not
+        less than C{simi_cutoff} whatever their common substructure is, because the score is bound by the difference of the
+        heavy atom counts of the two molecules (see C{similarity.max_by_heavy_atom_count}).
+
+        @type         mols: C{list} of C{Struc}
+        @param        mols: A list of molecules
+        @type        pairs: C{list} of C{(int, int,)}
+        @param       pairs: A list of pairs of indices into C{mols}
+        @type  simi_cutoff: C{float}
+        @param simi_cutoff: Cutoff of similarity scores
+        """
+        num_heavy = [len( mol.heavy_atoms() ) for mol in mols]
+        return [(i, j,) for i, j in pairs
+                if (similarity.max_by_heavy_atom_count( num_heavy[i], num_heavy[j] ) >= simi_cutoff)]
+
+
+
     def search( self, mol0, mol1 ) :
         """
         Finds out the maximum common substructure between C{mol0} and C{mol1} and deposits it in C{KBASE}. Returns the ID of
-        the substructure in C{KBASE}.
+        the substructure in C{KBASE}, or C{None} if there is no common substructure.
 
         @type  mol0: C{Struc}
         @param mol0: First molecule (the reference molecule)
         @type  mol1: C{Struc}
         @param mol1: Second molecule
         """
-        raise NotImplementedError( "`search' method not implemented in subclass" )
+        result = self.match( mol0, mol1 )
+        if (result) :
+            return self.deposit_to_kbase( mol0.id(), mol1.id(), result[0], result[1] )
 
     
 
-    def search_all( self, mols ) :
+    def search_all( self, mols, opt ) :
         """
         Finds out the maximum common substructures between any pair of the given structures and deposits them in C{KBASE}.
         Returns a list of IDs of the substructures in C{KBASE}.
 
         @type  mols: C{list} of C{Struc}
         @param mols: A list of molecules
+        @type   opt: C{optparse.Values}
+        @param  opt: Command line options (see C{main.startup})
         """
-        raise NotImplementedError( "`search' method not implemented in subclass" )
-        
+        num_mol = len( mols )
+        pairs   = [(i, j,) for i in range( num_mol ) for j in range( i + 1, num_mol )]
+        return self.search_pairs( mols, pairs, opt )
+
+
+
+    def search_pairs( self, mols, pairs, opt ) :
+        """
+        Finds out the maximum common substructures between the given pairs of structures and deposits them in C{KBASE}.
+        Returns a list of IDs of the substructures in C{KBASE}.
+
+        Pairs whose similarity scores cannot reach C{opt.prune} are skipped (see C{prune_pairs}). Pairs found in the MCS cache
+        (C{opt.cache}) are not searched again, and newly searched pairs are stored into it. Pairs that ran out of their time
+        budgets or search steps (C{TimedOut} results) are not cached; they are tagged with "mcs-timeout" in C{KBASE} if a
+        fallback result is deposited, and their IDs are appended to C{self.timed_out}. If C{opt.checkpoint} is given, the
+        results are appended to that file every C{opt.checkpoint_every} pairs, and with C{opt.resume} the pairs already
+        recorded there are not searched again (see C{cache.McsCheckpoint}). If C{opt.queue} is given, the searching is done by
+        the workers of that file queue (see the C{filequeue} module), and C{opt.jobs} workers are started on this machine.
+
+        Identical structures (see the "alias-of" tag deposited by C{struc.deposit_struc}) are searched only once; their
+        results are copied to all of the copies with the atom indices translated (see C{find_aliases}).
+
+        The substructures are deposited in the order of C{pairs}, each as soon as its result and the results of all the pairs
+        before it have arrived, so the results are not held in memory all at once (see C{_search_results}).
+
+        @type   mols: C{list} of C{Struc}
+        @param  mols: A list of molecules
+        @type  pairs: C{list} of C{(int, int,)}
+        @param pairs: A list of pairs of indices into C{mols}
+        @type    opt: C{optparse.Values}
+        @param   opt: Command line options (see C{main.startup})
+        """
+        if (opt.prune > 0) :
+            num_pair = len( pairs )
+            pairs    = self.prune_pairs( mols, pairs, opt.prune )
+            logging.info( "  %d of %d pairs pruned by the heavy atom counts." % (num_pair - len( pairs ), num_pair,) )
+
+        rep, atom_map = self.find_aliases( mols, pairs, opt.jobs )
+
+        # Pairs of the representative structures, each pair only once, and the number of pairs that use each of them.
+        rep_pairs = []
+        num_use   = {}
+        for i, j in pairs :
+            ri, rj = rep[i], rep[j]
+            if (ri != rj) :
+                key = (rj, ri,) if ((rj, ri,) in num_use) else (ri, rj,)
+                if (key not in num_use) :
+                    rep_pairs.append( key )
+                num_use[key] = num_use.get( key, 0 ) + 1
+        if (len( rep_pairs ) < len( pairs )) :
+            logging.info( "  %d of %d pairs are between copies of identical structures." % (len( pairs ) - len( rep_pairs ),
+                                                                                           len( pairs ),) )
+
+        def translate( k, a ) :
+            return a if (atom_map[k] is None) else atom_map[k].get( a )
+
+        # The results arrive in the order of the search, and are deposited into the kbase in the order of `pairs', so that
+        # the output does not depend on the engine or the number of jobs. A result is dropped as soon as all the pairs that use
+        # it are deposited, so only the results that arrive ahead of their turn are held in memory.
+        ret     = []
+        arrived = {}
+        done    = [0,]
+
+        def deposit_ready() :
+            while (done[0] < len( pairs )) :
+                i, j   = pairs[done[0]]
+                ri, rj = rep[i], rep[j]
+                if (ri == rj) :
+                    # Copies of the same structure match completely, on the atoms that the engine matches.
+                    common = set.intersection( *[set( e ) for e in (atom_map[i], atom_map[j],) if (e is not None)] )
+                    if (not self._matches_hydrogens) :
+                        common &= set( mols[ri].heavy_atoms() )
+                    result = ([translate( i, a ) for a in sorted( common )], [translate( j, a ) for a in sorted( common )],)
+                else :
+                    key = (ri, rj,) if ((ri, rj,) in num_use) else (rj, ri,)
+                    if (key not in arrived) :
+                        return
+                    result        = arrived[key]
+                    num_use[key] -= 1
+                    if (not num_use[key]) :
+                        del arrived[key]
+                    if (result and key != (ri, rj,)) :
+                        result = result.__class__( (result[1], result[0],) )
+                    if (result and (i != ri or j != rj)) :
+                        atom_match = [(translate( i, a0 ), translate( j, a1 ),) for a0, a1 in zip( result[0], result[1] )]
+                        atom_match = [e for e in atom_match if (None not in e)]
+                        result     = result.__class__( ([e[0] for e in atom_match], [e[1] for e in atom_match],) )
+                if (isinstance( result, TimedOut )) :
+                    self.timed_out.append( (mols[i].id(), mols[j].id(),) )
+                if (result) :
+                    ret.append( self.deposit_to_kbase( mols[i].id(), mols[j].id(), result[0], result[1] ) )
+                    if (isinstance( result, TimedOut )) :
+                        KBASE.deposit_extra( ret[-1], "mcs-timeout", True )
+                done[0] += 1
+
+        for key, result in self._search_results( mols, rep_pairs, opt ) :
+            arrived[key] = result
+            deposit_ready()
+        deposit_ready()
+        return ret
+
+
+
+    def _search_results( self, mols, pairs, opt ) :
+        """
+        Searches the given pairs of structures with the MCS cache, checkpoint and file queue of C{search_pairs}, and yields a
+        tuple of (pair, result of C{match},) for each pair: first those found in the cache or the checkpoint, and then the
+        others as they are searched (see C{iter_matches}).
+        """
+        todo       = pairs
+        db         = None
+        checkpoint = None
+        block_size = None
+        try :
+            if (opt.cache) :
+                db   = cache.McsCache( opt.cache, self.signature() )
+                todo = []
+                for i, j in pairs :
+                    try :
+                        result = db.get( mols[i], mols[j] )
+                    except KeyError :
+                        todo.append( (i, j,) )
+                    else :
+                        yield (i, j,), result
+                logging.info( "  %d of %d pairs found in the MCS cache '%s'." % (len( pairs ) - len( todo ), len( pairs ),
+                                                                                opt.cache,) )
+            if (opt.checkpoint) :
+                checkpoint = cache.McsCheckpoint( opt.checkpoint, self.signature(), opt.resume )
+                remaining  = []
+                for i, j in todo :
+                    try :
+                        result = checkpoint.get( mols[i], mols[j] )
+                    except KeyError :
+                        remaining.append( (i, j,) )
+                    else :
+                        yield (i, j,), result
+                if (opt.resume) :
+                    logging.info( "  %d of %d pairs resumed from the checkpoint '%s'." % (len( todo ) - len( remaining ),
+                                                                                         len( todo ), opt.checkpoint,) )
+                todo = remaining
+                # The results are checkpointed every `opt.checkpoint_every' pairs as they arrive, so the pairs are not searched
+                # in bigger blocks than that.
+                block_size = max( 1, opt.checkpoint_every )
+            if (opt.queue) :
+                if (not self._is_pairwise) :
+                    raise ValueError( "The file queue cannot be used with %s, which searches all pairs of its input molecules "
+                                      "at once, so a work unit would search many more pairs than it asks for."
+                                      % self.__class__.__name__ )
+                arrivals = filequeue.FileQueue( opt.queue ).match_pairs( self, mols, todo, opt.queue_unit, opt.jobs,
+                                                                         opt.queue_timeout )
+                arrivals = (e for block, block_results in arrivals for e in zip( block, block_results ))
+            else :
+                arrivals = self.iter_matches( mols, todo, opt.jobs, block_size )
+            num_done = 0
+            for (i, j,), result in arrivals :
+                if (db and not isinstance( result, TimedOut )) :
+                    db.put( mols[i], mols[j], result )
+                num_done += 1
+                if (checkpoint is not None) :
+                    checkpoint.put( mols[i], mols[j], result )
+                    if (not num_done % block_size) :
+                        checkpoint.flush()
+                        logging.debug( "DEBUG: %d of %d pairs checkpointed." % (num_done, len( todo ),) )
+                yield (i, j,), result
+        finally :
+            if (db) :
+                db.close()
+            if (checkpoint is not None) :
+                checkpoint.close()
+
+
+
+    def find_aliases( self, mols, pairs, num_jobs = 1 ) :
+        """
+        Finds out the copies of identical structures among the molecules involved in C{pairs}, and returns a list of the
+        indices of the representative structures (one for each molecule in C{mols}) and a list of dictionaries (one for each
+        molecule in C{mols}) that map the atom indices of the representative structure to those of the molecule. The
+        dictionaries of the representative structures themselves are C{None}.
+
+        Copies are identified by the "alias-of" tag in C{KBASE}. The atom indices are mapped by matching each copy with its
+        representative structure, and extended to the hydrogen atoms (see C{_with_hydrogens}), as the matches of some engines
+        include them. A copy that does not match completely, hydrogen atoms included, is treated as a distinct structure.
+        """
+        rep      = range( len( mols ) )
+        atom_map = [None] * len( mols )
+        first    = {}
+        aliases  = []
+        for k in sorted( set( [i for i, j in pairs] + [j for i, j in pairs] ) ) :
+            try :
+                key = KBASE.ask( mols[k].id(), "alias-of" )
+            except LookupError :
+                key = mols[k].id()
+            if (key in first) :
+                aliases.append( (first[key], k,) )
+            else :
+                first[key] = k
+        for (r, k,), result in zip( aliases, self.match_pairs( mols, aliases, num_jobs ) ) :
+            full_map = None
+            if (result and not isinstance( result, TimedOut )) :
+                full_map = self._with_hydrogens( mols[r], mols[k], dict( zip( result[0], result[1] ) ) )
+            if (full_map is None or len( full_map ) < len( mols[r].atom )) :
+                logging.warn( "WARNING: '%s' does not completely match its identical structure '%s'. They will be searched "
+                              "separately." % (mols[k].title(), mols[r].title(),) )
+                continue
+            rep     [k] = r
+            atom_map[k] = full_map
+        return rep, atom_map
+
+
+
+    @staticmethod
+    def _with_hydrogens( mol0, mol1, atom_map ) :
+        """
+        Returns a copy of C{atom_map}, a dictionary that maps atoms of C{mol0} to atoms of C{mol1}, with the hydrogen atoms
+        bonded to each pair of mapped atoms mapped in the order of their indices. Returns C{None} if a pair of mapped atoms
+        has different numbers of hydrogen atoms.
+        """
+        heavy0 = set( mol0.heavy_atoms() )
+        heavy1 = set( mol1.heavy_atoms() )
+        ret    = dict( atom_map )
+        for a0, a1 in atom_map.items() :
+            if (a0 not in heavy0) :
+                continue
+            h0 = sorted( set( mol0.bonded_atoms( a0 ) ) - heavy0 )
+            h1 = sorted( set( mol1.bonded_atoms( a1 ) ) - heavy1 )
+            if (len( h0 ) != len( h1 )) :
+                return None
+            ret.update( zip( h0, h1 ) )
+        return ret
+
+
+
+# (engine, molecules) shared with the worker processes of `Mcs.iter_matches'. It is set only while a pool is alive.
+_pool_state = None
+
+
+
+def _match_block( pairs ) :
+    """
+    Worker function of C{Mcs.iter_matches}. Returns a list of C{match} results for the given block of pairs.
+    """
+    engine, mols = _pool_state
+    return engine.match_block( mols, pairs )
+
+
+
+def _num_pair( num_mol ) :
+    """
+    Returns the number of pairs among C{num_mol} molecules.
+    """
+    return num_mol * (num_mol - 1) // 2
+
+
+
+def _vertex_cover( pairs ) :
+    """
+    Returns a set of molecules that includes at least one molecule of each of C{pairs}. It is found greedily: the molecule in
+    the most pairs that are not covered yet goes first.
+    """
+    neighbors = {}
+    for i, j in pairs :
+        neighbors.setdefault( i, set() ).add( j )
+        neighbors.setdefault( j, set() ).add( i )
+    ret = set()
+    while (neighbors) :
+        k = max( neighbors, key = lambda e : (len( neighbors[e] ), -e,) )
+        ret.add( k )
+        for e in neighbors.pop( k ) :
+            neighbors[e].discard( k )
+            if (not neighbors[e]) :
+                del neighbors[e]
+    return ret
+
+
+
+def _plan_canvas_jobs( pairs, num_jobs = 1, job_cost = 0 ) :
+    """
+    Plans the jobs of an engine that can only search all pairs of its input molecules, like canvasMCS (see C{SchrodMcs}),
+    so that all of C{pairs} are searched, but not many more. Returns a list of jobs, each a list of indices of the molecules
+    in the job.
+
+    The molecules are split into a core, which includes at least one molecule of each pair (see C{_vertex_cover}), and the
+    rest, which are only paired with the core, such as the structures added to an existing map, or the molecules of the
+    pairs that are missing from the MCS cache. Both are split into blocks of the same size, and each pair of blocks that has
+    any of C{pairs} across it is one job, which also searches the pairs within its two blocks. A core block whose own pairs
+    are not searched by any such job is one job by itself. The blocks of the rest are never paired with each other, so the
+    pairs among the rest are searched only within a block, and all molecules are the core if that is cheaper.
+
+    The pairs within a block are searched again by each job on the block, so smaller blocks search fewer pairs that are not
+    requested, but give more jobs and more redundant pairs. The block size is the one that minimizes the estimated running
+    time with C{num_jobs} concurrent jobs: the bigger one of (cost of all jobs) / C{num_jobs} and the cost of the biggest job,
+    where the cost of a job is its number of pairs plus C{job_cost}. One block of all molecules is one job on all of them.
+
+    @type     pairs: C{list} of C{(int, int,)}
+    @param    pairs: A list of pairs of indices of molecules
+    @type  num_jobs: C{int}
+    @param num_jobs: Number of jobs that run at the same time
+    @type  job_cost: C{int}
+    @param job_cost: Cost of starting a job, in the number of pairs that could be searched in the same time
+    """
+    pairs    = set( [(min( i, j ), max( i, j ),) for i, j in pairs if (i != j)] )
+    involved = sorted( set( [i for i, j in pairs] + [j for i, j in pairs] ) )
+    n        = len( involved )
+    if (not pairs) :
+        return []
+
+    # All pairs of the molecules are requested (the common case), so there is no rest to split off.
+    cover = set( involved ) if (len( pairs ) == _num_pair( n )) else _vertex_cover( pairs )
+    best  = None
+    for core in ([e for e in involved if (e in cover)], involved,) :
+        h, r = len( core ), n - len( core )
+        for size in range( 1, n + 1 ) :
+            # Estimated as if every pair of blocks had requested pairs across it
+            num_core = (h + size - 1) // size
+            num_rest = (r + size - 1) // size
+            jobs     = [(_num_pair( num_core ), min( h, 2 * size ),), (num_core * num_rest, min( h, size ) + min( r, size ),)]
+            if (num_core == 1 and num_rest == 0) :
+                jobs = [(1, h,),]
+            total = sum( [k * (_num_pair( m ) + job_cost) for k, m in jobs] )
+            cost  = max( [total / float( max( 1, num_jobs ) ),] + [_num_pair( m ) + job_cost for k, m in jobs if (k)] )
+            if (best is None or cost < best[0]) :
+                best = (cost, core, size,)
+            if (size >= max( h, r )) :
+                break
+    cost, core, size = best
+    rest   = sorted( set( involved ) - set( core ) )
+    blocks = [core[i:i + size] for i in range( 0, len( core ), size )]
+    blocks.extend( [rest[i:i + size] for i in range( 0, len( rest ), size )] )
+    block  = {}
+    for k, e in enumerate( blocks ) :
+        for i in e :
+            block[i] = k
+
+    # Pairs of blocks with requested pairs across them or within them
+    needed  = set( [(min( block[i], block[j] ), max( block[i], block[j] ),) for i, j in pairs] )
+    ret     = [blocks[a] + blocks[b] for a, b in sorted( needed ) if (a != b)]
+    covered = set( [a for a, b in needed if (a != b)] + [b for a, b in needed if (a != b)] )
+    ret.extend( [blocks[a] for a, b in sorted( needed ) if (a == b and a not in covered)] )
+    return ret
+
 
 
 try :
     import openeye.oechem as oechem
 
     class OeMcs( Mcs ) :
-        def __init__( self, atom_expr = oechem.OEExprOpts_IntType, bond_expr = 0, is_approximate = True ) :
+        def __init__( self, atom_expr = oechem.OEExprOpts_IntType, bond_expr = 0, is_approximate = True, pair_timeout = 0,
+                      first_match = False ) :
             """
             @type  atom_expr:       C{str}
             @param atom_expr:       Openeye oechem atom expression option. Atoms with same int value will be regarded equally. Use the SetIntType method to set Int type for individual atoms. For more details and more atom expression choices, please check OEExprOpts part Openeye oechem documentation.
@@ -106,28 +666,49 @@ try :
             @type  is_approximate:  C{bool}
             @param is_approximate:  1. Ture: Use the approximate MCSS method
                                     2. False: Use the exhaustive MCSS method    
+            @type  pair_timeout:    C{float}
+            @param pair_timeout:    Time budget in seconds per pair of molecules. When the budget runs out, the exhaustive
+                                    search falls back to the approximate one, and the approximate search keeps its best
+                                    match so far, if it had found any. 0 means no limit. With a budget, each pair is
+                                    searched in a forked child process that is killed when the budget runs out, so a
+                                    single match that takes long to find is interrupted too.
+            @type  first_match:     C{bool}
+            @param first_match:     If true, stops at the first match instead of enumerating all maximal matches and picking
+                                    the one with the most heavy atoms. This is much faster on symmetric molecules, but the
+                                    match might have fewer heavy atoms if the maximal matches differ in their hydrogens.
             """
+            Mcs.__init__( self )
             self._atom_expr      = atom_expr
             self._bond_expr      = bond_expr
             self._is_approximate = is_approximate
+            self._pair_timeout   = pair_timeout
+            self._first_match    = first_match
 
-        def search( self, mol0, mol1 ) :
-            mol0 = mol0._struc
-            mol1 = mol1._struc
+            self._prepared       = None
 
-            p0 = mol0.CreateCopy()
-            p1 = mol1.CreateCopy()
+        def _prepare( self, mol ) :
+            """
+            Returns a copy of the molecule that is ready for MCS searching: atom int types are set and hydrogens suppressed.
+            """
+            p = mol._struc.CreateCopy()
             #set atom int type. 
-            for mol in (p0, p1,) :
-                for atom in mol.GetAtoms() :
-                    if (atom.IsHydrogen()) :
-                        atom.SetIntType(1)
-                    else:
-                        atom.SetIntType(2)
+            for atom in p.GetAtoms() :
+                if (atom.IsHydrogen()) :
+                    atom.SetIntType(1)
+                else:
+                    atom.SetIntType(2)
             #suppress hydrogens before mcs search
-            oechem.OESuppressHydrogens(p0)              
-            oechem.OESuppressHydrogens(p1)     
-            if (self._is_approximate) :
+            oechem.OESuppressHydrogens(p)              
+            return p
+
+        def _mcss( self, p1, is_approximate = None ) :
+            """
+            Returns a MCS search object for the prepared pattern molecule C{p1}. The object can be matched against any number
+            of target molecules, and C{p1} must be kept alive as long as the object is in use.
+            """
+            if (is_approximate is None) :
+                is_approximate = self._is_approximate
+            if (is_approximate) :
                 mcss = oechem.OEMCSSearch( p1, self._atom_expr, self._bond_expr, oechem.OEMCSType_Approximate )
             else:
                 mcss = oechem.OEMCSSearch( p1, self._atom_expr, self._bond_expr )
@@ -135,44 +716,96 @@ try :
             mcss.SetMinAtoms( 1 )
             #set the function to evalue the mcs search 
             mcss.SetMCSFunc( oechem.OEMCSMaxAtomsCompleteCycles(1.5) )
+            return mcss
+
+        def match( self, mol0, mol1 ) :
+            p1 = self._prepare( mol1 )
+            return self._match_prepared( self._mcss( p1 ), self._prepare( mol0 ), p1 )
+
+        def iter_matches( self, mols, pairs, num_jobs = 1, block_size = None ) :
+            """
+            Same as C{Mcs.iter_matches}, but each molecule is prepared (see C{_prepare}) only once, before any worker process
+            is forked, and the pairs are searched (and yielded) grouped by their second molecules, so that one MCS search
+            object is built for each of them (see C{match_block}).
+            """
+            involved       = set( [i for i, j in pairs] + [j for i, j in pairs] )
+            self._prepared = dict( [(k, self._prepare( mols[k] ),) for k in involved] )
+            try :
+                for e in Mcs.iter_matches( self, mols, sorted( pairs, key = lambda e : (e[1], e[0],) ), num_jobs,
+                                           block_size ) :
+                    yield e
+            finally :
+                self._prepared = None
 
-            # There could be multiple matches. We select the one with the maximum number of atoms.
+        def match_block( self, mols, pairs ) :
+            ret     = []
+            mcss    = None
+            pattern = None
+            for i, j in pairs :
+                if (j != pattern) :
+                    mcss    = self._mcss( self._prepared[j] )
+                    pattern = j
+                ret.append( self._match_prepared( mcss, self._prepared[i], self._prepared[j] ) )
+            return ret
+
+        def _match_prepared( self, mcss, p0, p1 ) :
+            """
+            Matches the prepared target molecule C{p0} with the MCS search object C{mcss} of the prepared pattern molecule
+            C{p1}, and returns the pair of lists of matched atom indices, or C{None} if there is no match. If the time budget
+            runs out, returns a C{TimedOut} result instead.
+            """
+            if (not self._pair_timeout) :
+                return self._best_match( mcss, p0, None )[0]
+            # The search runs in a child process that is killed if it is still running shortly after the deadline, as a
+            # single `Match' call can take much longer than the budget. The grace period lets the search return its best
+            # match so far when it notices the deadline itself.
+            deadline                 = time.time() + self._pair_timeout
+            is_done, result          = _call_with_deadline( lambda : self._best_match( mcss, p0, deadline ),
+                                                            deadline + min( 1.0, 0.1 * self._pair_timeout ) )
+            best_match, is_timed_out = result if (is_done) else (None, True,)
+            if (is_timed_out) :
+                if (not self._is_approximate) :
+                    best_match, is_timed_out = self._best_match( self._mcss( p1, True ), p0, None )
+                return TimedOut( best_match or () )
+            return best_match
+
+        def _best_match( self, mcss, p0, deadline ) :
+            """
+            Returns the best match of C{mcss} on C{p0} (or C{None}) and whether the search was stopped by the C{deadline}.
+            """
+            # There could be multiple matches. We select the one with the maximum number of heavy atoms.
             # If there are more than 1 matches with the same maximum number of atoms, we arbitrarily select the first one.
-            mcs_mol = None
+            # The matches are scored from their atom pairs directly; no molecule is built for them.
+            best    = None
             max_num = 0
             #do the mcs search
             for match in mcss.Match( p0, True ) :
-                num_atom = 0
-                mcs_tmp  = oechem.OEMol()
-                oechem.OESubsetMol( mcs_tmp, match, True )
-                oechem.OEFindRingAtomsAndBonds(mcs_tmp)
-                for atom in mcs_tmp.GetAtoms() :
-                    if (not atom.IsHydrogen()) :
-                        num_atom += 1
-
+                pairs    = [(matchpair.target.GetIdx() + 1, matchpair.pattern.GetIdx() + 1, matchpair.pattern.IsHydrogen(),)
+                            for matchpair in match.GetAtoms()]
+                num_atom = len( [e for e in pairs if (not e[2])] )
                 if (num_atom > max_num) :
                     max_num = num_atom
-                    mcs_mol = mcs_tmp
-                    atom_match0 = []
-                    atom_match1 = []
-                    for matchpair in match.GetAtoms() :
-                        atom_match0.append( matchpair.target .GetIdx()+1 )
-                        atom_match1.append( matchpair.pattern.GetIdx()+1 )
-            #dump search result to kbase        
-            if (mcs_mol) :
-                mol0    = struc.OeStruc( mol0 )
-                mol1    = struc.OeStruc( mol1 )
-                mcs_mol = struc.OeStruc( mcs_mol )
-                return self.deposit_to_kbase( mol0.id(), mol1.id(), atom_match0, atom_match1 )
+                    best    = pairs
+                if (self._first_match and best) :
+                    break
+                if (deadline and time.time() > deadline) :
+                    return self._atom_matches( best ), True
+            return self._atom_matches( best ), False
 
-        def search_all( self, mols, opt ) :
-            ret     = []
-            num_mol = len( mols )
-            for i in range( num_mol ) :
-                for j in range( i+1, num_mol ) :
-                    result = self.search( mols[i], mols[j] )
-                    if (result) :
-                        ret.append( result )
+        @staticmethod
+        def _atom_matches( pairs ) :
+            """
+            Converts a list of (target atom index, pattern atom index, is hydrogen,) into a pair of lists of matched atom indices.
+            Returns C{None} if C{pairs} is C{None}.
+            """
+            if (pairs) :
+                return [e[0] for e in pairs], [e[1] for e in pairs]
+
+        def signature( self ) :
+            ret = "OeMcs(atom_expr=%d,bond_expr=%d,is_approximate=%d)" % (self._atom_expr, self._bond_expr,
+                                                                           self._is_approximate,)
+            if (self._first_match) :
+                ret = ret[:-1] + ",first_match=1)"
             return ret
 
 except ImportError :
@@ -183,40 +816,22 @@ except ImportError :
 try :
     import schrodinger.structutils.analyze as analyze
     
-    class McsMatch( object ) :
-        """
-        A class to temporarily store each entry (i.e., row) in Schrodinger's MCS result
-        """
-        def __init__( self, mol0_id, mol1_id, mcs_smarts0, mcs_smarts1, mcs_atom0, mcs_atom1 ) :
-            """
-            @type  mol0_id    : C{str}
-            @param mol0_id    : First structure/molecule's ID
-            @type  mol1_id    : C{str}
-            @param mol1_id    : Second structure/molecule's ID
-            @type  mcs_smarts0: C{str}
-            @param mcs_smarts0: SMARTS on the first molecule
-            @type  mcs_smarts1: C{str}
-            @param mcs_smarts1: SMARTS on the second molecule
-            @type  mcs_atom0  : C{str}
-            @param mcs_atom0  : A list of comma separated integer numbers that are atom indices of the first molecule. If the
-                                first molecule is trimmed such that only the specified atoms are left, you get the maximum
-                                common substructure.
-            @type  mcs_atom1  : C{str}
-            @param mcs_atom1  : A list of comma separated integer numbers that are atom indices of the second molecule. If the
-                                second molecule is trimmed such that only the specified atoms are left, you get the maximum
-                                common substructure.
-            """
-            self.mol0_id     = mol0_id
-            self.mol1_id     = mol1_id
-            self.mcs_smarts0 = mcs_smarts0
-            self.mcs_smarts1 = mcs_smarts1
-            self.mcs_atom0   = mcs_atom0
-            self.mcs_atom1   = mcs_atom1
-
-            
-            
     class SchrodMcs( Mcs ) :
-        def __init__( self, atomtyping = 3 ) :
+        # canvasMCS searches all pairs of the molecules involved, so the pairs are never split into blocks.
+        _is_pairwise = False
+
+        # canvasMCS matches the hydrogen atoms too.
+        _matches_hydrogens = True
+
+        # Rough number of pairs that canvasMCS searches in the time it takes to start (see `_plan_canvas_jobs').
+        _job_cost = 200
+
+        def __setstate__( self, state ) :
+            # The Schrodinger installation might be in a different place on the machine of a file-queue worker.
+            self.__dict__.update( state )
+            self._cmd = os.path.join( os.environ['SCHRODINGER'], "utilities", "canvasMCS" )
+
+        def __init__( self, atomtyping = 3, pair_timeout = 0 ) :
             """
             @type  atomtyping: C{int}
             @param atomtyping: Schrodinger Canvas' atom typing scheme (see below)
@@ -238,75 +853,167 @@ try :
                                12 - Same as 11, but distinguishing aliphatic atoms by ring/acyclic.
                                13 - Same as 12, but distinguishing rings by size.
                                 C - Custom. Must be followed by location of a type definitions file.
+            @type  pair_timeout: C{float}
+            @param pair_timeout: Time budget in seconds per pair of molecules. A canvasMCS job running longer than the budget
+                                 of all its pairs is killed, and its unfinished pairs are reported as timed out. 0 means no
+                                 limit.
             """
-            self._cmd    = os.path.join( os.environ['SCHRODINGER'], "utilities", "canvasMCS" )
-            self._typing = atomtyping
+            Mcs.__init__( self )
+            self._cmd          = os.path.join( os.environ['SCHRODINGER'], "utilities", "canvasMCS" )
+            self._typing       = atomtyping
+            self._pair_timeout = pair_timeout
             
 
 
-        def search( self, mol0, mol1 ) :
-            return self.search_all( [mol0, mol1,] )
+        def signature( self ) :
+            return "SchrodMcs(atomtyping=%s,nobreakring)" % (self._typing,)
+
+
+
+        def _canvas_job( self, mols, basename ) :
+            """
+            Writes C{mols} into a .mae file, and returns the canvasMCS command to search them, and the names of the CSV output
+            and log files of the command.
+            """
+            mae_fname = basename + ".mae"
+            out_fname = basename + ".csv"
+            log_fname = basename + ".log"
+
+            if (os.path.isfile( mae_fname )) :
+                os.remove( mae_fname )
+
+            for mol in mols :
+                title = mol.title()
+                mol.set_title( mol.id() )
+                mol.write( mae_fname )
+                mol.set_title( title )
+            cmd = [self._cmd,
+                   "-imae",     mae_fname,
+                   "-opw",      out_fname,
+                   "-atomtype", str( self._typing ),
+                   "-nobreakring",
+                   ]
+            return cmd, out_fname, log_fname
+
+
+
+        def _check_canvas( self, val, out_fname ) :
+            """
+            Raises C{RuntimeError} if canvasMCS exited with a nonzero value C{val}.
+            """
+            if (val == 17) :
+                raise RuntimeError( "Used a MCS feature that requires Schrodinger's CANVAS_ELEMENTS license." )
+            if (val != 0 ) :
+                msg = "CanvasMCS exited prematurely. This could be because the input molecules were too dissimilar" \
+                      " or too numerous, or because the chosen atom-typing scheme was too general."
+                with open( out_fname ) as fh:
+                    msg += "\n\n"
+                    msg += fh.read()
+                raise RuntimeError( msg )
+
+
+
+        def _run_canvas_jobs( self, jobs, num_jobs ) :
+            """
+            Runs canvasMCS jobs (as returned by C{_canvas_job}), up to C{num_jobs} at a time, and returns the list of indices of
+            the jobs that were killed because they ran out of their time budgets.
+
+            canvasMCS cannot be limited per pair, so a job gets the per-pair time budget times its number of pairs. Rows that a
+            killed job has already written are still valid.
+            """
+            r = runner.Runner( num_jobs )
+            for mols, basename in jobs :
+                cmd, out_fname, log_fname = self._canvas_job( mols, basename )
+                num_pair = len( mols ) * (len( mols ) - 1) // 2
+                r.submit( cmd,
+                          name      = "canvasMCS %s" % os.path.basename( basename ),
+                          log_fname = log_fname,
+                          timeout   = self._pair_timeout * num_pair,
+                          progress  = lambda counter = runner.LineCounter( out_fname ), n = num_pair : counter() / float( n ) )
+            killed = []
+            for k, job in enumerate( r.run() ) :
+                if (job.timed_out) :
+                    killed.append( k )
+                else :
+                    self._check_canvas( job.returncode, job.cmd[job.cmd.index( "-opw" ) + 1] )
+            return killed
+
+
+
+        def _read_canvas( self, out_fname ) :
+            """
+            Reads a canvasMCS CSV output file row by row, and yields a tuple of (ID of the first molecule, ID of the second
+            molecule, atom match of the first molecule, atom match of the second molecule,) for each row. Only the ID and
+            atom index columns are read; the rows are not kept in memory.
+            """
+            if (not os.path.isfile( out_fname )) :
+                # A killed job might not have written its output file.
+                return
+            import csv
+
+            with open( out_fname, "rb" ) as fh :
+                reader = csv.reader( fh )
+                next( reader, None )
+                for tokens in reader :
+                    # Skips the incomplete last row of a killed job.
+                    if (len( tokens ) < 15) :
+                        continue
+                    yield (tokens[1], tokens[3],
+                           [int( i ) for i in tokens[ 9].split( ',' )],
+                           [int( i ) for i in tokens[12].split( ',' )],)
+
+
+
+        def match( self, mol0, mol1 ) :
+            return self.match_pairs( [mol0, mol1,], [(0, 1,),] )[0]
+
+
+
+        def iter_matches( self, mols, pairs, num_jobs = 1, block_size = None ) :
+            """
+            Runs canvasMCS over the molecules involved in C{pairs}, and yields a tuple of (pair, result of C{match} on the
+            pair,) for each of C{pairs} as its row is read from the outputs, and then for the pairs without rows (C{TimedOut}
+            for the pairs of killed jobs, C{None} for the others). Only the requested pairs are kept in memory, not the rows.
+
+            The search is split into canvasMCS jobs (see C{_plan_canvas_jobs}), up to C{num_jobs} of which run at the same
+            time. A pair searched by several jobs is taken from the first one. canvasMCS searches all pairs of each job at once,
+            so C{block_size} is ignored.
+            """
+            if (not pairs) :
+                return
+            # (ID of the first molecule, ID of the second molecule,) -> pairs of indices into `mols'
+            todo = {}
+            for i, j in pairs :
+                todo.setdefault( (mols[i].id(), mols[j].id(),), [] ).append( (i, j,) )
+            jobs      = [[mols[k] for k in e] for e in _plan_canvas_jobs( pairs, num_jobs, self._job_cost )]
+            basenames = ["%s_%d" % (tempfile_basename, k,) for k in range( len( jobs ) )]
+            num_pair  = len( set( [(min( i, j ), max( i, j ),) for i, j in pairs] ) )
+            logging.info( "  Running %d canvasMCS job(s), %d at a time, which search %d pairs for %d requested pairs..."
+                          % (len( jobs ), num_jobs, sum( [_num_pair( len( e ) ) for e in jobs] ), num_pair,) )
+            killed = self._run_canvas_jobs( zip( jobs, basenames ), num_jobs )
+            for basename in basenames :
+                for id0, id1, atom_match0, atom_match1 in self._read_canvas( basename + ".csv" ) :
+                    for pair in todo.pop( (id0, id1,), [] ) :
+                        yield pair, (atom_match0, atom_match1,)
+                    for pair in todo.pop( (id1, id0,), [] ) :
+                        yield pair, (atom_match1, atom_match0,)
+            # A pair without a row has no common substructure, unless all the jobs that searched it were killed.
+            finished = [set( [e.id() for e in jobs[k]] ) for k in range( len( jobs ) ) if (k not in killed)]
+            for (id0, id1,), e in sorted( todo.items(), key = lambda x : min( x[1] ) ) :
+                is_killed = not [g for g in finished if (id0 in g and id1 in g)]
+                for pair in e :
+                    yield pair, (TimedOut() if (is_killed) else None)
 
 
 
         def search_all( self, mols, opt ) :
             if (not opt.mcs) :
-                mae_fname = tempfile_basename + ".mae"
-                out_fname = tempfile_basename + ".csv"
-                log_fname = tempfile_basename + ".log"
-                log_fh    = open( log_fname, "w" )
-
-                if (os.path.isfile( mae_fname )) :
-                    os.remove( mae_fname )
-
-                for mol in mols :
-                    title = mol.title()
-                    mol.set_title( mol.id() )
-                    mol.write( mae_fname )
-                    mol.set_title( title )
-                cmd          = [self._cmd,
-                                "-imae",     mae_fname,
-                                "-opw",      out_fname,
-                                "-atomtype", str( self._typing ),
-                                "-nobreakring",
-                                ]
-                mcs_proc     = subprocess.Popen( cmd, stderr = subprocess.STDOUT, stdout = log_fh )
-                null, stderr = mcs_proc.communicate()
-                val          = mcs_proc.returncode
-
-                if (val == 17) :
-                    raise RuntimeError( "Used a MCS feature that requires Schrodinger's CANVAS_ELEMENTS license." )
-                if (val != 0 ) :
-                    msg = "CanvasMCS exited prematurely. This could be because the input molecules were too dissimilar" \
-                          " or too numerous, or because the chosen atom-typing scheme was too general."
-                    with open( out_fname ) as fh:
-                        msg += "\n\n"
-                        msg += fh.read()
-                    raise RuntimeError( msg )
-            else :
-                logging.debug( "DEBUG: Reuse previous MCS searching results: '%s'." % opt.mcs )
-                out_fname = opt.mcs
-            
-            with open( out_fname, "r" ) as fh :
-                import csv
-                
-                lines     = fh.readlines()[1:]
-                mcs_match = []
-                for tokens in csv.reader( lines ) :
-                    mcs_match.append( McsMatch( tokens[1], tokens[3], tokens[11],  tokens[14], tokens[9], tokens[12] ) )
+                return Mcs.search_all( self, mols, opt )
 
+            logging.debug( "DEBUG: Reuse previous MCS searching results: '%s'." % opt.mcs )
             ret = []
-            for m in mcs_match :
-                id0  = m.mol0_id
-                id1  = m.mol1_id
-                mol0 = KBASE.ask( id0 )
-                mol1 = KBASE.ask( id1 )
-
-                atom_match0 = [int( i ) for i in m.mcs_atom0.split( ',' )]
-                atom_match1 = [int( i ) for i in m.mcs_atom1.split( ',' )]
-
+            for id0, id1, atom_match0, atom_match1 in self._read_canvas( opt.mcs ) :
                 ret.append( self.deposit_to_kbase( id0, id1, atom_match0, atom_match1 ) )
-                
             return ret
         
 except ImportError :
@@ -314,6 +1021,172 @@ except ImportError :
 
 
 
+try :
+    import numpy
+
+    class _SearchStopped( Exception ) :
+        """
+        Stops the search of C{PyMcs}. Its argument is the class of the result: C{TimedOut} or C{StepLimited}.
+        """
+        pass
+
+
+
+    class PyMcs( Mcs ) :
+        """
+        A reference MCS engine in Python and NumPy, which works with any C{Struc} (in particular C{struc.PyStruc}) and needs no
+        licensed toolkit. Like C{OeMcs} with its default settings, it matches any heavy atom with any heavy atom and any bond
+        with any bond, ignores hydrogen atoms, and returns the biggest connected common substructure that it finds.
+
+        The search is a branch-and-bound on NumPy adjacency arrays: the common substructure grows one pattern atom at a time
+        from its frontier, each pattern atom is either matched with a compatible target atom (one whose bonds to the matched
+        target atoms are the same as the pattern atom's bonds to the matched pattern atoms) or excluded, and branches that
+        cannot beat the best match so far are cut.
+        """
+        def __init__( self, max_steps = 20000, pair_timeout = 0 ) :
+            """
+            @type     max_steps: C{int}
+            @param    max_steps: Maximum number of search steps per pair of molecules. When reached, the best match so far is
+                                 returned as a C{StepLimited} result, so the search is exhaustive only for small or similar
+                                 molecules.
+            @type  pair_timeout: C{float}
+            @param pair_timeout: Time budget in seconds per pair of molecules. When the budget runs out, the best match so far
+                                 is returned as a C{TimedOut} result. 0 means no limit.
+            """
+            Mcs.__init__( self )
+            self._max_steps    = max_steps
+            self._pair_timeout = pair_timeout
+
+            self._prepared     = None
+
+
+
+        @staticmethod
+        def _prepare( mol ) :
+            """
+            Returns a tuple of (array of the indices of the heavy atoms, adjacency array of the heavy atoms,) of the molecule.
+            """
+            heavy = numpy.array( sorted( mol.heavy_atoms() ), dtype = int )
+            index = dict( [(e, k,) for k, e in enumerate( heavy )] )
+            adj   = numpy.zeros( (len( heavy ), len( heavy ),), dtype = bool )
+            for k, e in enumerate( heavy ) :
+                for b in mol.bonded_atoms( e ) :
+                    if (b in index) :
+                        adj[k, index[b]] = True
+            return heavy, adj
+
+
+
+        def match( self, mol0, mol1 ) :
+            return self._match_prepared( self._prepare( mol0 ), self._prepare( mol1 ) )
+
+
+
+        def iter_matches( self, mols, pairs, num_jobs = 1, block_size = None ) :
+            """
+            Same as C{Mcs.iter_matches}, but each molecule is prepared (see C{_prepare}) only once, before any worker process
+            is forked.
+            """
+            involved       = set( [i for i, j in pairs] + [j for i, j in pairs] )
+            self._prepared = dict( [(k, self._prepare( mols[k] ),) for k in involved] )
+            try :
+                for e in Mcs.iter_matches( self, mols, pairs, num_jobs, block_size ) :
+                    yield e
+            finally :
+                self._prepared = None
+
+
+
+        def match_block( self, mols, pairs ) :
+            if (self._prepared is None) :
+                return Mcs.match_block( self, mols, pairs )
+            return [self._match_prepared( self._prepared[i], self._prepared[j] ) for i, j in pairs]
+
+
+
+        def _match_prepared( self, p0, p1 ) :
+            """
+            Matches the prepared target molecule C{p0} with the prepared pattern molecule C{p1}, and returns the pair of lists
+            of matched atom indices, or C{None} if there is no match. If the time budget or the step limit runs out, returns a
+            C{TimedOut} or C{StepLimited} result instead.
+            """
+            heavy0, adj0 = p0
+            heavy1, adj1 = p1
+            n0, n1       = len( heavy0 ), len( heavy1 )
+            if (n0 == 0 or n1 == 0) :
+                return None
+
+            deadline = (time.time() + self._pair_timeout) if (self._pair_timeout) else None
+            state    = numpy.zeros( n1, dtype = int )       # 0: undecided, 1: matched, -1: excluded
+            used     = numpy.zeros( n0, dtype = bool )
+            matched0 = []
+            matched1 = []
+            best     = [[], [],]
+            steps    = [0,]
+            degree0  = adj0.sum( axis = 1 )
+            degree1  = adj1.sum( axis = 1 )
+
+            def extend() :
+                steps[0] += 1
+                if (steps[0] > self._max_steps) :
+                    raise _SearchStopped( StepLimited )
+                if (deadline and not steps[0] % 100 and time.time() > deadline) :
+                    raise _SearchStopped( TimedOut )
+
+                undecided = (state == 0)
+                if (len( matched1 ) + min( undecided.sum(), n0 - len( matched0 ) ) <= len( best[0] )) :
+                    return
+                if (matched1) :
+                    frontier = undecided & adj1[:, matched1].any( axis = 1 )
+                    if (not frontier.any()) :
+                        if (len( matched1 ) > len( best[0] )) :
+                            best[0], best[1] = list( matched0 ), list( matched1 )
+                        return
+                    # The most constrained frontier atom goes first.
+                    num_bond = numpy.where( frontier, adj1[:, matched1].sum( axis = 1 ), -1 )
+                    a        = int( num_bond.argmax() )
+                    cand     = ~used & (adj0[:, matched0] == adj1[a, matched1]).all( axis = 1 )
+                else :
+                    a    = int( numpy.where( undecided, degree1, -1 ).argmax() )
+                    cand = ~used
+                cand = numpy.flatnonzero( cand )
+                cand = cand[numpy.argsort( abs( degree0[cand] - degree1[a] ), kind = "mergesort" )]
+
+                state[a] = 1
+                matched1.append( a )
+                for t in cand :
+                    used[t] = True
+                    matched0.append( t )
+                    extend()
+                    matched0.pop()
+                    used[t] = False
+                matched1.pop()
+                state[a] = -1
+                extend()
+                state[a] = 0
+
+            stopped = None
+            try :
+                extend()
+            except _SearchStopped, e :
+                stopped = e.args[0]
+            result = None
+            if (best[0]) :
+                result = ([int( heavy0[k] ) for k in best[0]], [int( heavy1[k] ) for k in best[1]],)
+            if (stopped) :
+                return stopped( result or () )
+            return result
+
+
+
+        def signature( self ) :
+            return "PyMcs(max_steps=%d)" % self._max_steps
+
+except ImportError :
+    pass
+
+
+
 def get_parent_ids( mcs_id ) :
     """
     Returns a pair of IDs of the common substructure's parents.
@@ -325,20 +1198,32 @@ def get_parent_ids( mcs_id ) :
 
 
 
+def get_atom_matches( mcs_id ) :
+    """
+    Returns a dict mapping the IDs of the common substructure's parents to the indices of their matched atoms. The matched
+    atoms of the two parents are in the same order, sorted by the atom indices of the first parent (see C{get_parent_ids}).
+
+    @type  mcs_id: C{str}
+    @param mcs_id: ID of the common substructure
+    """
+    id0, id1    = KBASE.ask( mcs_id, "mcs-parents" )
+    mcs_matches = KBASE.ask( mcs_id, "mcs-matches" )
+    return {id0 : mcs_matches[0], id1 : mcs_matches[1],}
+
+
+
 def get_struc( mcs_id ) :
     """
     get the mcs strcuture based on mcs_id
     """
     title                    = KBASE.ask( mcs_id                )
     id0, id1                 = KBASE.ask( mcs_id, "mcs-parents" )
-    mcs_matches              = KBASE.ask( mcs_id, "mcs-matches" )
-    atom_match0, atom_match1 = mcs_matches[id0], mcs_matches[id1]
+    atom_match0, atom_match1 = KBASE.ask( mcs_id, "mcs-matches" )
     mol0                     = KBASE.ask( id0 )
     mol1                     = KBASE.ask( id1 )
     mcs                      = KBASE.ask( id0 ).extract( atom_match0 )
 
-    for i, e in enumerate( atom_match1, start = 1 ) :
-        mcs.atom_prop[i]["mapped_index"] = e
+    mcs.atom_prop["mapped_index"] = atom_match1
 
     mcs.set_title( title  )
     mcs.set_id   ( mcs_id )
@@ -106,12 +106,43 @@ class DotRender:
         self._renderEdges()
    
         self._D.set_shape_files(self._img_list)
-        self._D.write(filename, format=format)
+        if format is None:
+            format = guess_format(filename)
+        if format in (None, 'raw', 'dot'):
+            self._D.write(filename, format='raw')
+        else:
+            self._runDot(filename, format)
         
         if not self._save_image:
             for image in self._img_list:
                 os.remove(image)   
                 
+    def _runDot(self, filename, format):
+        # Runs Graphviz through our runner instead of pydot, so that the
+        # output of Graphviz goes to the log and a hanging run can be
+        # interrupted.
+        import pydot
+        import runner
+        import tempfile
+
+        progs = pydot.find_graphviz()
+        if not progs or self._D.prog not in progs:
+            raise RuntimeError('GraphViz\'s executable "%s" not found' % self._D.prog)
+
+        dot_fd, dot_fname = tempfile.mkstemp(suffix='.dot')
+        os.close(dot_fd)
+        log_fname = dot_fname[:-4] + '.log'
+        try:
+            self._D.write(dot_fname, format='raw')
+            job = runner.run([progs[self._D.prog], '-T' + format, '-o', filename, dot_fname],
+                             name=self._D.prog, log_fname=log_fname)
+            if job.returncode != 0:
+                raise RuntimeError('GraphViz\'s "%s" exited with status %d.' % (self._D.prog, job.returncode))
+        finally:
+            for fname in (dot_fname, log_fname):
+                if os.path.exists(fname):
+                    os.remove(fname)
+
     def _getImgFname(self, name):
         img_fname = '%s_%s.%s'%(self._basename, 
                                 name, 
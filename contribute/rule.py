@@ -6,6 +6,7 @@
 from kbase import KBASE
 
 import mcs
+import struc
 import similarity
 
 import hashlib
@@ -84,8 +85,8 @@ class MinimumNumberOfAtom( Rule ) :
     def _similarity( self, id0, id1, **kwarg ) :
         # Uses the first common substructure.
         num_atom_mcs  = KBASE.ask( kwarg["mcs_id"], "num_heavy_atoms" )
-        num_atom_mol0 = len( KBASE.ask( id0 ).heavy_atoms() )
-        num_atom_mol1 = len( KBASE.ask( id1 ).heavy_atoms() )
+        num_atom_mol0 = struc.ask_descriptor( id0, "num_heavy_atoms" )
+        num_atom_mol1 = struc.ask_descriptor( id1, "num_heavy_atoms" )
 
         return float( (num_atom_mcs  >= self._threshold    ) or
                       (num_atom_mol0 <  self._threshold + 3) or
@@ -132,10 +133,8 @@ class EqualCharge( Rule ) :
         
         
     def _similarity( self, id0, id1, **kwarg ) :
-        # Retrieves the parent molecules of the MCS.
-        mol0 = KBASE.ask( id0 )
-        mol1 = KBASE.ask( id1 )
-        if (mol0.total_charge() != mol1.total_charge()) :
+        # Uses the descriptors of the parent molecules, which do not need the structures in memory.
+        if (struc.ask_descriptor( id0, "total_charge" ) != struc.ask_descriptor( id1, "total_charge" )) :
             return 0.0
         return 1.0
 
@@ -184,8 +183,10 @@ class TrimMcs( Rule ) :
         mo0_ring_atoms = mol0.ring_atoms()
         mo1_ring_atoms = mol1.ring_atoms()
 
-        mo0_conflict   = set( [mcs0.atom_prop[i][  "orig_index"] for i in mcs_nonr_atoms] ) & mo0_ring_atoms
-        mo1_conflict   = set( [mcs0.atom_prop[i]["mapped_index"] for i in mcs_nonr_atoms] ) & mo1_ring_atoms
+        orig_index     = mcs0.atom_prop[  "orig_index"]
+        mapped_index   = mcs0.atom_prop["mapped_index"]
+        mo0_conflict   = set( [int(   orig_index[i] ) for i in mcs_nonr_atoms] ) & mo0_ring_atoms
+        mo1_conflict   = set( [int( mapped_index[i] ) for i in mcs_nonr_atoms] ) & mo1_ring_atoms
 
         def extend_conflict_to_whole_ring( mol, conflict ) :
             ring_agrps = mol.ring_atoms( aromaticity = 0, group = True )
@@ -230,8 +231,8 @@ class TrimMcs( Rule ) :
         mo0_to_mcs = {}
         mo1_to_mcs = {}
         for i in range( 1, len( mcs0.atom ) + 1 ) :
-            mo0_to_mcs[mcs0.atom_prop[i][  "orig_index"]] = i
-            mo1_to_mcs[mcs0.atom_prop[i]["mapped_index"]] = i
+            mo0_to_mcs[int(   orig_index[i] )] = i
+            mo1_to_mcs[int( mapped_index[i] )] = i
         mo0_conflict = set( [mo0_to_mcs[i] for i in mo0_conflict if (i in mo0_to_mcs)] )
         mo1_conflict = set( [mo1_to_mcs[i] for i in mo1_conflict if (i in mo1_to_mcs)] )
 
@@ -280,11 +281,8 @@ class TrimMcs( Rule ) :
         mcs0.delete_atom( atoms_to_delete )
 
         # Gets the SMARTS for the trimmed structure.
-        atom_list0 = []
-        atom_list1 = []
-        for e in mcs0.atom_prop[1:] :
-            atom_list0.append( e[  "orig_index"] )
-            atom_list1.append( e["mapped_index"] )
+        atom_list0 = [int( e ) for e in mcs0.atom_prop[  "orig_index"][1:]]
+        atom_list1 = [int( e ) for e in mcs0.atom_prop["mapped_index"][1:]]
 
         smarts0 = mol0.smarts( atom_list0 )
         try :
@@ -332,10 +330,12 @@ class TrimMcs_oe( Rule ) :
         mo1_conflict = []
         #Strict ring check 
         #Delete atoms which change ring size either from mol0 to mcs or from mol1 to mcs
+        orig_index = mcs0.atom_prop["orig_index"]
+        mapped_index = mcs0.atom_prop["mapped_index"]
         if self._strict_ring_checking:
             for i in mcs0_ring_dic.keys():
-                mol0_key = mcs0.atom_prop[i][  "orig_index"]
-                mol1_key = mcs0.atom_prop[i][  "mapped_index"]
+                mol0_key = int(orig_index[i])
+                mol1_key = int(mapped_index[i])
 
                 if mcs0_ring_dic[i] <> mol0_ring_dic[mol0_key]:
                     mo0_conflict.append(i)
@@ -346,8 +346,8 @@ class TrimMcs_oe( Rule ) :
         #Delete all atoms which either (a) in a ring in mol0 but not in a ring in mcs, or (b) in a ring in mol1 but not in a ring in mcs, or (c) in a ring in mcs and not in aromatic ring in either mcs, mol0, mol1 if the ring size is changed from mol0 to mcs or mol1 to mcs.  
         else:
             for i in mcs0_ring_dic.keys():                    
-                mol0_key = mcs0.atom_prop[i][  "orig_index"]  
-                mol1_key = mcs0.atom_prop[i][  "mapped_index"]
+                mol0_key = int(orig_index[i])
+                mol1_key = int(mapped_index[i])
                 #delete atoms for case (a) and case (b)                     
                 if mcs0_ring_dic[i] == 0 and mol0_ring_dic[mol0_key] > 0:   
                     mo0_conflict.append(i)                    
@@ -372,6 +372,8 @@ class TrimMcs_oe( Rule ) :
         mol1   = KBASE.ask( id1 )
 
         orig_num_heavy_atoms = len( mcs0.heavy_atoms() )
+        # `delete_atom' renumbers the remaining atoms 1..n on every infrastructure, so no copy is needed after a deletion to
+        # compact the atom indices.
         # Deletes chiral atoms.
         chiral_atoms = mcs0.chiral_atoms()
         ring_atoms   = mcs0.  ring_atoms()
@@ -391,23 +393,18 @@ class TrimMcs_oe( Rule ) :
                             i = atom
                             n = m
                     mcs0.delete_atom( i )
-                    mcs0 = mcs0.copy()
                 else :
                     logging.warn( "WARNING: Cannot delete chiral atom #%d in structure: %s" % (atom_index, mcs0.title(),) )
             else :
                 # If the chiral atom is not a ring atom, we simply delete it.
                 mcs0.delete_atom( atom_index )
-                mcs0 = mcs0.copy()
 
         # If the deletion results in multiple unconnected fragments, we keep only the biggest one.
-        mcs0 = mcs0.copy()
         atoms_to_delete = []
         for e in mcs0.molecules()[1:] :
             atoms_to_delete.extend( e )
         mcs0.delete_atom( atoms_to_delete )
-        mcs0 = mcs0.copy()
         partial_ring         = self._delete_broken_ring( mol0, mol1, mcs0 )
-        mcs0 = mcs0.copy()
         atoms_to_delete_2 = []
         for e in mcs0.molecules()[1:] :
             atoms_to_delete_2.extend( e )
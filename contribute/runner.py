@@ -0,0 +1,237 @@
+"""Runs external programs concurrently, with their logs tailed into the logger, progress estimates, timeouts and cancellation
+"""
+
+
+
+import os
+import time
+import logging
+import subprocess
+
+
+
+class LineCounter( object ) :
+    """
+    Counts the lines of a growing file, reading only the new part of the file on each call.
+    """
+    def __init__( self, filename ) :
+        self._filename = filename
+        self._offset   = 0
+        self._count    = 0
+
+
+
+    def __call__( self ) :
+        try :
+            with open( self._filename, "rb" ) as fh :
+                fh.seek( self._offset )
+                data = fh.read()
+        except IOError :
+            return self._count
+        self._offset += len( data )
+        self._count  += data.count( "\n" )
+        return self._count
+
+
+
+class Job( object ) :
+    """
+    An external program submitted to a C{Runner}. After the job is finished, C{returncode} is the exit status of the program,
+    and C{timed_out} and C{cancelled} tell whether it was killed because of its timeout or by C{Runner.cancel}.
+    """
+    def __init__( self, cmd, name, log_fname, timeout, cwd, progress ) :
+        self.cmd        = cmd
+        self.name       = name
+        self.log_fname  = log_fname
+        self.timeout    = timeout
+        self.cwd        = cwd
+        self.progress   = progress
+        self.returncode = None
+        self.timed_out  = False
+        self.cancelled  = False
+
+        self._proc          = None
+        self._start_time    = None
+        self._deadline      = None
+        self._log_offset    = 0
+        self._log_rest      = ""
+        self._last_progress = None
+
+
+
+    def is_done( self ) :
+        return self.returncode is not None or self.timed_out or self.cancelled
+
+
+
+class Runner( object ) :
+    """
+    Runs external programs up to C{max_jobs} at a time. The standard output and error of each program go to its log file,
+    whose new lines are passed to the logger at the debug level while the program runs.
+
+    The runner is driven by polling, so it can be used in two ways: C{run} blocks until all submitted jobs are done, and
+    C{poll} does one round of work and returns, so that the caller can do other work between the rounds.
+    """
+    def __init__( self, max_jobs = 1, poll_interval = 0.2, progress_interval = 30.0 ) :
+        """
+        @type           max_jobs: C{int}
+        @param          max_jobs: Maximum number of programs running at the same time
+        @type      poll_interval: C{float}
+        @param     poll_interval: Seconds between the rounds of C{run}
+        @type  progress_interval: C{float}
+        @param progress_interval: Minimum seconds between two progress messages of a job
+        """
+        self._max_jobs          = max( 1, max_jobs )
+        self._poll_interval     = poll_interval
+        self._progress_interval = progress_interval
+        self._pending           = []
+        self._running           = []
+        self.jobs               = []
+
+
+
+    def submit( self, cmd, name = None, log_fname = None, timeout = None, cwd = None, progress = None ) :
+        """
+        Submits an external program and returns its C{Job}. The program is started by C{poll} or C{run}.
+
+        @type        cmd: C{list} of C{str}
+        @param       cmd: Command line of the program
+        @type       name: C{str}
+        @param      name: Name of the job in the log messages. Default is the program's name.
+        @type  log_fname: C{str}
+        @param log_fname: Name of the log file. If it is C{None}, the output of the program is discarded.
+        @type    timeout: C{float}
+        @param   timeout: The program is killed if it runs longer than this number of seconds. C{None} or 0 means no limit.
+        @type        cwd: C{str}
+        @param       cwd: Working directory of the program
+        @type   progress: A callable
+        @param  progress: Called without arguments while the program runs, and returns the estimated fraction of the work done,
+                          or C{None} if unknown.
+        """
+        job = Job( cmd, name or os.path.basename( cmd[0] ), log_fname, timeout, cwd, progress )
+        self._pending.append( job )
+        self.jobs.append( job )
+        return job
+
+
+
+    def _start( self, job ) :
+        out = open( job.log_fname, "w" ) if (job.log_fname) else open( os.devnull, "w" )
+        try :
+            job._proc = subprocess.Popen( job.cmd, stdout = out, stderr = subprocess.STDOUT, cwd = job.cwd )
+        finally :
+            out.close()
+        job._start_time    = time.time()
+        job._last_progress = job._start_time
+        if (job.timeout) :
+            job._deadline = job._start_time + job.timeout
+        self._running.append( job )
+        logging.debug( "DEBUG: [%s] started: %s" % (job.name, " ".join( job.cmd ),) )
+
+
+
+    def _tail( self, job, is_final = False ) :
+        if (not job.log_fname) :
+            return
+        try :
+            with open( job.log_fname, "rb" ) as fh :
+                fh.seek( job._log_offset )
+                data = fh.read()
+        except IOError :
+            return
+        job._log_offset += len( data )
+        lines            = (job._log_rest + data).split( "\n" )
+        job._log_rest    = lines.pop()
+        if (is_final and job._log_rest) :
+            lines.append( job._log_rest )
+            job._log_rest = ""
+        for line in lines :
+            logging.debug( "DEBUG: [%s] %s" % (job.name, line.rstrip(),) )
+
+
+
+    def _report_progress( self, job ) :
+        if (job.progress is None or time.time() - job._last_progress < self._progress_interval) :
+            return
+        job._last_progress = time.time()
+        fraction           = job.progress()
+        if (fraction) :
+            fraction = min( fraction, 1.0 )
+            elapsed  = time.time() - job._start_time
+            logging.info( "  [%s] %.0f%% done in %.0f seconds, about %.0f seconds to go" \
+                          % (job.name, 100.0 * fraction, elapsed, elapsed * (1.0 - fraction) / fraction,) )
+
+
+
+    def _kill( self, job ) :
+        try :
+            job._proc.kill()
+        except OSError :
+            pass
+        job._proc.wait()
+        self._tail( job, True )
+        self._running.remove( job )
+
+
+
+    def poll( self ) :
+        """
+        Does one round of work: starts pending jobs up to the limit, tails the logs, reports progress, and kills the jobs that
+        ran out of time. Returns true if there are still jobs pending or running.
+        """
+        while (self._pending and len( self._running ) < self._max_jobs) :
+            self._start( self._pending.pop( 0 ) )
+        for job in list( self._running ) :
+            self._tail( job )
+            if (job._proc.poll() is not None) :
+                self._tail( job, True )
+                job.returncode = job._proc.returncode
+                self._running.remove( job )
+                logging.debug( "DEBUG: [%s] exited with status %d." % (job.name, job.returncode,) )
+            elif (job._deadline and time.time() > job._deadline) :
+                job.timed_out = True
+                self._kill( job )
+                logging.warn( "WARNING: [%s] ran out of its time budget (%g seconds) and was killed." % (job.name,
+                                                                                                       job.timeout,) )
+            else :
+                self._report_progress( job )
+        return bool( self._pending or self._running )
+
+
+
+    def run( self ) :
+        """
+        Runs all submitted jobs to the end and returns the list of all jobs. If interrupted (e.g., by Ctrl-C), the jobs are
+        cancelled before the exception goes on.
+        """
+        try :
+            while (self.poll()) :
+                time.sleep( self._poll_interval )
+        except :
+            self.cancel()
+            raise
+        return self.jobs
+
+
+
+    def cancel( self ) :
+        """
+        Kills the running jobs and drops the pending ones.
+        """
+        for job in self._pending :
+            job.cancelled = True
+        self._pending = []
+        for job in list( self._running ) :
+            job.cancelled = True
+            self._kill( job )
+
+
+
+def run( cmd, **kwarg ) :
+    """
+    Runs a single external program to the end and returns its C{Job}. The keyword arguments are the same as C{Runner.submit}.
+    """
+    r = Runner( 1 )
+    job = r.submit( cmd, **kwarg )
+    r.run()
+    return job
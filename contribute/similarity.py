@@ -54,6 +54,21 @@ def by_heavy_atom_count( mol0, mol1, mcs ) :
 
 
 
+def max_by_heavy_atom_count( num_heavy_atom0, num_heavy_atom1 ) :
+    """
+    Returns the upper bound of the score of C{by_heavy_atom_count} for two molecules with the given numbers of heavy atoms.
+    The common substructure cannot have more heavy atoms than the smaller molecule, so the difference is at least
+    |num_heavy_atom0 - num_heavy_atom1|. This assumes that heavy atoms are matched only to heavy atoms.
+
+    @type  num_heavy_atom0: C{int}
+    @param num_heavy_atom0: Number of heavy atoms of the first molecule
+    @type  num_heavy_atom1: C{int}
+    @param num_heavy_atom1: Number of heavy atoms of the second molecule
+    """
+    return exp_delta( abs( num_heavy_atom0 - num_heavy_atom1 ), 0 )
+
+
+
 if ("__main__" == __name__) :
     for i in range( 100 ) :
         print i, math.exp( -0.1 * i )
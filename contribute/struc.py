@@ -6,13 +6,157 @@
 from kbase import KBASE
 
 import os
-import copy
 import hashlib
+import functools
 
 
 
 # Flag indicating which infrastructure we are using.
-infrastructure = None    # "schrodinger" | "oechem"
+infrastructure = None    # "schrodinger" | "oechem" | "python"
+
+
+
+def _copied( obj ) :
+    """
+    Returns a copy of C{obj} if it is a list, set or dict (and of the lists, sets and dicts in a list or set), or C{obj}
+    itself otherwise.
+    """
+    if (isinstance( obj, dict )) :
+        return dict( obj )
+    if (isinstance( obj, (list, set,) )) :
+        if (obj and isinstance( next( iter( obj ) ), (list, set, dict,) )) :
+            return obj.__class__( [_copied( e ) for e in obj] )
+        return obj.__class__( obj )
+    return obj
+
+
+
+def _memoized( method ) :
+    """
+    Decorates a descriptor method of a C{Struc} subclass, so that its result is calculated once for each structure (and each
+    set of arguments), and kept until the structure is changed (see C{Struc._changed}). Lists, sets and dicts are returned as
+    copies, so the callers may change them.
+    """
+    name = method.__name__
+
+    @functools.wraps( method )
+    def wrapper( self, *args, **kwarg ) :
+        key = (name, args, tuple( sorted( kwarg.items() ) ),) if (args or kwarg) else name
+        try :
+            ret = self._memo[key]
+        except KeyError :
+            ret = self._memo[key] = method( self, *args, **kwarg )
+        return _copied( ret )
+
+    return wrapper
+
+
+
+try :
+    import numpy
+
+    def _new_column( values ) :
+        ret = numpy.array( [0,] + list( values ), dtype = numpy.int32 )
+        ret.flags.writeable = False
+        return ret
+
+    def _take( column, indices ) :
+        ret = column[[0,] + indices]
+        ret.flags.writeable = False
+        return ret
+
+    def _delete( column, indices ) :
+        ret = numpy.delete( column, indices )
+        ret.flags.writeable = False
+        return ret
+
+except ImportError :
+    def _new_column( values ) :
+        return tuple( [0,] + list( values ) )
+
+    def _take( column, indices ) :
+        return tuple( [column[i] for i in [0,] + indices] )
+
+    def _delete( column, indices ) :
+        indices = set( indices )
+        return tuple( [e for i, e in enumerate( column ) if (i not in indices)] )
+
+
+
+class AtomProp( object ) :
+    """
+    Integer properties of the atoms of a structure, e.g., "orig_index" (index of the atom in the structure that this one was
+    extracted from). Each property is a column (a read-only numpy array, or a tuple without numpy) indexed by the 1-based
+    atom indices, so C{atom_prop["orig_index"][i]} is the property of the atom C{i}; element 0 is unused. Unset properties
+    are 0.
+
+    Columns are never changed in place but replaced, so copies share them until either copy is changed.
+    """
+    def __init__( self, num_atom ) :
+        self._num_atom = num_atom
+        self._columns  = {}
+
+
+
+    def __len__( self ) :
+        """
+        Returns the number of atoms.
+        """
+        return self._num_atom
+
+
+
+    def __contains__( self, name ) :
+        return name in self._columns
+
+
+
+    def __getitem__( self, name ) :
+        return self._columns[name]
+
+
+
+    def __setitem__( self, name, values ) :
+        """
+        Sets the property C{name} of all atoms to C{values}, which are in the order of the atom indices.
+        """
+        if (len( values ) != self._num_atom) :
+            raise ValueError( "%d values given for the property '%s' of %d atoms." % (len( values ), name, self._num_atom,) )
+        self._columns[name] = _new_column( values )
+
+
+
+    def names( self ) :
+        return self._columns.keys()
+
+
+
+    def copy( self ) :
+        ret          = AtomProp( self._num_atom )
+        ret._columns = dict( self._columns )
+        return ret
+
+
+
+    def take( self, indices ) :
+        """
+        Returns the properties of the atoms C{indices} (in that order) as those of a new structure.
+        """
+        indices      = [int( e ) for e in indices]
+        ret          = AtomProp( len( indices ) )
+        ret._columns = dict( [(name, _take( e, indices ),) for name, e in self._columns.items()] )
+        return ret
+
+
+
+    def delete( self, indices ) :
+        """
+        Deletes the properties of the atoms C{indices}. The other atoms are renumbered in the same order.
+        """
+        indices         = sorted( set( [int( e ) for e in indices] ) )
+        self._num_atom -= len( indices )
+        for name, e in self._columns.items() :
+            self._columns[name] = _delete( e, indices )
 
 
 
@@ -59,18 +203,31 @@ class Struc( object ) :
     """
     def __init__( self ) :
         # Public attributes:
-        self.atom_prop = []
+        self.atom_prop = AtomProp( len( self.atom ) )
 
         # Private attributes:
-        self._id = None
-
-        for i in range( len( self.atom ) + 1 ) :
-            self.atom_prop.append( {} )
+        self._id   = None
+        self._memo = {}         # Memoized descriptors, see `_memoized'
         
         
 
     def __str__( self ) :
         return self.title()
+
+
+
+    def __setstate__( self, state ) :
+        # Structures pickled without the memo
+        self.__dict__.update( state )
+        self.__dict__.setdefault( "_memo", {} )
+
+
+
+    def _changed( self ) :
+        """
+        Forgets the memoized descriptors (see C{_memoized}). Subclasses call this whenever they change the structure.
+        """
+        self._memo = {}
     
 
         
@@ -238,6 +395,76 @@ class Struc( object ) :
         """
         raise NotImplementedError( "`write' method not implemented by subclass" )
 
+
+
+# Keys of the first structures deposited for each pair of (canonical SMILES, total charge,), across all calls of `deposit_struc'.
+_unique_strucs = {}
+
+
+
+def deposit_descriptors( id, mol ) :
+    """
+    Deposits the descriptors of the structure C{mol} that are often needed without the structure itself: its title, total
+    charge and number of heavy atoms. Reading them does not bring an evicted structure back into memory (see
+    C{kbase.MolStore}).
+    """
+    KBASE.deposit_extra( id, "title",           mol.title() )
+    KBASE.deposit_extra( id, "total_charge",    mol.total_charge() )
+    KBASE.deposit_extra( id, "num_heavy_atoms", len( mol.heavy_atoms() ) )
+
+
+
+def ask_descriptor( id, tag ) :
+    """
+    Returns the descriptor C{tag} (see C{deposit_descriptors}) of the structure C{id}. For a structure deposited without its
+    descriptors (e.g., by another script), they are calculated from the structure and deposited on the first call.
+    """
+    try :
+        return KBASE.ask( id, tag )
+    except LookupError :
+        deposit_descriptors( id, KBASE.ask( id ) )
+        return KBASE.ask( id, tag )
+
+
+
+def deposit_struc( mol, source, id = None ) :
+    """
+    Deposits the structure C{mol} read from the record C{source[1]} of the structure file C{source[0]} into the C{KBASE},
+    together with its file name, descriptors (see C{deposit_descriptors}) and canonical SMILES ("SMILES" tag). Returns its key.
+
+    A structure identical to an earlier one (same canonical SMILES and total charge) gets the key of the earlier one deposited
+    with the "alias-of" tag, so that the MCS searching can be done once for all copies (see C{mcs.Mcs.search_pairs}).
+
+    @type     id: C{str}
+    @param    id: Key to deposit the structure under, overwriting any knowledge of it. By default, the key is C{mol.id()},
+                  and it is changed if it is already in the C{KBASE}.
+    """
+    id = KBASE.deposit( mol.id() if (id is None) else id, mol, should_overwrite = id is not None, source = source )
+    KBASE.deposit_extra( id, "filename", source[0] )
+    mol.set_id( id )
+    deposit_descriptors( id, mol )
+    smiles = mol.smiles()
+    KBASE.deposit_extra( id, "SMILES", smiles )
+    key = (smiles, mol.total_charge(),)
+    if (key in _unique_strucs and _unique_strucs[key] != id) :
+        KBASE.deposit_extra( id, "alias-of", _unique_strucs[key] )
+    else :
+        _unique_strucs[key] = id
+    return id
+
+
+
+def _deposit_n_files( filenames, read_file ) :
+    """
+    Reads the structure files with the C{read_file} function and deposits the structures into the C{KBASE} (see
+    C{deposit_struc}). Returns a list of keys.
+    """
+    strucid = []
+    for fn in filenames :
+        for record, e in enumerate( read_file( fn ) ) :
+            strucid.append( deposit_struc( e, (fn, record,) ) )
+    return strucid
+
     
 
 try :
@@ -265,7 +492,8 @@ try :
             Returns a copy of this structure.
             """
             ret           = SchrodStruc( self._struc.copy() )
-            ret.atom_prop = copy.deepcopy( self.atom_prop )
+            ret.atom_prop = self.atom_prop.copy()
+            ret._memo     = dict( self._memo )
             return ret
             
 
@@ -274,10 +502,9 @@ try :
             """
             Return a new structure object which contains the atoms of the current structure that appear in the specified list.
             """
-            ret = SchrodStruc( self._struc.extract( indices, True ) )
-            indices.sort()
-            for i, e in enumerate( indices, start = 1 ) :
-                ret.atom_prop[i] = copy.deepcopy( self.atom_prop[e] )
+            indices       = sorted( [int( e ) for e in indices] )
+            ret           = SchrodStruc( self._struc.extract( indices, True ) )
+            ret.atom_prop = self.atom_prop.take( indices )
             return ret
         
         
@@ -298,6 +525,7 @@ try :
         
             
             
+        @_memoized
         def heavy_atoms( self ) :
             """
             Returns a list of indices of heavy atoms (viz non-hydrogen atoms).
@@ -321,6 +549,7 @@ try :
         
         
         
+        @_memoized
         def chiral_atoms( self ) :
             """
             Returns the indices of the chiral atoms.
@@ -336,6 +565,7 @@ try :
 
 
 
+        @_memoized
         def ring_atoms( self, aromaticity = 0, group = False ) :
             """
             Returns ring atoms.
@@ -403,6 +633,7 @@ try :
         
         
         
+        @_memoized
         def total_charge( self ) :
             """
             Returns the formal charge of the structure
@@ -422,9 +653,9 @@ try :
                 atom_index = [atom_index,]
             atom_index.sort()
             atom_index.reverse()
+            self._changed()
             self._struc.deleteAtoms( atom_index )
-            for i in atom_index :
-                del self.atom_prop[i]
+            self.atom_prop.delete( atom_index )
             
 
 
@@ -437,6 +668,8 @@ try :
             """
             import schrodinger.structutils.analyze as analyze
 
+            if (atoms is not None) :
+                atoms = [int( e ) for e in atoms]
             return analyze.generate_smarts( self._struc, atoms )
 
 
@@ -483,28 +716,32 @@ try :
         ret = []
         for ct in structure.StructureReader( filename, format = format ) :
             struc = SchrodStruc( ct )
-            for i in range( 1, len( struc.atom ) + 1 ) :
-                struc.atom_prop[i]["orig_index"] = i
+            struc.atom_prop["orig_index"] = range( 1, len( struc.atom ) + 1 )
             ret.append( struc )
             
         return ret
 
 
 
+    def read_record( filename, record ) :
+        """
+        Reads the structure of the index C{record} from a structure file, and returns it as a `SchrodStruc' object, or
+        C{None} if the file has no such structure. The reader starts at that structure; the ones before it are not parsed
+        into structures.
+        """
+        for ct in structure.StructureReader( filename, index = record + 1 ) :
+            struc = SchrodStruc( ct )
+            struc.atom_prop["orig_index"] = range( 1, len( struc.atom ) + 1 )
+            return struc
+
+
+
     def read_n_files( filenames ) :
         """
         `filenames' is a list of file names. The format of each file will be determined from the file's extension name. Reads
         the files and deposits them into the `KBASE'. Returns a list of keys.
         """
-        strucid = []
-        for fn in filenames :
-            strucs = read_file( fn )
-            for e in strucs :
-                id = KBASE.deposit( e.id(), e )
-                KBASE.deposit_extra(id, "filename", (fn))
-                e.set_id( id )
-                strucid.append( id )
-        return strucid
+        return _deposit_n_files( filenames, read_file )
 
     infrastructure = "schrodinger"
     
@@ -544,7 +781,8 @@ try:
             Returns a copy of this structure.
             """
             ret = OeStruc( self._struc.CreateCopy() )
-            ret.atom_prop = copy.deepcopy(self.atom_prop)
+            ret.atom_prop = self.atom_prop.copy()
+            ret._memo = dict(self._memo)
             return ret
         
 
@@ -552,19 +790,19 @@ try:
             """                                               
             Return a new structure object which contains the atoms of the current structure that appear in the specified list.
             """                                               
+            indices = sorted([int(e) for e in indices])
+            kept = set(indices)
             #make a copy before deleting atoms                  
             new_mol = self._struc.CreateCopy()
             for atom in new_mol.GetAtoms():
                 oe_idx = atom.GetIdx() + 1
-                if oe_idx not in indices:
+                if oe_idx not in kept:
                     new_mol.DeleteAtom(atom)
             #make a copy after deleting to make sure the idx start from 1   
             new_mol_copy = new_mol.CreateCopy()               
             oechem.OEFindRingAtomsAndBonds(new_mol_copy)      
             ret = OeStruc(new_mol_copy)                       
-            indices.sort()                                    
-            for i, e in enumerate(indices, start = 1):        
-                ret.atom_prop[i] = copy.deepcopy(self.atom_prop[e])              
+            ret.atom_prop = self.atom_prop.take(indices)
             return ret
         
             
@@ -585,6 +823,7 @@ try:
 
             
 
+        @_memoized
         def heavy_atoms(self) :
             """
             Returns a list of indices of heavy atoms (viz non-hydrogen atoms).
@@ -598,6 +837,7 @@ try:
             return ret
         
 
+        @_memoized
         def total_charge( self ) :
             """
             Returns oechem net charge of the structure
@@ -615,6 +855,7 @@ try:
             return self.atom[atom_index].IsChiral()
         
 
+        @_memoized
         def chiral_atoms( self ) :
             """
             Returns the indices of chiral atoms.
@@ -633,6 +874,7 @@ try:
             return ret
         
 
+        @_memoized
         def ring_atoms( self ) :
             """
             Returns a set of ring atoms.
@@ -649,6 +891,7 @@ try:
                     ret.append( oe_idx )                      
             return set( ret )
         
+        @_memoized
         def aromatic_atoms ( self ):                          
             """                                               
             Returns a set of aromatic atoms. 
@@ -665,6 +908,7 @@ try:
                     ret.append( oe_idx )                      
             return set( ret )
     
+        @_memoized
         def ring_size (self):                                 
             """
             Returns a dictionary, which is atom's index correspoding to the ring size the atom in.
@@ -745,24 +989,21 @@ f a molecule in the structure. The first
                 atom_index = [atom_index,]
             atom_index.sort()
             atom_index.reverse()
-            ret_atoms = []
-            for (idx, e) in enumerate(self._struc.GetAtoms()):
-                oe_idx = idx + 1
-                for i in atom_index:
-                    if i == oe_idx:
-                        ret_atoms.append(e)
-
-            for j in ret_atoms:                               
-                self._struc.DeleteAtom(j)                     
-                self.atom = {}                                
-                for atom in self._struc.GetAtoms():           
-                    oe_idx = atom.GetIdx() + 1                
-                    if self.atom.has_key(oe_idx):
-                        print "Struc has duplicate atom index :i %s need to check"%oe_idx                                                     
-                    else:                                     
-                        self.atom[oe_idx] = atom
-            for i in atom_index:                              
-                del self.atom_prop[i]
+            if (not atom_index) :
+                return
+            self._changed()
+            # Resolves all the atom handles in a single pass, deletes them, and then renumbers the remaining atoms
+            # once (`CreateCopy' compacts the indices that `DeleteAtom' leaves behind), instead of rebuilding the
+            # index map after every single deletion.
+            doomed = set( atom_index )
+            for (idx, e) in enumerate( list( self._struc.GetAtoms() ) ) :
+                if (idx + 1 in doomed) :
+                    self._struc.DeleteAtom( e )
+            self._struc = self._struc.CreateCopy()
+            self.atom   = {}
+            for atom in self._struc.GetAtoms() :
+                self.atom[atom.GetIdx() + 1] = atom
+            self.atom_prop.delete(atom_index)
         def smiles(self):                                     
             """                                               
             Returns a SMILES string for this structure.       
@@ -824,25 +1065,24 @@ and `OEMol' objects.
                                                               
         istream.close()                                       
         struc = OeStruc(molecule)                             
-        for i in range(1, len(struc.atom) + 1) :              
-            struc.atom_prop[i]["orig_index"] = i        
+        struc.atom_prop["orig_index"] = range(1, len(struc.atom) + 1)
         ret.append(struc)                                     
                                                                       
         return ret
 
+    def read_record( filename, record ) :
+        """
+        Reads the structure of the index C{record} from a structure file, and returns it as an `OeStruc' object, or C{None} if
+        the file has no such structure. Like `read_file', only the first structure of a file is read.
+        """
+        if (record == 0) :
+            return read_file( filename )[0]
+
     def read_n_files( filenames ) :
         """                                                   
         `filenames' is a list of file names. Reads the files and deposits them into the `KBASE'. Returns a list of keys.                                                           
         """                                                   
-        strucid = []
-        for fn in filenames :
-            strucs = read_file( fn )
-            for e in strucs:                                  
-                id = KBASE.deposit( e.id(), e )               
-                KBASE.deposit_extra(id, "filename", (fn))
-                e.set_id( id )                                
-                strucid.append( id )                          
-        return strucid
+        return _deposit_n_files( filenames, read_file )
 
 
     infrastructure = "oechem"
@@ -852,10 +1092,583 @@ except ImportError, e :
 
 
 
+class PyStruc( Struc ) :
+    """
+    A `Struc' subclass in pure Python, which needs neither Schrodinger's nor OEChem's infrastructure. It reads and writes
+    Tripos .mol2 files (see C{read_mol2_file}), and perceives rings, aromaticity and chirality from the connection table and
+    the SYBYL atom and bond types.
+    """
+    # Elements that can be written in SMILES strings without brackets
+    _ORGANIC = set( ["B", "C", "N", "O", "P", "S", "F", "Cl", "Br", "I",] )
+
+    def __init__( self, title, atoms, bonds ) :
+        """
+        @type  title: C{str}
+        @param title: Title of the structure
+        @type  atoms: C{list} of C{dict}
+        @param atoms: Atoms in the order of their indices. Each atom is a dictionary with the keys: "name", "xyz" (a tuple of
+                      3 floats), "type" (SYBYL atom type), "element", "charge" (partial charge) and "subst" (a tuple of the
+                      substructure ID and name). The dictionaries are owned by this structure afterwards.
+        @type  bonds: C{list} of C{(int, int, str,)}
+        @param bonds: Bonds as tuples of (atom index, atom index, SYBYL bond type,). Atom indices start from 1.
+        """
+        self._title = title
+        self._bonds = bonds
+        self.atom   = dict( enumerate( atoms, start = 1 ) )
+        self._update_bonded()
+        Struc.__init__( self )
+
+
+
+    def _update_bonded( self ) :
+        self._bonded = dict( [(i, {},) for i in self.atom] )
+        for i, j, type in self._bonds :
+            self._bonded[i][j] = type
+            self._bonded[j][i] = type
+
+
+
+    def copy( self ) :
+        """
+        Returns a copy of this structure.
+        """
+        ret = PyStruc( self._title, [dict( self.atom[i] ) for i in range( 1, len( self.atom ) + 1 )], list( self._bonds ) )
+        ret.atom_prop = self.atom_prop.copy()
+        ret._memo     = dict( self._memo )
+        return ret
+
+
+
+    def extract( self, indices ) :
+        """
+        Return a new structure object which contains the atoms of the current structure that appear in the specified list.
+        """
+        indices   = sorted( [int( e ) for e in indices] )
+        new_index = dict( [(e, i,) for i, e in enumerate( indices, start = 1 )] )
+        bonds     = [(new_index[i], new_index[j], type,) for i, j, type in self._bonds
+                     if (i in new_index and j in new_index)]
+        ret       = PyStruc( self._title, [dict( self.atom[e] ) for e in indices], bonds )
+        ret.atom_prop = self.atom_prop.take( indices )
+        return ret
+
+
+
+    def title( self ) :
+        return self._title
+
+
+
+    def set_title( self, new_title ) :
+        self._title = new_title
+
+
+
+    @_memoized
+    def heavy_atoms( self ) :
+        """
+        Returns a list of indices of heavy atoms (viz non-hydrogen atoms).
+        """
+        return [i for i in range( 1, len( self.atom ) + 1 ) if (self.atom[i]["element"] != "H")]
+
+
+
+    @_memoized
+    def total_charge( self ) :
+        """
+        Returns the total charge of the structure, which is the sum of the partial charges rounded to an integer.
+        """
+        return int( round( sum( [e["charge"] for e in self.atom.values()] ) ) )
+
+
+
+    @_memoized
+    def _ring_bonds( self ) :
+        """
+        Returns a set of ring bonds, each as a C{frozenset} of two atom indices. A bond is in a ring if and only if it is not a
+        bridge of the molecular graph.
+        """
+        depth   = {}
+        low     = {}
+        bridges = set()
+        for root in self.atom :
+            if (root in depth) :
+                continue
+            # Iterative depth-first search, element of `stack' = (atom, parent, iterator of bonded atoms,)
+            depth[root] = low[root] = 0
+            stack       = [(root, None, iter( self._bonded[root] ),)]
+            while (stack) :
+                a, parent, it = stack[-1]
+                for b in it :
+                    if (b == parent) :
+                        continue
+                    if (b in depth) :
+                        low[a] = min( low[a], depth[b] )
+                    else :
+                        depth[b] = low[b] = depth[a] + 1
+                        stack.append( (b, a, iter( self._bonded[b] ),) )
+                        break
+                else :
+                    stack.pop()
+                    if (parent is not None) :
+                        low[parent] = min( low[parent], low[a] )
+                        if (low[a] > depth[parent]) :
+                            bridges.add( frozenset( (a, parent,) ) )
+        return set( [frozenset( (i, j,) ) for i, j, type in self._bonds] ) - bridges
+
+
+
+    def _components( self, bonds ) :
+        """
+        Returns a list of lists of atom indices that are connected by the given bonds. Atoms not in any bond are not returned.
+        """
+        neighbors = {}
+        for e in bonds :
+            i, j = tuple( e )[:2]
+            neighbors.setdefault( i, [] ).append( j )
+            neighbors.setdefault( j, [] ).append( i )
+        ret  = []
+        seen = set()
+        for i in sorted( neighbors ) :
+            if (i in seen) :
+                continue
+            component = []
+            stack     = [i,]
+            seen.add( i )
+            while (stack) :
+                a = stack.pop()
+                component.append( a )
+                for b in neighbors[a] :
+                    if (b not in seen) :
+                        seen.add( b )
+                        stack.append( b )
+            ret.append( sorted( component ) )
+        return ret
+
+
+
+    @_memoized
+    def _symmetry_classes( self ) :
+        """
+        Returns a dictionary of atom indices to ranks, so that two atoms have the same rank if they cannot be distinguished by
+        their elements, their numbers of bonded atoms and, iteratively, the ranks of their bonded atoms.
+        """
+        def rerank( keys ) :
+            order = sorted( set( keys.values() ) )
+            order = dict( [(e, k,) for k, e in enumerate( order )] )
+            return dict( [(i, order[e],) for i, e in keys.items()] )
+
+        aromatic = self.aromatic_atoms()
+        rank     = rerank( dict( [(i, (e["element"], len( self._bonded[i] ), i in aromatic,),)
+                                      for i, e in self.atom.items()] ) )
+        num      = 0
+        while (num != len( set( rank.values() ) )) :
+            num  = len( set( rank.values() ) )
+            keys = {}
+            for i in self.atom :
+                keys[i] = (rank[i], tuple( sorted( [(rank[j], self._bonded[i][j],) for j in self._bonded[i]] ) ),)
+            rank = rerank( keys )
+        return rank
+
+
+
+    def _canonical_ranks( self ) :
+        """
+        Returns a dictionary of atom indices to unique ranks. Ties between the symmetry classes are broken one at a time and
+        the ranks are refined again, so equivalent atoms end up in the same order whatever their original indices are.
+        """
+        rank = self._symmetry_classes()
+        while (len( set( rank.values() ) ) < len( rank )) :
+            counts = {}
+            for e in rank.values() :
+                counts[e] = counts.get( e, 0 ) + 1
+            tie  = min( [e for e, n in counts.items() if (n > 1)] )
+            pick = min( [i for i, e in rank.items() if (e == tie)] )
+            keys = dict( [(i, (2 * e - (i == pick),),) for i, e in rank.items()] )
+            num  = 0
+            while (num != len( set( keys.values() ) )) :
+                num   = len( set( keys.values() ) )
+                order = dict( [(e, k,) for k, e in enumerate( sorted( set( keys.values() ) ) )] )
+                rank  = dict( [(i, order[e],) for i, e in keys.items()] )
+                keys  = dict( [(i, (rank[i], tuple( sorted( [rank[j] for j in self._bonded[i]] ) ),),) for i in self.atom] )
+        return rank
+
+
+
+    def is_chiral_atom( self, atom_index ) :
+        """
+        Returns true if the atom indicated by C{atom_index} is chiral; otherwise, false.
+
+        @type  atom_index: C{int}
+        @param atom_index: Atom index
+        """
+        return atom_index in self.chiral_atoms()
+
+
+
+    @_memoized
+    def chiral_atoms( self ) :
+        """
+        Returns the indices of the chiral atoms, which are the sp3 carbon and nitrogen atoms with four distinct substituents.
+        Missing hydrogen atoms (e.g., in a substructure) are counted as implicit hydrogens.
+
+        @rtype : C{list} of C{int}
+        @return: A list of atom indices
+        """
+        rank = self._symmetry_classes()
+        ret  = []
+        for i, e in sorted( self.atom.items() ) :
+            if (e["type"] not in ("C.3", "N.4",)) :
+                continue
+            bonded     = self._bonded[i]
+            substs     = [rank[j] for j in bonded if (self.atom[j]["element"] != "H")]
+            num_hydrgn = 4 - len( substs )
+            if (len( bonded ) <= 4 and num_hydrgn <= 1 and len( set( substs ) ) == len( substs )) :
+                ret.append( i )
+        return ret
+
+
+
+    @_memoized
+    def ring_atoms( self ) :
+        """
+        Returns a set of ring atoms.
+
+        @rtype : C{set} of C{int}
+        @return: A set of atom indices
+        """
+        ret = set()
+        for e in self._ring_bonds() :
+            ret |= e
+        return ret
+
+
+
+    @_memoized
+    def aromatic_atoms( self ) :
+        """
+        Returns a set of aromatic atoms, which are the ring atoms of the SYBYL type "*.ar" or in aromatic bonds. (SYBYL types
+        also mark delocalized groups out of rings, e.g., amidinium groups, as aromatic.)
+
+        @rtype : C{set} of C{int}
+        @return: A set of atom indices
+        """
+        ret = set( [i for i, e in self.atom.items() if (e["type"].endswith( ".ar" ))] )
+        for i, j, type in self._bonds :
+            if (type == "ar") :
+                ret.add( i )
+                ret.add( j )
+        return ret & self.ring_atoms()
+
+
+
+    @_memoized
+    def ring_size( self ) :
+        """
+        Returns a dictionary, which is atom's index correspoding to the ring size the atom in. As in the C{OeStruc} class, the
+        ring size is the number of atoms in the ring system (fused rings count as one system), or 0 for non-ring atoms.
+
+        @rtype : C{dic} of C{int} : C{int}
+        @return: A dictionary of atom indices correspoing to the size of the ring they are in.
+        """
+        ret = dict( [(i, 0,) for i in self.atom] )
+        for e in self._components( self._ring_bonds() ) :
+            for i in e :
+                ret[i] = len( e )
+        return ret
+
+
+
+    def bonded_atoms( self, atom_index ) :
+        """
+        Returns a list of atom indices of atoms bonded to the indicated atom.
+
+        @type  atom_index: C{int}
+        @param atom_index: Atom index
+
+        @rtype : C{list} of C{int}
+        @return: A list of atom indices of atoms bonded to the indicated atom
+        """
+        return sorted( self._bonded[atom_index] )
+
+
+
+    def molecules( self ) :
+        """
+        Returns a list of atom lists. Each element list is a list of atoms of a molecule in the structure. The first element
+        in the returned list belongs to the biggest molecule.
+        """
+        ret  = self._components( self._bonds )
+        seen = set()
+        for e in ret :
+            seen |= set( e )
+        ret.extend( [[i,] for i in sorted( self.atom ) if (i not in seen)] )
+        heavy_atoms = set( self.heavy_atoms() )
+        ret.sort( key = lambda x : (-len( x ), -len( set( x ) & heavy_atoms ),) )
+        return ret
+
+
+
+    def delete_atom( self, atom_index ) :
+        """
+        Deletes atoms. The remaining atoms are renumbered in the same order.
+
+        @type  atom_index: C{int} or C{list} of C{int}
+        @param atom_index: A single index or a list of indices of the atoms to be deleted
+        """
+        if (not isinstance( atom_index, list )) :
+            atom_index = [atom_index,]
+        self._changed()
+        deleted = set( atom_index )
+        kept    = [i for i in range( 1, len( self.atom ) + 1 ) if (i not in deleted)]
+        new_idx = dict( [(e, i,) for i, e in enumerate( kept, start = 1 )] )
+
+        self._bonds = [(new_idx[i], new_idx[j], type,) for i, j, type in self._bonds if (i in new_idx and j in new_idx)]
+        self.atom   = dict( [(new_idx[e], self.atom[e],) for e in kept] )
+        self.atom_prop.delete( deleted )
+        self._update_bonded()
+
+
+
+    def smarts( self, atoms = None ) :
+        """
+        Returns a SMARTS string for this structure. Not supported; returns C{None} as C{OeStruc} does.
+        """
+        return None
+
+
+
+    def smiles( self ) :
+        """
+        Returns a canonical SMILES string of the heavy atoms of this structure. Hydrogen atoms are implicit, and charges and
+        stereochemistry are not written.
+        """
+        heavy = self.heavy_atoms()
+        if (len( heavy ) < len( self.atom )) :
+            # Ranks the atoms without the hydrogen atoms, so that the SMILES string does not depend on explicit hydrogens.
+            return self.extract( heavy ).smiles()
+        heavy    = set( heavy )
+        rank     = self._canonical_ranks()
+        aromatic = self.aromatic_atoms()
+        bonded   = dict( [(i, sorted( [j for j in self._bonded[i] if (j in heavy)], key = lambda j : rank[j] ),)
+                          for i in heavy] )
+        opens    = dict( [(i, [],) for i in heavy] )   # Ring closures opened at the atom
+        closes   = dict( [(i, [],) for i in heavy] )   # Ring closures closed at the atom
+        children = dict( [(i, [],) for i in heavy] )
+        visited  = set()
+
+        def walk( a, parent ) :
+            visited.add( a )
+            for b in bonded[a] :
+                if (b == parent) :
+                    continue
+                if (b in visited) :
+                    if (a not in opens[b] and b not in opens[a]) :
+                        opens [b].append( a )
+                        closes[a].append( b )
+                else :
+                    children[a].append( b )
+                    walk( b, a )
+
+        bond_symbol = {"2" : "=", "3" : "#",}
+        digits      = {}   # Ring closure bond (as a frozenset) -> digit
+        free        = range( 1, 100 )
+
+        def write( a ) :
+            e   = self.atom[a]["element"]
+            out = [(e.lower() if (a in aromatic) else e) if (e in self._ORGANIC) else "[%s]" % e]
+            for b in closes[a] :
+                d = digits.pop( frozenset( (a, b,) ) )
+                free.append( d )
+                free.sort()
+                out.append( bond_symbol.get( self._bonded[a][b], "" ) + (str( d ) if (d < 10) else "%%%d" % d) )
+            for b in opens[a] :
+                d = digits[frozenset( (a, b,) )] = free.pop( 0 )
+                out.append( str( d ) if (d < 10) else "%%%d" % d )
+            for k, b in enumerate( children[a] ) :
+                branch = bond_symbol.get( self._bonded[a][b], "" ) + write( b )
+                out.append( branch if (k == len( children[a] ) - 1) else "(%s)" % branch )
+            return "".join( out )
+
+        fragments = []
+        for e in sorted( heavy, key = lambda i : rank[i] ) :
+            if (e not in visited) :
+                walk( e, None )
+                fragments.append( write( e ) )
+        return ".".join( fragments )
+
+
+
+    def write( self, filename, format = "mol2", mode = "w" ) :
+        """
+        Writes this structure into a file in the designated format.
+
+        @type  format: C{str}
+        @param format: Only "mol2" is supported.
+        @type  mode  : C{char}, 'a' | 'w'
+        @param mode  : When a file of the same name exists, this determines whether to overwrite ('w') or append ('a') to the
+                       file.
+        """
+        if (format != "mol2") :
+            raise ValueError( "Unsupported format: '%s', PyStruc only writes .mol2 files." % format )
+        if (mode not in ("a", "w",)) :
+            raise ValueError( "Invalid value for `mode' argument: '%s', should be one of 'a' and 'w'." % mode )
+        lines = ["@<TRIPOS>MOLECULE", self._title, "%5d %5d %5d 0 0" % (len( self.atom ), len( self._bonds ), 1,), "SMALL",
+                 "USER_CHARGES", "", "@<TRIPOS>ATOM",]
+        for i in range( 1, len( self.atom ) + 1 ) :
+            e = self.atom[i]
+            lines.append( "%7d %-8s %10.4f %10.4f %10.4f %-8s %3d %-8s %10.6f" % ((i, e["name"],) + tuple( e["xyz"] ) +
+                                                                              (e["type"],) + tuple( e["subst"] ) +
+                                                                              (e["charge"],)) )
+        lines.append( "@<TRIPOS>BOND" )
+        for k, (i, j, type,) in enumerate( self._bonds, start = 1 ) :
+            lines.append( "%6d %5d %5d %s" % (k, i, j, type,) )
+        with open( filename, mode ) as fh :
+            fh.write( "\n".join( lines ) + "\n" )
+
+
+
+# Absolute file name -> ((size, modification time,), list of the byte offsets of the molecules,) of the .mol2 files read by
+# `read_mol2_file', so that `read_mol2_record' can seek to a molecule instead of parsing the file up to it.
+_mol2_offsets = {}
+
+
+
+def _stamp( filename ) :
+    """
+    Returns a tuple that changes when the file C{filename} is changed.
+    """
+    st = os.stat( filename )
+    return (st.st_size, st.st_mtime,)
+
+
+
+def _parse_mol2( fh, offsets = None, max_num = None ) :
+    """
+    Parses the molecules of a Tripos .mol2 file from the current position of its open handle C{fh}, and returns a list of
+    `PyStruc' objects. The byte offset of each molecule is appended to C{offsets} if it is given. Stops after C{max_num}
+    molecules if it is given.
+    """
+    ret = []
+
+    def add( title, atoms, bonds ) :
+        struc = PyStruc( title, atoms, bonds )
+        struc.atom_prop["orig_index"] = range( 1, len( struc.atom ) + 1 )
+        ret.append( struc )
+
+    title   = None
+    section = None
+    atoms   = []
+    bonds   = []
+    offset  = fh.tell()
+    while (True) :
+        line    = fh.readline()
+        start   = offset
+        offset += len( line )
+        if (not line) :
+            break
+        line = line.strip()
+        if (line.startswith( "@<TRIPOS>" )) :
+            section = line[9:]
+            if (section == "MOLECULE") :
+                if (title is not None) :
+                    add( title, atoms, bonds )
+                    if (len( ret ) == max_num) :
+                        return ret
+                if (offsets is not None) :
+                    offsets.append( start )
+                title = None
+                atoms = []
+                bonds = []
+            continue
+        if (section == "MOLECULE") :
+            if (title is None) :
+                title = line
+        elif (section == "ATOM" and line) :
+            tokens = line.split()
+            type   = tokens[5]
+            atoms.append( {"name"    : tokens[1],
+                           "xyz"     : tuple( [float( e ) for e in tokens[2:5]] ),
+                           "type"    : type,
+                           "element" : type.split( "." )[0],
+                           "subst"   : (int( tokens[6] ), tokens[7],) if (len( tokens ) > 7) else (1, "MOL",),
+                           "charge"  : float( tokens[8] ) if (len( tokens ) > 8) else 0.0,} )
+        elif (section == "BOND" and line) :
+            tokens = line.split()
+            bonds.append( (int( tokens[1] ), int( tokens[2] ), tokens[3],) )
+    if (title is not None) :
+        add( title, atoms, bonds )
+    return ret
+
+
+
+def read_mol2_file( filename ) :
+    """
+    Reads a Tripos .mol2 file and returns a list of `PyStruc' objects, one for each molecule in the file. The byte offsets of
+    the molecules are remembered for C{read_mol2_record}.
+
+    @type  filename: C{str}
+    @param filename: Name of the structure file
+    """
+    offsets = []
+    with open( filename, "rb" ) as fh :
+        stamp = _stamp( filename )
+        ret   = _parse_mol2( fh, offsets )
+    _mol2_offsets[os.path.abspath( filename )] = (stamp, offsets,)
+    return ret
+
+
+
+def read_mol2_record( filename, record ) :
+    """
+    Reads the molecule of the index C{record} from a Tripos .mol2 file, and returns it as a `PyStruc' object, or C{None} if
+    the file has no such molecule. Only that molecule is parsed: the file is scanned for the offsets of its molecules once,
+    unless it has been read by C{read_mol2_file}, and is changed since.
+    """
+    key     = os.path.abspath( filename )
+    offsets = _mol2_offsets.get( key )
+    with open( filename, "rb" ) as fh :
+        stamp = _stamp( filename )
+        if (offsets is None or offsets[0] != stamp) :
+            offsets = (stamp, [],)
+            for line in iter( fh.readline, "" ) :
+                if (line.strip() == "@<TRIPOS>MOLECULE") :
+                    offsets[1].append( fh.tell() - len( line ) )
+            _mol2_offsets[key] = offsets
+        if (record >= len( offsets[1] )) :
+            return None
+        fh.seek( offsets[1][record] )
+        return _parse_mol2( fh, max_num = 1 )[0]
+
+
+
 if (infrastructure is None) :
-    print "ERROR: Need either Schrodinger's or OEChem's infrastructure to run, but none is found."
-    import sys
-    sys.exit( 1 )
+    print "\nWARNING: Neither Schrodinger's nor OEChem's infrastructure is found. Using the pure-Python infrastructure, which " \
+          "reads only .mol2 files.\n"
+
+    def read_file( filename ) :
+        """
+        Reads a .mol2 file and returns a list of `PyStruc' objects.
+        """
+        return read_mol2_file( filename )
+
+
+
+    def read_record( filename, record ) :
+        """
+        Reads the molecule of the index C{record} from a .mol2 file, and returns it as a `PyStruc' object, or C{None} if the
+        file has no such molecule (see C{read_mol2_record}).
+        """
+        return read_mol2_record( filename, record )
+
+
+
+    def read_n_files( filenames ) :
+        """
+        `filenames' is a list of file names. Reads the files and deposits them into the `KBASE'. Returns a list of keys.
+        """
+        return _deposit_n_files( filenames, read_file )
+
+    infrastructure = "python"
 
     
 
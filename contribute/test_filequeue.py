@@ -0,0 +1,166 @@
+"""Checks the file queue (see the C{filequeue} module) against a local run of the same code
+
+The maps built through the queue with local workers must be the same as the maps built by the serial run, also when several
+records of a structure file share a title. Claims of dead workers must be queued again, but not fresh claims of units that
+waited long in the queue, and a failing worker must stop the driver. Run from this directory:
+
+    python test_filequeue.py
+"""
+
+
+
+from kbase import KBASE
+
+import struc
+import mcs
+import filequeue
+
+import os
+import sys
+import glob
+import time
+import pickle
+import shutil
+import optparse
+import tempfile
+import unittest
+import threading
+import subprocess
+
+
+
+HERE     = os.path.dirname( os.path.abspath( __file__ ) )
+TEST_SET = os.path.join( HERE, os.pardir, "test_sets", "M-build27" )
+
+
+
+def _run_main( workdir, name, *args ) :
+    """
+    Runs C{main.py} with the arguments C{args} in the directory C{workdir}, writing the map into C{<name>.pkl}. Returns the
+    map as a tuple of (sorted list of edges with their attributes, sorted list of nodes with their attributes,).
+    """
+    with open( os.path.join( workdir, name + ".log" ), "w" ) as log :
+        subprocess.check_call( [sys.executable, os.path.join( HERE, "main.py" ), "-o", name,] + list( args ),
+                               cwd = workdir, stdout = log, stderr = subprocess.STDOUT )
+    g = pickle.load( open( os.path.join( workdir, name + ".pkl" ) ) )
+    return (sorted( [(tuple( sorted( (id0, id1,) ) ), sorted( e.items() ),) for id0, id1, e in g.edges( data = True )] ),
+            sorted( [(id, sorted( e.items() ),) for id, e in g.nodes( data = True )] ),)
+
+
+
+def _retitle( fname, title ) :
+    """
+    Returns the lines of the Tripos .mol2 file C{fname} with the title of every molecule replaced by C{title}.
+    """
+    lines = open( fname ).read().splitlines()
+    for k, line in enumerate( lines[:-1] ) :
+        if (line.startswith( "@<TRIPOS>MOLECULE" )) :
+            lines[k + 1] = title
+    return lines
+
+
+
+class TestFileQueue( unittest.TestCase ) :
+    def setUp( self ) :
+        self.workdir = tempfile.mkdtemp( prefix = "test_filequeue." )
+
+
+
+    def tearDown( self ) :
+        shutil.rmtree( self.workdir, ignore_errors = True )
+
+
+
+    def test_same_map_as_serial_run( self ) :
+        serial = _run_main( self.workdir, "serial", TEST_SET )
+        queued = _run_main( self.workdir, "queued", "--queue", os.path.join( self.workdir, "queue" ), "-j", "2", TEST_SET )
+        self.assertTrue( serial[0] )
+        self.assertEqual( serial, queued )
+        self.assertEqual( [], glob.glob( os.path.join( self.workdir, "queue", "*", "*" ) ) )
+
+
+
+    def test_records_with_same_title( self ) :
+        fname = os.path.join( self.workdir, "same.mol2" )
+        with open( fname, "w" ) as fh :
+            for e in sorted( glob.glob( os.path.join( TEST_SET, "*.mol2" ) ) )[:3] :
+                fh.write( "\n".join( _retitle( e, "SAME" ) ) + "\n" )
+        serial = _run_main( self.workdir, "serial", fname )
+        queued = _run_main( self.workdir, "queued", "--queue", os.path.join( self.workdir, "queue" ), "-j", "2", fname )
+        self.assertTrue( serial[0] )
+        self.assertEqual( serial, queued )
+
+
+
+    def _mols( self ) :
+        ids = struc.read_n_files( sorted( glob.glob( os.path.join( TEST_SET, "*.mol2" ) ) )[:3] )
+        return [KBASE.ask( id ) for id in ids]
+
+
+
+    def test_stale_claims_are_queued_again( self ) :
+        mols    = self._mols()
+        pairs   = [(0, 1,), (0, 2,), (1, 2,),]
+        queue   = filequeue.FileQueue( self.workdir )
+        arrived = []
+        driver  = threading.Thread( target = lambda : arrived.extend( queue.match_pairs( mcs.PyMcs(), mols, pairs, 1, 0, 1.0 ) ) )
+        driver.daemon = True
+        driver.start()
+
+        # A worker that claims a unit and dies
+        todo = os.path.join( self.workdir, "todo" )
+        while (len( [e for e in os.listdir( todo ) if (e.endswith( ".pkl" ))] ) < len( pairs )) :
+            time.sleep( 0.1 )
+        name  = sorted( os.listdir( todo ) )[0]
+        stale = os.path.join( self.workdir, "claimed", name + ".dead.0" )
+        os.rename( os.path.join( todo, name ), stale )
+        os.utime( stale, (time.time() - 60, time.time() - 60,) )
+
+        filequeue.work( self.workdir )
+        deadline = time.time() + 60
+        while (driver.is_alive() and time.time() < deadline) :
+            filequeue.work( self.workdir )
+            driver.join( 0.5 )
+        self.assertFalse( driver.is_alive() )
+        self.assertFalse( os.path.exists( stale ) )
+        self.assertEqual( sorted( pairs ), sorted( [e for block, results in arrived for e in block] ) )
+
+
+
+    def test_fresh_claims_of_old_units_stay( self ) :
+        queue = filequeue.FileQueue( self.workdir )
+        unit  = os.path.join( self.workdir, "todo", "old_0.pkl" )
+        filequeue._write( unit, ("old", [],) )
+        os.utime( unit, (time.time() - 100, time.time() - 100,) )
+
+        name, claimed = filequeue._claim( self.workdir, "live.0" )
+        self.assertEqual( "old_0.pkl", name )
+        queue._requeue_stale( 10.0 )
+        self.assertTrue( os.path.exists( claimed ) )
+        self.assertEqual( [], os.listdir( os.path.join( self.workdir, "todo" ) ) )
+
+
+
+    def test_non_pairwise_engine_is_refused( self ) :
+        class Engine( mcs.PyMcs ) :
+            _is_pairwise = False
+
+        opt = optparse.Values( {"prune" : 0, "cache" : None, "checkpoint" : None, "queue" : self.workdir, "jobs" : 0,} )
+        with self.assertRaises( ValueError ) :
+            Engine().search_pairs( self._mols(), [(0, 1,),], opt )
+
+
+
+    def test_failing_worker_stops_driver( self ) :
+        mols = self._mols()
+        KBASE.deposit( mols[1].id(), mols[1], should_overwrite = True,
+                       source = (os.path.join( self.workdir, "missing.mol2" ), 0,) )
+        queue = filequeue.FileQueue( self.workdir )
+        with self.assertRaises( RuntimeError ) :
+            list( queue.match_pairs( mcs.PyMcs(), mols, [(0, 1,),], 1, 1 ) )
+        self.assertEqual( [], glob.glob( os.path.join( self.workdir, "*", "*" ) ) )
+
+
+
+if ("__main__" == __name__) :
+    unittest.main()
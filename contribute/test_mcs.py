@@ -0,0 +1,65 @@
+"""Checks the planning of the canvasMCS jobs (see C{mcs._plan_canvas_jobs}), which needs no Schrodinger installation
+
+Every requested pair must be searched by some job. When all pairs of the molecules are requested, one job must search them
+all, or with concurrent jobs the pairs must be searched at most twice on average. When only the pairs that involve the new
+structures of add mode are requested, every job must include new structures, and with a few new structures far fewer pairs
+must be searched than all pairs. Run from this directory:
+
+    python test_mcs.py
+"""
+
+
+
+import mcs
+
+import unittest
+
+
+
+def _searched( jobs ) :
+    """
+    Returns a tuple of (set of the pairs searched by the jobs, total number of pairs searched by the jobs,).
+    """
+    pairs = set( [(i, j,) for e in jobs for i in e for j in e if (i < j)] )
+    return pairs, sum( [mcs._num_pair( len( e ) ) for e in jobs] )
+
+
+
+class TestPlanCanvasJobs( unittest.TestCase ) :
+    def _check_covered( self, pairs, jobs ) :
+        searched = _searched( jobs )[0]
+        self.assertEqual( [], [(i, j,) for i, j in pairs if ((min( i, j ), max( i, j ),) not in searched)] )
+
+
+
+    def test_all_pairs( self ) :
+        n     = 100
+        pairs = [(i, j,) for i in range( n ) for j in range( i + 1, n )]
+        self.assertEqual( [range( n ),], mcs._plan_canvas_jobs( pairs, 1, 200 ) )
+
+        jobs = mcs._plan_canvas_jobs( pairs, 8, 200 )
+        self._check_covered( pairs, jobs )
+        self.assertTrue( len( jobs ) >= 8 )
+        self.assertTrue( _searched( jobs )[1] < 2 * len( pairs ) )
+
+
+
+    def test_add_mode( self ) :
+        for num_old, num_new, num_jobs in [(1000, 1, 1,), (1000, 10, 1,), (1000, 10, 4,), (200, 200, 4,),] :
+            n     = num_old + num_new
+            pairs = [(i, j,) for i in range( n ) for j in range( max( i + 1, num_old ), n )]
+            jobs  = mcs._plan_canvas_jobs( pairs, num_jobs, 200 )
+            self._check_covered( pairs, jobs )
+            self.assertEqual( [], [e for e in jobs if (max( e ) < num_old)] )
+            if (num_new < num_old) :
+                self.assertTrue( _searched( jobs )[1] < mcs._num_pair( n ) / 10 )
+
+
+
+    def test_no_pairs( self ) :
+        self.assertEqual( [], mcs._plan_canvas_jobs( [], 4, 200 ) )
+
+
+
+if ("__main__" == __name__) :
+    unittest.main()